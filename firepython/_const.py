@@ -1,13 +1,50 @@
 import re
 
+AGGREGATE_SAMPLES = 5 # argument tuples sent of an aggregated group
+AGGREGATE_THRESHOLD = None # records of one template aggregated, None is off
 AUTHTOK_FORMAT = '#FireLoggerPassword#%s#'
+BUFFER_REAP_INTERVAL = 60 # seconds between scans for buffers of dead threads
+COMPRESSION_LEVEL = 6
+CONTINUOUS_MAX_ROUTES = 100 # routes told apart by the continuous sampler
+CONTINUOUS_MAX_STACKS = 500 # distinct stacks per route and window
+CONTINUOUS_SAMPLE_INTERVAL = 0.05 # seconds between continuous samples
+CONTINUOUS_WINDOW = 60 # seconds of samples per window
+CONTINUOUS_WINDOWS = 10 # windows kept
 DEEP_LOCALS = True
+EXCEPTION_CAPTURES = 3 # full captures of one exception per request
 FIRELOGGER_APPSTATS_ENABLED_HEADER = 'HTTP_X_FIRELOGGERAPPSTATS'
 FIRELOGGER_AUTH_HEADER = 'HTTP_X_FIRELOGGERAUTH'
+FIRELOGGER_ENCODING_HEADER = 'HTTP_X_FIRELOGGERENCODING'
+FIRELOGGER_ENCODING_RESPONSE_HEADER = 'FireLoggerEncoding-%(guid)s'
 FIRELOGGER_HEADER_FORMAT = 'FireLogger-%(guid)s-%(identity)s'
+FIRELOGGER_LEVEL_HEADER = 'HTTP_X_FIRELOGGERLEVEL'
 FIRELOGGER_MESSAGE_HEADER = 'FireLoggerMessage'
 FIRELOGGER_PROFILER_ENABLED_HEADER = 'HTTP_X_FIRELOGGERPROFILER'
 FIRELOGGER_RESPONSE_HEADER = re.compile(r'^FireLogger', re.IGNORECASE)
+FIRELOGGER_TOKEN_RESPONSE_HEADER = 'FireLoggerToken'
 FIRELOGGER_VERSION_HEADER = 'HTTP_X_FIRELOGGER'
+FLUSH_DEADLINE = None # seconds for preparing the logs of a response
+FRAME_MAX_DEPTH = 3 # container nesting of captured locals with DEEP_LOCALS
+FRAME_MAX_FRAMES = 20 # innermost frames of an exception with captured locals
+FRAME_MAX_ITEMS = 20 # items captured per container
+FRAME_MAX_LOCALS = 50 # locals captured per frame
+FRAME_REPR_LENGTH = 500 # characters per captured repr or string
+FRAME_SKIP_LIBRARIES = False # no locals from stdlib and installed packages
+FUNCTION_NAME_CACHE_SIZE = 1000 # profile graph labels cached by function
+HEADER_CHUNK_SIZE = 76 # characters of base64 payload per FireLogger header
+INCREMENTAL_ENCODING = False # serialize records when emitted, see middleware
 JSONPICKLE_DEPTH = 16
+MAX_PAYLOAD_SIZE = None # bytes of FireLogger headers, None means unlimited
+MAX_RECORDS = None # per request, None means unlimited
+OVERFLOW_POLICY = 'keep-last' # see firepython.handlers.OVERFLOW_POLICIES
+PAYLOAD_STORE_SIZE = 100 # payloads kept for fetching by token
+PAYLOAD_STORE_TTL = 300 # seconds
+PROFILE_PACKAGES = None # measured by the monitoring profiler, None is all
+PROFILE_RENDER_QUEUE = 20 # profile graphs waiting to be rendered
+PROFILE_RENDER_TIMEOUT = 30 # seconds a fetch waits for its profile graph
+PROFILE_RENDER_WORKERS = 0 # background graph renderers, 0 renders inline
+PROFILE_SAMPLE_INTERVAL = 0.005 # seconds between stack samples
 RAZOR_MODE = False
+SERIALIZER = 'jsonpickle' # see firepython.serializers.SERIALIZERS
+SNAPSHOT_RECORDS = False # buffer RecordSnapshots, see firepython.handlers
+TRACEBACK_CACHE_SIZE = 1000 # traceback entries cached by code location
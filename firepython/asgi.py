@@ -0,0 +1,185 @@
+# -*- mode: python; coding: utf-8 -*-
+"""
+ASGI middleware for FirePython (Python 3.7+).
+
+Kept out of ``firepython.middleware`` because it needs ``async`` syntax.
+"""
+
+import asyncio
+import logging
+import weakref
+
+import firepython.profiling
+import firepython.serializers
+import firepython._const as CONST
+from firepython.middleware import FirePythonBase
+
+__all__ = [
+    'FirePythonASGI',
+]
+
+
+def _get_environ(scope):
+    """ Maps ASGI request headers to the WSGI ``HTTP_*`` keys ``_check`` uses. """
+    environ = {}
+    for name, value in scope.get('headers', ()):
+        key = 'HTTP_' + name.decode('latin-1').upper().replace('-', '_')
+        environ[key] = value.decode('latin-1')
+    return environ
+
+
+def _encode_header(name, value):
+    return (name.lower().encode('latin-1'), value.encode('latin-1'))
+
+
+class FirePythonASGI(FirePythonBase):
+    """
+    ASGI middleware to enable FirePython logging.
+
+    Records are buffered per task through ``contextvars``, so concurrent
+    requests served by one event loop get their own logs.  FireLogger
+    headers are added to the ``http.response.start`` message, carrying the
+    records logged up to that point; the body is passed through untouched.
+
+    Profiling measures the request (with ``cProfile`` unless the client
+    asks for another profiler, see ``firepython.profiling``) from its start
+    until the response starts.  Profilers see the whole thread, so the
+    profiler is paused whenever the task of the request waits and the
+    event loop runs other tasks (see ``_TaskProfile``), and only one
+    request is profiled at a time.
+    """
+
+    def __init__(self, app, password=None, logger_name=None, check_agent=True,
+                 serializer=None):
+        self.app = app
+        self._password = password
+        self._logger_name = logger_name
+        self._check_agent = check_agent
+        self._serializer = firepython.serializers.get_serializer(serializer)
+        self._profiled_request = None
+        self.install_handler()
+
+    def __del__(self):
+        self.uninstall_handler()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        request = self._check(_get_environ(scope))
+        check = request.enabled
+        if not check and not request.client_message:
+            await self.app(scope, receive, send) # a quick path
+            return
+
+        if check:
+            self._start_profiler(request)
+            self._start(request, weakref.ref(asyncio.current_task()))
+        client_message = request.client_message
+
+        scope = dict(scope)
+        if request.appstats_enabled:
+            scope['firepython.appstats_enabled'] = True
+        if check:
+            scope['firepython.set_extension_data'] = \
+                request.extension_data.__setitem__
+
+        async def send_with_logs(message):
+            if message['type'] == 'http.response.start':
+                headers = list(message.get('headers', ()))
+
+                def add_header(name, value):
+                    headers.append(_encode_header(name, value))
+
+                if client_message:
+                    add_header(CONST.FIRELOGGER_MESSAGE_HEADER, client_message)
+                if check:
+                    self._flush_response(request, add_header)
+                message = dict(message, headers=headers)
+            await send(message)
+
+        app = self.app(scope, receive, send_with_logs)
+        if check and request.profile_enabled:
+            app = _TaskProfile(self, request, app)
+        try:
+            try:
+                await app
+            except Exception:
+                logging.exception('Exception in ASGI application')
+                raise
+        finally:
+            if check:
+                self._stop_profiler(request)
+                self._discard()
+
+    def _start_profiler(self, request):
+        if not request.profile_enabled:
+            return
+        if self._profiled_request is not None:
+            request.client_message += 'Another request is being profiled. '
+            request.profile_enabled = False
+            return
+        request.profiler = \
+            firepython.profiling.create_profiler(request.profile_mode)
+        self._profiled_request = request
+        if hasattr(request.profiler, 'pause'):
+            # started once, resumed while the task runs, see _TaskProfile
+            request.profiler.enable()
+            request.profiler.pause()
+
+    def _resume_profiler(self, request):
+        if self._profiled_request is request:
+            profiler = request.profiler
+            getattr(profiler, 'resume', profiler.enable)()
+
+    def _pause_profiler(self, request):
+        if self._profiled_request is request:
+            profiler = request.profiler
+            getattr(profiler, 'pause', profiler.disable)()
+
+    def _stop_profiler(self, request):
+        if self._profiled_request is request:
+            request.profiler.disable()
+            self._profiled_request = None
+
+    def _flush_response(self, request, add_header):
+        self._stop_profiler(request)
+        profile = self._prepare_profile(request)
+        self._finish()
+        self._flush_records(request, add_header, profile)
+
+
+class _TaskProfile(object):
+    """
+    Awaitable running the coroutine ``coro`` of ``request`` step by step,
+    with the profiler of the request running only during the steps: while
+    the task waits, the event loop runs other tasks, which must not show
+    in the profile of the request.
+    """
+
+    def __init__(self, middleware, request, coro):
+        self._middleware = middleware
+        self._request = request
+        self._coro = coro
+
+    def __await__(self):
+        coro = self._coro
+        step, value = coro.send, None
+        while True:
+            self._middleware._resume_profiler(self._request)
+            try:
+                future = step(value)
+            except StopIteration as e:
+                return e.value
+            finally:
+                self._middleware._pause_profiler(self._request)
+            try:
+                value = yield future
+                step = coro.send
+            except GeneratorExit:
+                coro.close()
+                raise
+            except BaseException as e: # e.g. cancelled
+                value = e
+                step = coro.throw
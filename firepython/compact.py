@@ -0,0 +1,84 @@
+# -*- mode: python; coding: utf-8 -*-
+"""
+Compact, columnar layout of the log entries of a FireLogger payload.
+
+Sent instead of the list of log entries when the client asks for it with a
+``compact`` option in its version header (e.g. ``X-FireLogger: 1.0;
+compact``).  The payload then has ``"format": "compact"`` and its ``logs``
+are an object:
+
+ - ``count``: number of log entries
+ - ``strings``: interned strings, referred to by index from the
+   ``pathname``, ``name``, ``threadName`` and ``template`` columns
+ - ``columns``: one list per field, ``level`` holds indexes into
+   ``LEVELS`` and ``timestamp`` the first timestamp followed by the
+   differences between consecutive ones (microseconds)
+ - ``extra``: list of ``[index, fields]`` with the remaining fields of the
+   entries having any (exception info, aggregation counts...)
+
+The pre-formatted ``time`` of each entry is left out.
+"""
+
+import sys
+
+__all__ = [
+    'LEVELS',
+    'compact_logs',
+]
+
+
+if sys.version_info[0] >= 3:
+    _TEXT_TYPES = (str,)
+else:
+    _TEXT_TYPES = (str, unicode)
+
+LEVELS = ['debug', 'info', 'warning', 'error', 'critical']
+_LEVEL_CODES = dict((level, code) for code, level in enumerate(LEVELS))
+
+_INTERNED = ('pathname', 'name', 'threadName', 'template')
+_PLAIN = ('message', 'lineno', 'thread', 'process', 'args', 'exc_text')
+_COLUMNS = frozenset(('level', 'timestamp', 'time') + _INTERNED + _PLAIN)
+
+
+def compact_logs(logs):
+    """ Returns the compact layout of log entries ``logs`` (dictionaries). """
+    strings = []
+    indexes = {} # string -> index in strings
+    columns = dict((name, []) for name in _INTERNED + _PLAIN)
+    levels = []
+    timestamps = []
+    extra = []
+    previous = 0
+    for i, log in enumerate(logs):
+        levels.append(_LEVEL_CODES.get(log.get('level'), 0))
+        timestamp = log.get('timestamp', previous)
+        timestamps.append(timestamp - previous)
+        previous = timestamp
+        others = {}
+        for name in _INTERNED:
+            value = log.get(name)
+            if value is None or not isinstance(value, _TEXT_TYPES):
+                if value is not None:
+                    others[name] = value
+                columns[name].append(None)
+                continue
+            index = indexes.get(value)
+            if index is None:
+                index = indexes[value] = len(strings)
+                strings.append(value)
+            columns[name].append(index)
+        for name in _PLAIN:
+            columns[name].append(log.get(name))
+        for name, value in log.items():
+            if name not in _COLUMNS:
+                others[name] = value
+        if others:
+            extra.append([i, others])
+    columns['level'] = levels
+    columns['timestamp'] = timestamps
+    return {
+        'count': len(logs),
+        'strings': strings,
+        'columns': columns,
+        'extra': extra,
+    }
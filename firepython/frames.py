@@ -0,0 +1,253 @@
+# -*- mode: python; coding: utf-8 -*-
+"""
+Bounded capture of traceback frame locals.
+
+What is captured from each exception is governed by constants from
+``firepython._const``:
+
+ - ``FRAME_MAX_FRAMES``: only the innermost frames get their locals
+ - ``FRAME_MAX_LOCALS``: locals captured per frame
+ - ``FRAME_MAX_ITEMS``: items captured per container
+ - ``FRAME_MAX_DEPTH``: container nesting captured with ``DEEP_LOCALS``
+ - ``FRAME_REPR_LENGTH``: characters of each ``repr`` and string
+ - ``FRAME_SKIP_LIBRARIES``: skip frames of the standard library and of
+   installed packages
+
+Locals are captured as bounded ``repr`` strings or, with ``DEEP_LOCALS``,
+as bounded copies of their containers and attributes.  Cycles and anything
+nested too deep end up as bounded ``repr`` strings.
+"""
+
+import os
+import sys
+import zlib
+import types
+import linecache
+
+try:
+    import reprlib
+except ImportError: # Python 2
+    import repr as reprlib
+
+try:
+    import sysconfig
+except ImportError: # Python 2.6
+    sysconfig = None
+
+import firepython._const as CONST
+
+__all__ = [
+    'capture_locals',
+    'capture_value',
+    'bounded_repr',
+    'extract_tb',
+    'fingerprint',
+]
+
+
+if sys.version_info[0] >= 3:
+    _TEXT_TYPES = (str, bytes)
+    _SCALAR_TYPES = (type(None), bool, int, float)
+    _text = str
+else:
+    _TEXT_TYPES = (str, unicode)
+    _SCALAR_TYPES = (type(None), bool, int, long, float)
+    _text = unicode
+_SEQUENCE_TYPES = (list, tuple, set, frozenset)
+_OPAQUE_TYPES = (type, types.ModuleType, types.FunctionType, types.MethodType,
+                 types.BuiltinFunctionType) # captured as repr only
+
+_library_paths = None
+_tb_entries = {} # (filename, line number, function name) -> traceback entry
+
+
+def _get_library_paths():
+    global _library_paths
+    if _library_paths is None:
+        paths = set()
+        if sysconfig is not None:
+            for name in ('stdlib', 'platstdlib', 'purelib', 'platlib'):
+                path = sysconfig.get_paths().get(name)
+                if path:
+                    paths.add(os.path.normcase(os.path.abspath(path)) + os.sep)
+        _library_paths = tuple(paths)
+    return _library_paths
+
+
+def _is_library_frame(frame):
+    filename = os.path.normcase(os.path.abspath(frame.f_code.co_filename))
+    return (filename.startswith(_get_library_paths()) or
+            'site-packages' in filename or 'dist-packages' in filename)
+
+
+def _create_repr():
+    r = reprlib.Repr()
+    r.maxlevel = CONST.FRAME_MAX_DEPTH
+    r.maxstring = r.maxother = r.maxlong = CONST.FRAME_REPR_LENGTH
+    r.maxlist = r.maxtuple = r.maxdict = r.maxset = r.maxfrozenset = \
+        r.maxdeque = r.maxarray = CONST.FRAME_MAX_ITEMS
+    return r
+
+
+def bounded_repr(value, r=None):
+    """ Returns ``repr`` of ``value`` cut to ``FRAME_REPR_LENGTH``. """
+    if r is None:
+        r = _create_repr()
+    try:
+        text = r.repr(value)
+    except Exception as e:
+        text = '<unrepresentable %s: %s>' % (type(value).__name__, e)
+    limit = CONST.FRAME_REPR_LENGTH
+    if len(text) > limit:
+        text = text[:limit - 3] + '...'
+    return text
+
+
+class _Capture(object):
+    """ Bounded copy of values, one instance per exception. """
+
+    def __init__(self):
+        self.repr = _create_repr()
+        self.max_items = CONST.FRAME_MAX_ITEMS
+        self.max_length = CONST.FRAME_REPR_LENGTH
+        self.path = set() # ids of the containers being copied
+
+    def copy(self, value, depth):
+        if isinstance(value, _SCALAR_TYPES):
+            return value
+        if isinstance(value, _TEXT_TYPES):
+            if len(value) > self.max_length:
+                ellipsis = isinstance(value, bytes) and b'...' or u'...'
+                return value[:self.max_length - 3] + ellipsis
+            return value
+        if depth <= 0 or id(value) in self.path:
+            return bounded_repr(value, self.repr)
+        if isinstance(value, dict):
+            items = value
+        elif isinstance(value, _SEQUENCE_TYPES):
+            items = None
+        else:
+            items = getattr(value, '__dict__', None)
+            if not isinstance(items, dict) or isinstance(value, _OPAQUE_TYPES):
+                return bounded_repr(value, self.repr)
+        self.path.add(id(value))
+        try:
+            if items is None:
+                return self._copy_sequence(value, depth - 1)
+            return self._copy_items(items, depth - 1)
+        except Exception:
+            # e.g. a container changed while being copied
+            return bounded_repr(value, self.repr)
+        finally:
+            self.path.discard(id(value))
+
+    def _copy_sequence(self, value, depth):
+        data = []
+        for i, item in enumerate(value):
+            if i == self.max_items:
+                data.append('... %d more' % (len(value) - i))
+                break
+            data.append(self.copy(item, depth))
+        return data
+
+    def _copy_items(self, items, depth):
+        data = {}
+        for i, (key, item) in enumerate(items.items()):
+            if i == self.max_items:
+                data['...'] = '%d more' % (len(items) - i)
+                break
+            if not isinstance(key, _TEXT_TYPES):
+                key = bounded_repr(key, self.repr)
+            data[key] = self.copy(item, depth)
+        return data
+
+    def frame_locals(self, frame, deep):
+        data = {}
+        max_locals = CONST.FRAME_MAX_LOCALS
+        f_locals = frame.f_locals
+        for i, (name, value) in enumerate(f_locals.items()):
+            if i == max_locals:
+                data['...'] = '%d more' % (len(f_locals) - i)
+                break
+            if deep:
+                data[_text(name)] = self.copy(value, CONST.FRAME_MAX_DEPTH)
+            else:
+                data[_text(name)] = bounded_repr(value, self.repr)
+        return data
+
+
+def capture_value(value):
+    """ Returns a bounded copy of ``value`` as captured for frame locals. """
+    return _Capture().copy(value, CONST.FRAME_MAX_DEPTH)
+
+
+def extract_tb(tb):
+    """
+    Returns the entries of ``tb`` like ``traceback.extract_tb`` as plain
+    tuples (filename, line number, function name, text).  Entries are
+    cached by code location, up to ``TRACEBACK_CACHE_SIZE`` of them; unlike
+    ``traceback.extract_tb``, source files changed since their line was
+    cached are not noticed.
+    """
+    entries = []
+    while tb is not None:
+        code = tb.tb_frame.f_code
+        key = (code.co_filename, tb.tb_lineno, code.co_name)
+        entry = _tb_entries.get(key)
+        if entry is None:
+            line = linecache.getline(code.co_filename, tb.tb_lineno,
+                                     tb.tb_frame.f_globals)
+            entry = key + (line.strip() or None,)
+            if len(_tb_entries) >= CONST.TRACEBACK_CACHE_SIZE:
+                _tb_entries.clear()
+            _tb_entries[key] = entry
+        entries.append(entry)
+        tb = tb.tb_next
+    return entries
+
+
+def fingerprint(exc_type, tb):
+    """
+    Returns a short string identifying an exception by its type and the
+    code locations of traceback ``tb``.
+    """
+    locations = []
+    while tb is not None:
+        code = tb.tb_frame.f_code
+        locations.append('%s:%s:%d' % (code.co_filename, code.co_name,
+                                       tb.tb_lineno))
+        tb = tb.tb_next
+    key = '%s.%s|%s' % (getattr(exc_type, '__module__', ''),
+                        getattr(exc_type, '__name__', exc_type),
+                        '|'.join(locations))
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    return '%08x' % (zlib.crc32(key) & 0xffffffff)
+
+
+def capture_locals(tb, deep=None):
+    """
+    Returns bounded copies of the frame locals of traceback ``tb``, one
+    dictionary per traceback entry (outermost first).  Frames without
+    captured locals get an empty dictionary, frames whose locals could not
+    be read ``'?'``.  ``deep`` defaults to ``DEEP_LOCALS``.
+    """
+    if deep is None:
+        deep = CONST.DEEP_LOCALS
+    frames = []
+    while tb is not None:
+        frames.append(tb.tb_frame)
+        tb = tb.tb_next
+    first = max(len(frames) - CONST.FRAME_MAX_FRAMES, 0)
+    skip_libraries = CONST.FRAME_SKIP_LIBRARIES
+    capture = _Capture()
+    result = []
+    for i, frame in enumerate(frames):
+        if i < first or (skip_libraries and _is_library_frame(frame)):
+            result.append({})
+            continue
+        try:
+            result.append(capture.frame_locals(frame, deep))
+        except Exception:
+            result.append('?')
+    return result
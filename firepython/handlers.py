@@ -1,8 +1,26 @@
 # -*- mode: python; coding: utf-8 -*-
 
+import copy
+import time
+import heapq
+import logging
+import weakref
+import itertools
 from logging import Handler
+from collections import deque
 
-__all__ = ['ThreadBufferedHandler']
+import firepython.frames
+import firepython._const as CONST
+
+__all__ = [
+    'ThreadBufferedHandler',
+    'RecordSnapshot',
+    'OVERFLOW_POLICIES',
+    'KEEP_FIRST',
+    'KEEP_LAST',
+    'KEEP_FIRST_AND_LAST',
+    'LEVEL_PRIORITY',
+]
 
 
 threading_supported = False
@@ -13,71 +31,422 @@ try:
 except ImportError:
     pass
 
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
 
-class ThreadBufferedHandler(Handler):
-    """ A logging handler that buffers records by thread. """
+
+KEEP_FIRST = 'keep-first'
+KEEP_LAST = 'keep-last'
+KEEP_FIRST_AND_LAST = 'keep-first-and-last'
+LEVEL_PRIORITY = 'level-priority'
+OVERFLOW_POLICIES = (KEEP_FIRST, KEEP_LAST, KEEP_FIRST_AND_LAST, LEVEL_PRIORITY)
+
+
+class _BoundedRecords(object):
+    """
+    A record list holding at most ``size`` records.  What is dropped once it
+    is full depends on ``policy``:
+
+     - ``keep-first``: new records are dropped
+     - ``keep-last``: the oldest records are dropped
+     - ``keep-first-and-last``: the first half is kept, the rest of the
+       space holds the latest records
+     - ``level-priority``: the oldest records below WARNING are dropped,
+       records of WARNING and above are never dropped
+
+    ``dropped`` counts the dropped records by level number.
+    """
+
+    def __init__(self, size, policy):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError('unknown overflow policy %r' % policy)
+        self.size = size
+        self.policy = policy
+        self.dropped = {}
+        if policy == KEEP_FIRST:
+            self._head, tail = size, 0
+        elif policy == KEEP_LAST:
+            self._head, tail = 0, size
+        elif policy == KEEP_FIRST_AND_LAST:
+            self._head, tail = size - size // 2, size // 2
+        else:
+            self._head, tail = None, None
+        self._first = [] # kept head, or (seq, record) of important records
+        self._last = deque(maxlen=tail) # ring of latest (seq, record)
+        self._seq = itertools.count()
+
+    def append(self, record):
+        if self._head is None:
+            self._append_by_level(record)
+        elif len(self._first) < self._head:
+            self._first.append(record)
+        elif self._last.maxlen:
+            if len(self._last) == self._last.maxlen:
+                self._drop(self._last[0])
+            self._last.append(record)
+        else:
+            self._drop(record)
+
+    def _append_by_level(self, record):
+        item = (next(self._seq), record)
+        if record.levelno >= logging.WARNING:
+            self._first.append(item)
+        elif len(self._first) < self.size:
+            self._last.append(item)
+        else:
+            self._drop(record)
+            return
+        while self._last and len(self._first) + len(self._last) > self.size:
+            self._drop(self._last.popleft()[1])
+
+    def _drop(self, record):
+        self.dropped[record.levelno] = self.dropped.get(record.levelno, 0) + 1
+
+    def __len__(self):
+        return len(self._first) + len(self._last)
+
+    def __iter__(self):
+        if self._head is None:
+            return (record for _, record in
+                    heapq.merge(self._first, self._last))
+        return itertools.chain(self._first, self._last)
+
+
+class RecordSnapshot(object):
+    """
+    What FirePython sends of a ``LogRecord``, taken when it is emitted.
+
+    The message is formatted right away and ``exc_info`` holds the
+    exception type, a bounded copy of the exception and the extracted
+    traceback entries; bounded frame locals are in ``exc_frames``.  No
+    reference to the traceback (and so to its frames) is kept.
+
+    ``exceptions`` counts exceptions of the request by fingerprint.  Once
+    an exception was seen ``EXCEPTION_CAPTURES`` times, only its
+    ``exc_fingerprint`` is kept (``exc_info`` is None) and the message is
+    formatted without the traceback.
+    """
+
+    __slots__ = ('name', 'levelno', 'msg', 'args', 'created', 'pathname',
+                 'lineno', 'exc_text', 'process', 'thread', 'threadName',
+                 'message', 'exc_info', 'exc_frames', 'exc_fingerprint')
+
+    def __init__(self, record, handler, exceptions=None):
+        self.exc_info = None
+        self.exc_frames = None
+        self.exc_fingerprint = None
+        exc_info = record.exc_info
+        if exc_info:
+            exc_type, exc_value, tb = exc_info
+            self.exc_fingerprint = firepython.frames.fingerprint(exc_type, tb)
+            if exceptions is not None:
+                count = exceptions.get(self.exc_fingerprint, 0) + 1
+                exceptions[self.exc_fingerprint] = count
+                if count > CONST.EXCEPTION_CAPTURES:
+                    record = copy.copy(record)
+                    record.exc_info = record.exc_text = None
+                    exc_info = None
+        if exc_info:
+            self.exc_frames = []
+            if tb is not None:
+                self.exc_frames = firepython.frames.capture_locals(tb)
+                tb = firepython.frames.extract_tb(tb)
+            self.exc_info = (exc_type,
+                             firepython.frames.capture_value(exc_value), tb)
+        self.message = handler.format(record)
+        for name in ('name', 'levelno', 'msg', 'args', 'created', 'pathname',
+                     'lineno', 'exc_text', 'process', 'thread', 'threadName'):
+            setattr(self, name, getattr(record, name, None))
+
+
+class _RequestBuffer(object):
+    """ Records and republished headers collected for a single request. """
+
+    __slots__ = ('records', 'republished', 'exceptions', 'active', 'owner',
+                 'started')
+
+    def __init__(self, owner, records):
+        self.records = records
+        self.republished = [] # list of tuples (header_name, header_value)
+        self.exceptions = {} # exception fingerprint -> count of snapshots
+        self.active = True
+        self.owner = owner # weak reference to the thread (or task)
+        self.started = time.time()
+
+    def owner_alive(self):
+        owner = self.owner and self.owner()
+        if owner is None:
+            return False
+        if hasattr(owner, 'is_alive'):
+            return owner.is_alive()
+        if hasattr(owner, 'done'):
+            return not owner.done()
+        return True
+
+
+class _ThreadSlot(object):
+    """ Holds the current request buffer of each thread. """
 
     def __init__(self):
-        Handler.__init__(self)
-        self.records = {} # dictionary (Thread -> list of records)
-        self._enabled = {} # dictionary (Thread -> enabled/disabled)
-        self.republished = {} # dictionary (Thread -> list of tuples (header_name, header_value) )
+        self._local = threading.local()
 
-    def start(self, thread=None):
-        if not thread and threading_supported:
-            thread = threading.currentThread()
-        self._enabled[thread] = True
+    def get(self):
+        return getattr(self._local, 'buffer', None)
 
-    def finish(self, thread=None):
-        if not thread and threading_supported:
-            thread = threading.currentThread()
-        self._enabled.pop(thread, None)
+    def set(self, buffer):
+        self._local.buffer = buffer
 
-    def is_enabled(self, thread=None):
-        if not thread and threading_supported:
-            thread = threading.currentThread()
-        return self._enabled.get(thread, False)
 
-    def emit(self, record):
-        """ Append the record to the buffer for the current thread. """
-        if self.is_enabled():
-            self.get_records().append(record)
+class _GlobalSlot(object):
+    """ Fallback for interpreters built without thread support. """
+
+    buffer = None
+
+    def get(self):
+        return self.buffer
+
+    def set(self, buffer):
+        self.buffer = buffer
+
+
+class _ContextSlot(object):
+    """ Holds the current request buffer of each ``contextvars`` context. """
+
+    def __init__(self):
+        self._var = contextvars.ContextVar('firepython_buffer', default=None)
+
+    def get(self):
+        return self._var.get()
+
+    def set(self, buffer):
+        self._var.set(buffer)
+
+
+def _create_slot():
+    if contextvars is not None:
+        return _ContextSlot()
+    if threading_supported:
+        return _ThreadSlot()
+    return _GlobalSlot()
+
+
+def _current_owner():
+    if threading_supported:
+        return weakref.ref(threading.currentThread())
+    return None
+
+
+class ThreadBufferedHandler(Handler):
+    """
+    A logging handler that buffers records by request.
+
+    Buffers live in request-local storage (a ``contextvars`` variable when
+    available, a thread local otherwise) between ``start()`` and
+    ``discard()``, so they go away with the request or with the thread that
+    owned them.  Buffers whose owner died before calling ``finish()`` are
+    reclaimed by ``reap()``, which also runs periodically from ``start()``.
+
+    When ``logger`` is given, the handler attaches itself to it only while
+    at least one request is active and detaches again after the last
+    ``finish()``, so records logged while no FireLogger request is active
+    never reach the handler at all.
+
+    ``max_records`` caps the number of records buffered per request and
+    ``overflow_policy`` (one of ``OVERFLOW_POLICIES``) decides which ones
+    are dropped; both default to ``MAX_RECORDS`` and ``OVERFLOW_POLICY``
+    from ``firepython._const``.
+
+    With ``snapshot`` (default ``SNAPSHOT_RECORDS``), ``RecordSnapshot``
+    objects are buffered instead of the records, so that tracebacks of
+    logged exceptions are not kept alive until the end of the request.
+    ``encoder``, a function of the record (or snapshot), may turn it into
+    whatever should be buffered instead, e.g. its serialized form.
+
+    Buffers being request-local, records are emitted without taking the
+    handler lock.
+    """
+
+    def __init__(self, logger=None, max_records=None, overflow_policy=None,
+                 snapshot=None, encoder=None):
+        Handler.__init__(self)
+        self._slot = _create_slot()
+        self._logger = logger
+        self._max_records = max_records
+        self._overflow_policy = overflow_policy
+        self._snapshot = snapshot
+        self._encoder = encoder
+        self._active_buffers = set() # buffers between start() and finish()
+        self._active = 0 # len(self._active_buffers), read without locking
+        self._last_reap = time.time()
+        if threading_supported:
+            self._active_lock = threading.Lock()
+        else:
+            self._active_lock = None
+
+    def start(self, owner=None):
+        """
+        Starts buffering for the current request.  ``owner`` is a weak
+        reference to the object whose death means the request is gone, the
+        current thread by default.
+        """
+        if owner is None:
+            owner = _current_owner()
+        if time.time() - self._last_reap > CONST.BUFFER_REAP_INTERVAL:
+            self.reap()
+        buffer = _RequestBuffer(owner, self._new_records())
+        self._acquire_active()
+        try:
+            stale = self._slot.get()
+            if stale is not None:
+                # previous request in this context never discarded its buffer
+                self._deactivate(stale)
+            self._active_buffers.add(buffer)
+            self._set_active()
+        finally:
+            self._release_active()
+        self._slot.set(buffer)
+
+    def finish(self):
+        """ Stops buffering; collected records stay until ``discard()``. """
+        buffer = self._slot.get()
+        if buffer is None or not buffer.active:
+            return
+        self._acquire_active()
+        try:
+            self._deactivate(buffer)
+            self._set_active()
+        finally:
+            self._release_active()
 
-    def get_records(self, thread=None):
+    def discard(self):
+        """ Finishes the current request and drops its buffer. """
+        self.finish()
+        self._slot.set(None)
+
+    def reap(self, max_age=None):
         """
-        Gets the log messages of the specified thread, or the current thread if
-        no thread is specified.
+        Reclaims active buffers whose owner is dead or, when ``max_age`` is
+        given, which were started more than ``max_age`` seconds ago.
+        Returns the number of reclaimed buffers.
         """
-        if not thread and threading_supported:
-            thread = threading.currentThread()
-        if thread not in self.records:
-            self.records[thread] = []
-        return self.records[thread]
+        now = time.time()
+        self._last_reap = now
+        self._acquire_active()
+        try:
+            dead = [buffer for buffer in self._active_buffers
+                    if not buffer.owner_alive() or
+                       (max_age is not None and now - buffer.started > max_age)]
+            for buffer in dead:
+                self._deactivate(buffer)
+                buffer.records = []
+                del buffer.republished[:]
+            self._set_active()
+        finally:
+            self._release_active()
+        return len(dead)
+
+    def _new_records(self):
+        max_records = self._max_records
+        if max_records is None:
+            max_records = CONST.MAX_RECORDS
+        if max_records is None:
+            return []
+        return _BoundedRecords(max_records,
+                               self._overflow_policy or CONST.OVERFLOW_POLICY)
+
+    def _deactivate(self, buffer):
+        buffer.active = False
+        self._active_buffers.discard(buffer)
+
+    def _set_active(self):
+        was_active = self._active
+        self._active = len(self._active_buffers)
+        if self._logger is not None:
+            if self._active and not was_active:
+                self._logger.addHandler(self)
+            elif was_active and not self._active:
+                self._logger.removeHandler(self)
+
+    def _acquire_active(self):
+        if self._active_lock:
+            self._active_lock.acquire()
+
+    def _release_active(self):
+        if self._active_lock:
+            self._active_lock.release()
 
-    def clear_records(self, thread=None):
+    def is_active(self):
+        """ Returns True if any request is between ``start()`` and ``finish()``. """
+        return self._active > 0
+
+    def is_enabled(self):
+        buffer = self._slot.get()
+        return buffer is not None and buffer.active
+
+    def handle(self, record):
+        # idle fast path: skip filters and the handler lock when no request
+        # is being logged (relevant when the handler was attached manually)
+        if not self._active:
+            return 0
+        rv = self.filter(record)
+        if isinstance(rv, logging.LogRecord): # filters may replace records
+            record = rv
+        if rv:
+            self.emit(record)
+        return rv
+
+    def emit(self, record):
+        """ Append the record to the buffer of the current request. """
+        if self._active:
+            buffer = self._slot.get()
+            if buffer is not None and buffer.active:
+                snapshot = self._snapshot
+                if snapshot is None:
+                    snapshot = CONST.SNAPSHOT_RECORDS
+                if snapshot:
+                    record = RecordSnapshot(record, self, buffer.exceptions)
+                if self._encoder is not None:
+                    record = self._encoder(record)
+                buffer.records.append(record)
+
+    def get_records(self):
+        """ Gets the log records of the current request. """
+        buffer = self._slot.get()
+        if buffer is None:
+            return []
+        return buffer.records
+
+    def clear_records(self):
+        """ Clears the log records of the current request. """
+        buffer = self._slot.get()
+        if buffer is not None:
+            buffer.records = self._new_records()
+
+    def get_dropped(self):
         """
-        Clears the log messages of the specified thread, or the current thread
-        if no thread is specified.
+        Gets the number of records of the current request dropped because of
+        ``max_records``, as a dictionary (level number -> count).
         """
-        if not thread and threading_supported:
-            thread = threading.currentThread()
-        if thread in self.records:
-            del self.records[thread]
+        buffer = self._slot.get()
+        if buffer is None:
+            return {}
+        return getattr(buffer.records, 'dropped', {})
 
     def republish(self, headers):
-        """ Appends republished firepython headers for the current thread. """
-        if self.is_enabled():
-            self.get_republished().extend(headers)
-
-    def get_republished(self, thread=None):
-        if not thread and threading_supported:
-            thread = threading.currentThread()
-        if thread not in self.republished:
-            self.republished[thread] = []
-        return self.republished[thread]
-
-    def clear_republished(self, thread=None):
-        if not thread and threading_supported:
-            thread = threading.currentThread()
-        if thread in self.republished:
-            del self.republished[thread]
+        """ Appends republished firepython headers for the current request. """
+        buffer = self._slot.get()
+        if buffer is not None and buffer.active:
+            buffer.republished.extend(headers)
+
+    def get_republished(self):
+        buffer = self._slot.get()
+        if buffer is None:
+            return []
+        return buffer.republished
+
+    def clear_republished(self):
+        buffer = self._slot.get()
+        if buffer is not None:
+            buffer.republished = []
@@ -0,0 +1,144 @@
+# -*- mode: python; coding: utf-8 -*-
+"""
+Per-request logging level overrides.
+
+A request may ask to see records below the configured logger levels (see
+``FIRELOGGER_LEVEL_HEADER``).  Rather than lowering logger levels for the
+whole process, the override is kept in request-local storage and
+``logging.Logger.isEnabledFor`` is wrapped to consult it.  The wrapper is
+installed only while at least one override is active, so other requests
+keep the stock (cached) level check.
+
+Records let through by an override alone reach only the handlers given
+with it (FirePython's), not e.g. the log files of the server:
+``logging.Logger.callHandlers`` is wrapped the same way.
+"""
+
+import logging
+
+from firepython.handlers import _create_slot, threading_supported
+
+if threading_supported:
+    import threading
+
+__all__ = [
+    'parse_level_spec',
+    'set_override',
+    'clear_override',
+    'get_override',
+]
+
+
+_slot = _create_slot()
+_active = 0 # number of contexts with an override set
+_original_is_enabled_for = logging.Logger.__dict__['isEnabledFor']
+_original_call_handlers = logging.Logger.__dict__['callHandlers']
+if threading_supported:
+    _lock = threading.Lock()
+else:
+    _lock = None
+
+
+def parse_level_spec(value):
+    """
+    Parses ``level[:prefix,prefix...]`` into a tuple (level number, tuple
+    of logger name prefixes).  Level is a level name (case insensitive) or
+    a number; no prefixes mean all loggers.  Raises ValueError for unknown
+    levels.
+    """
+    level, _, prefixes = value.strip().partition(':')
+    level = level.strip()
+    if level.isdigit():
+        levelno = int(level)
+    else:
+        levelno = logging.getLevelName(level.upper())
+        if not isinstance(levelno, int):
+            raise ValueError('unknown logging level %r' % level)
+    prefixes = tuple(p.strip() for p in prefixes.split(',') if p.strip())
+    return levelno, prefixes
+
+
+def _matches(name, prefixes):
+    if not prefixes:
+        return True
+    for prefix in prefixes:
+        if name == prefix or name.startswith(prefix + '.'):
+            return True
+    return False
+
+
+def _is_enabled_for(self, level):
+    override = _slot.get()
+    if (override is not None and level >= override[0] and
+        self.manager.disable < level and _matches(self.name, override[1])):
+        return True
+    return _original_is_enabled_for(self, level)
+
+
+def _call_handlers(self, record):
+    override = _slot.get()
+    if (override is None or override[2] is None or
+        _original_is_enabled_for(self, record.levelno)):
+        return _original_call_handlers(self, record)
+    # let through by the override alone, for its handlers only
+    logger = self
+    while logger is not None:
+        for handler in logger.handlers:
+            if handler in override[2] and record.levelno >= handler.level:
+                handler.handle(record)
+        logger = logger.propagate and logger.parent or None
+
+
+def set_override(levelno, prefixes=(), handlers=None):
+    """
+    Lets loggers matching ``prefixes`` accept records of ``levelno`` and
+    above in the current request.  With ``handlers`` given, the records
+    accepted only thanks to the override reach none of the other handlers.
+    """
+    global _active
+    _acquire()
+    try:
+        if _slot.get() is None:
+            _active += 1
+            if _active == 1:
+                logging.Logger.isEnabledFor = _is_enabled_for
+                logging.Logger.callHandlers = _call_handlers
+        if handlers is not None:
+            handlers = tuple(handlers)
+        _slot.set((levelno, tuple(prefixes), handlers))
+    finally:
+        _release()
+
+
+def clear_override():
+    """ Removes the override of the current request, if any. """
+    global _active
+    if _slot.get() is None:
+        return
+    _acquire()
+    try:
+        _slot.set(None)
+        _active -= 1
+        if _active == 0:
+            logging.Logger.isEnabledFor = _original_is_enabled_for
+            logging.Logger.callHandlers = _original_call_handlers
+    finally:
+        _release()
+
+
+def get_override():
+    """
+    Returns the (level number, prefixes, handlers) override of the current
+    request.
+    """
+    return _slot.get()
+
+
+def _acquire():
+    if _lock:
+        _lock.acquire()
+
+
+def _release():
+    if _lock:
+        _lock.release()
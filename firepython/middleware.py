@@ -2,51 +2,103 @@
 
 import os
 import sys
+import copy
 import time
+import base64
 import random
 import logging
-import traceback
+import operator
 
 try:
     from cStringIO import StringIO
 except ImportError:
-    from StringIO import StringIO
+    try:
+        from StringIO import StringIO
+    except ImportError:
+        from io import StringIO
 
-import jsonpickle
+try:
+    unicode
+except NameError: # Python 3
+    unicode = str
+    long = int
+
+try:
+    from urllib.parse import parse_qs
+except ImportError: # Python 2
+    from urlparse import parse_qs
 
 try:
     import gprof2dot
-except ImportError:
+except (ImportError, SyntaxError): # the bundled copy is Python 2 only
     gprof2dot = None
 
 import firepython
 import firepython.utils
+import firepython.frames
+import firepython.compact
+import firepython.levels
+import firepython.store
+import firepython.profiling
+import firepython.serializers
 import firepython._const as CONST
-from firepython.handlers import ThreadBufferedHandler
+from firepython.handlers import ThreadBufferedHandler, RecordSnapshot
 
 __all__ = [
     'FirePythonBase',
+    'FirePythonRequest',
     'FirePythonDjango',
     'FirePythonWSGI',
     'paste_filter_factory',
 ]
 
+# log entry keys dropped when a flush runs out of time
+_DETAIL_KEYS = ('args', 'args_samples', 'exc_frames')
+
+
+class FirePythonRequest(object):
+    """
+    State of a single request as seen by the middleware: results of
+    ``FirePythonBase._check`` and the profiler, if any.  Kept off the
+    middleware instance, which is shared by all concurrent requests.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.client_message = ''
+        self.profile_enabled = False
+        self.profile_mode = '' # see firepython.profiling.PROFILERS
+        self.appstats_enabled = False
+        self.level_override = None
+        self.encoding = None # payload compression agreed with the client
+        self.compact = False # compact payload layout, see firepython.compact
+        self.profiler = None
+        self.extension_data = {}
 
-# add a new backed jsonpickle for Django
-# jsonpickle will attempt to import this if default
-# jsonpickle libraries are not present
-jsonpickle.load_backend('django.utils.simplejson', 'dumps',
-                        'loads', ValueError)
 
 class FirePythonBase(object):
 
+    _serializer = firepython.serializers.JsonpickleSerializer()
+    _payload_path = None # see ``_serve_payload``
+    _store = None
+    _incremental = False # see ``_encode_record``
+    _auth_token = None # (password, expected auth token)
+    _profile_path = None # see ``_serve_profile``
+    _sampler = None # firepython.profiling.ContinuousSampler of all requests
+
     def __init__(self):
         raise NotImplementedError("Must be subclassed")
 
     def install_handler(self):
+        # the handler attaches itself to the logger only while a FireLogger
+        # request is running, see ``ThreadBufferedHandler``
         logger = logging.getLogger(self._logger_name)
-        self._handler = ThreadBufferedHandler()
-        logger.addHandler(self._handler)
+        self._incremental = CONST.INCREMENTAL_ENCODING
+        if self._incremental:
+            self._handler = ThreadBufferedHandler(logger, snapshot=True,
+                                                  encoder=self._encode_record)
+        else:
+            self._handler = ThreadBufferedHandler(logger)
 
     def uninstall_handler(self):
         if self._handler is None:
@@ -55,13 +107,14 @@ class FirePythonBase(object):
         logger.removeHandler(self._handler)
         self._handler = None
 
-    def _version_check(self, version_header):
-        firelogger_api_version = version_header.strip()
+    def _version_check(self, request, version_header):
+        firelogger_api_version = \
+            firepython.utils.parse_version_header(version_header)[0]
         if firelogger_api_version == '':
             logging.info('FireLogger not detected')
             return False
         if firepython.__api_version__ != firelogger_api_version:
-            self._client_message += (
+            request.client_message += (
                 'Warning: FireLogger (client) has version %s, but '
                 'FirePython (server) is version %s. Check http://firelogger.binaryage.com for latest version.' % (firelogger_api_version,
                                                  firepython.__api_version__)
@@ -71,16 +124,21 @@ class FirePythonBase(object):
                             firepython.__api_version__)
         return True
 
-    def _password_check(self, token):
+    def _password_check(self, request, token):
         if self._password is None:
             raise Exception("self._password must be set!")
-        if not firepython.utils.get_auth_token(self._password) == token:
-            self._client_message += 'FireLogger password does not match. '
+        if self._auth_token is None or self._auth_token[0] != self._password:
+            # computed once per password
+            self._auth_token = (self._password,
+                                firepython.utils.get_auth_token(self._password))
+        if not firepython.utils.constant_time_compare(self._auth_token[1],
+                                                      token):
+            request.client_message += 'FireLogger password does not match. '
             logging.warning('FireLogger password does not match. Logging output won\'t be sent to FireLogger. Double check your settings!')
             return False
         return True
 
-    def _appengine_check(self):
+    def _appengine_check(self, request):
         if 'google.appengine' not in sys.modules:
             return True  # Definitely not running under Google App Engine
         try:
@@ -91,28 +149,54 @@ class FirePythonBase(object):
             return True  # Running in SDK dev_appserver
         # Running in production, only allow admin users
         if not users.is_current_user_admin():
-            self._client_message += 'Security: Log in as a project administrator to see FirePython logs (App Engine in production mode). '
+            request.client_message += 'Security: Log in as a project administrator to see FirePython logs (App Engine in production mode). '
             logging.warning('Security: Log in as a project administrator to see FirePython logs (App Engine in production mode)')
             return False
         return True
 
     def _check(self, env):
-        self._client_message = ''
-        self._profile_enabled = \
-            env.get(CONST.FIRELOGGER_PROFILER_ENABLED_HEADER, '') != ''
-        self._appstats_enabled = \
+        """
+        Checks whether FireLogger output should be sent for the request
+        with WSGI-style environment ``env``.  Returns a new
+        ``FirePythonRequest``; its ``enabled`` attribute holds the result.
+        """
+        request = FirePythonRequest()
+        version_header = env.get(CONST.FIRELOGGER_VERSION_HEADER)
+        if self._check_agent and not version_header:
+            return request # the fast path for requests without FireLogger
+        request.profile_mode = \
+            env.get(CONST.FIRELOGGER_PROFILER_ENABLED_HEADER, '')
+        request.profile_enabled = request.profile_mode != ''
+        request.appstats_enabled = \
             env.get(CONST.FIRELOGGER_APPSTATS_ENABLED_HEADER, '') != ''
         if self._check_agent and not self._version_check(
-            env.get(CONST.FIRELOGGER_VERSION_HEADER, '')):
-            return False
+            request, version_header):
+            return request
         if ((self._password and not
               self._password_check(
-                env.get(CONST.FIRELOGGER_AUTH_HEADER, '')))):
-            return False
+                request, env.get(CONST.FIRELOGGER_AUTH_HEADER, '')))):
+            return request
         # If _password is set, skip _appengine_check()
-        if (not self._password and not self._appengine_check()):
-            return False
-        return True
+        if (not self._password and not self._appengine_check(request)):
+            return request
+        request.level_override = self._level_check(
+            request, env.get(CONST.FIRELOGGER_LEVEL_HEADER, ''))
+        request.encoding = firepython.utils.negotiate_encoding(
+            env.get(CONST.FIRELOGGER_ENCODING_HEADER, ''))
+        request.compact = 'compact' in firepython.utils.parse_version_header(
+            version_header or '')[1]
+        request.enabled = True
+        return request
+
+    def _level_check(self, request, level_header):
+        if not level_header.strip():
+            return None
+        try:
+            return firepython.levels.parse_level_spec(level_header)
+        except ValueError as e:
+            request.client_message += 'Ignoring FireLogger level: %s. ' % e
+            logging.warning('Ignoring FireLogger level: %s', e)
+            return None
 
     def _sanitize_exc_info(self, exc_info):
         if exc_info == None:
@@ -121,7 +205,7 @@ class FirePythonBase(object):
         exc_value = exc_info[1]
         exc_traceback = exc_info[2]
         if exc_traceback is not None:
-            exc_traceback = traceback.extract_tb(exc_traceback)
+            exc_traceback = firepython.frames.extract_tb(exc_traceback)
         return (exc_type, exc_value, exc_traceback)
 
     def _handle_internal_exception(self, e):
@@ -132,122 +216,530 @@ class FirePythonBase(object):
         return {"message": "Internal FirePython error: %s" % unicode(e),
                 "exc_info": exc_info}
 
-    def _encode(self, logs, errors=None, profile=None, extension_data=None):
-        data = {"logs": logs}
+    def _encode(self, logs, errors=None, profile=None, extension_data=None,
+                dropped=None, encoding=None, compact=False):
+        data = self._payload_data(logs, errors, profile, extension_data,
+                                  dropped, compact)
+        return self._pack(self._serialize(data), encoding)
+
+    def _payload_data(self, logs, errors=None, profile=None,
+                      extension_data=None, dropped=None, compact=False):
+        if compact:
+            data = {"format": "compact",
+                    "logs": firepython.compact.compact_logs(logs)}
+        else:
+            data = {"logs": logs}
         if errors:
             data['errors'] = errors
+        if dropped:
+            data['dropped'] = dropped
         if profile:
             data['profile'] = profile
         if extension_data:
             data['extension_data'] = extension_data
+        return data
+
+    def _serialize(self, data):
+        serializer = self._serializer
         try:
-            data = jsonpickle.encode(data, unpicklable=False,
-                                     max_depth=CONST.JSONPICKLE_DEPTH)
-        except Exception, e:
+            data = serializer.encode(data)
+        except Exception as e:
             # this exception may be fired, because of buggy __repr__ or
             # __str__ implementations on various objects
             errors = [self._handle_internal_exception(e)]
             try:
-                data = jsonpickle.encode({"errors": errors },
-                                         unpicklable=False,
-                                         max_depth=CONST.JSONPICKLE_DEPTH)
-            except Exception, e:
+                data = serializer.encode({"errors": errors })
+            except Exception as e:
                 # even unable to serialize error message
-                data = jsonpickle.encode(
+                data = serializer.encode(
                         {"errors": {
                             "message": "FirePython has a really bad day :-("
                         }
-                    },
-                    unpicklable=False,
-                    max_depth=CONST.JSONPICKLE_DEPTH
+                    }
                 )
+        return data
+
+    def _pack(self, data, encoding=None):
+        """
+        Compresses serialized payload ``data`` with ``encoding`` (see
+        ``firepython.utils.COMPRESSORS``, None for no compression), encodes
+        it in base64 and splits it into ``HEADER_CHUNK_SIZE`` long chunks.
+        """
         data = data.encode('utf-8')
-        data = data.encode('base64')
-        return data.splitlines()
+        if encoding:
+            data = firepython.utils.COMPRESSORS[encoding](data)
+        data = base64.b64encode(data)
+        if not isinstance(data, str):
+            data = data.decode('ascii') # Python 3
+        size = CONST.HEADER_CHUNK_SIZE
+        return [data[i:i + size] for i in range(0, len(data), size)]
 
     def republish(self, headers):
         firelogger_headers = []
-        for key, value in headers.iteritems():
+        for key, value in headers.items():
             if CONST.FIRELOGGER_RESPONSE_HEADER.match(key):
                 firelogger_headers.append((key, value))
 
         self._handler.republish(firelogger_headers)
 
-    def _flush_records(self, add_header, profile=None, extension_data=None):
+    def _flush_records(self, request, add_header, profile=None):
         """
-        Flush collected logs into response.
+        Flush collected logs of ``request`` into response.
 
         Argument ``add_header`` should be a function receiving two arguments:
         ``name`` and ``value`` of header.
         """
 
         records = self._handler.get_records()
-        self._handler.clear_records()
         republished = self._handler.get_republished()
-        self._handler.clear_republished()
+        dropped = self._handler.get_dropped()
+        self._handler.discard()
 
         for name, value in republished:
             add_header(name, value)
 
+        if self._incremental:
+            self._flush_encoded(request, add_header, records, dropped,
+                                profile)
+            return
+
+        logs, errors, dropped_by_level = self._prepare_logs(
+            records, dropped, self._deadline())
+
+        if self._store is not None:
+            # serialized only if the client fetches it, see _serve_payload
+            data = self._payload_data(logs, errors, profile,
+                                      request.extension_data,
+                                      dropped_by_level, request.compact)
+            add_header(CONST.FIRELOGGER_TOKEN_RESPONSE_HEADER,
+                       self._store.put(lambda: self._serialize(data)))
+            return
+
+        guid = "%08x" % random.randint(0, 0xFFFFFFFF)
+        chunks = self._encode_within_budget(guid, logs, errors, profile,
+                                            request.extension_data,
+                                            dropped_by_level, request.encoding,
+                                            request.compact)
+        if not chunks:
+            add_header(CONST.FIRELOGGER_MESSAGE_HEADER,
+                       'FirePython log dropped, it does not fit into %d '
+                       'bytes. ' % CONST.MAX_PAYLOAD_SIZE)
+            return
+        self._add_payload_headers(add_header, guid, chunks, request.encoding)
+
+    def _deadline(self):
+        if CONST.FLUSH_DEADLINE is None:
+            return None
+        return time.time() + CONST.FLUSH_DEADLINE
+
+    def _add_payload_headers(self, add_header, guid, chunks, encoding):
+        if encoding:
+            add_header(CONST.FIRELOGGER_ENCODING_RESPONSE_HEADER %
+                       dict(guid=guid), encoding)
+        for i, chunk in enumerate(chunks):
+            add_header(CONST.FIRELOGGER_HEADER_FORMAT %
+                       dict(guid=guid, identity=i), chunk)
+
+    def _encode_record(self, record):
+        """
+        Prepares and serializes ``record`` (a ``RecordSnapshot``) when it is
+        emitted, in ``INCREMENTAL_ENCODING`` mode.  Flushing then only
+        joins the serialized entries, at the price of the stages that need
+        all records: aggregation, the compact layout, ``exc_count`` and
+        trimming of frame locals and arguments.
+        """
+        encoded = _EncodedRecord(record.levelno)
+        try:
+            data = self._prepare_log_record(record, record.exc_info is not None)
+            if record.exc_fingerprint is not None:
+                data['exc_fingerprint'] = record.exc_fingerprint
+            encoded.entry = self._serializer.encode(data)
+        except Exception as e:
+            # this exception may be fired, because of buggy __repr__ or
+            # __str__ implementations on various objects
+            encoded.error = self._handle_internal_exception(e)
+        return encoded
+
+    def _flush_encoded(self, request, add_header, records, dropped, profile):
+        """ ``_flush_records`` for records encoded by ``_encode_record``. """
+        entries = []
+        errors = []
+        for record in records:
+            if record.error is None:
+                entries.append((record.levelno, record.entry))
+            else:
+                errors.append(record.error)
+        dropped_by_level = self._prepare_logs([], dropped)[2]
+        extension_data = request.extension_data
+
+        if self._store is not None:
+            def render():
+                return self._join_entries([entry for _, entry in entries],
+                                          errors, profile, extension_data,
+                                          dropped_by_level)
+            add_header(CONST.FIRELOGGER_TOKEN_RESPONSE_HEADER,
+                       self._store.put(render))
+            return
+
+        budget = CONST.MAX_PAYLOAD_SIZE
+        guid = "%08x" % random.randint(0, 0xFFFFFFFF)
+        def pack(summary=None):
+            return self._pack(self._join_entries(
+                [entry for _, entry in entries] + (summary and [summary] or []),
+                errors, profile, extension_data, dropped_by_level),
+                request.encoding)
+        def fits(chunks):
+            return budget is None or \
+                self._payload_size(guid, chunks, request.encoding) <= budget
+
+        # shed in the order of _encode_within_budget: debug and info
+        # records, the profile, more severe records, errors and extension
+        # data (None stands for the profile, 'rest' for the last)
+        levels = sorted(set(l for l, _ in entries))
+        steps = [l for l in levels if l < logging.WARNING] + [None] + \
+                [l for l in levels if l >= logging.WARNING] + ['rest']
+        trimmed = []
+        chunks = pack()
+        for step in steps:
+            if fits(chunks):
+                break
+            if step is None:
+                if not profile:
+                    continue
+                profile = None
+                trimmed.append('the profile')
+            elif step == 'rest':
+                errors = extension_data = dropped_by_level = None
+                trimmed.append('internal errors and extension data')
+            else:
+                count = len([l for l, _ in entries if l == step])
+                entries = [(l, e) for l, e in entries if l != step]
+                trimmed.append('%d %s records' % (count, self._log_level(step)))
+            chunks = pack(self._serializer.encode(self._prepare_log_record(
+                logging.LogRecord(
+                    'firepython', logging.WARNING, __file__, 0,
+                    'FirePython log trimmed to %d bytes, removed %s',
+                    (budget, ', '.join(trimmed)), None))))
+        if not fits(chunks):
+            add_header(CONST.FIRELOGGER_MESSAGE_HEADER,
+                       'FirePython log dropped, it does not fit into %d '
+                       'bytes. ' % budget)
+            return
+        self._add_payload_headers(add_header, guid, chunks, request.encoding)
+
+    def _join_entries(self, entries, errors, profile, extension_data,
+                      dropped):
+        """
+        Returns the serialized payload with log entries serialized already
+        (``entries``, a list of JSON strings).
+        """
+        data = self._payload_data([], errors, profile, extension_data,
+                                  dropped)
+        del data['logs']
+        logs = '[' + ', '.join(entries) + ']'
+        if not data:
+            return '{"logs": %s}' % logs
+        # splice the logs into the serialized JSON object of the rest
+        rest = self._serialize(data).lstrip()[1:]
+        return '{"logs": %s, %s' % (logs, rest)
+
+    def _prepare_logs(self, records, dropped, deadline=None):
+        """
+        Returns log entries and internal errors for ``records`` and the
+        number of ``dropped`` records by level name.
+
+        When ``deadline`` (a ``time.time()`` value) is given, records still
+        waiting halfway through ``FLUSH_DEADLINE`` get plain entries, those
+        left at the deadline are not sent at all, arguments and frame
+        locals are dropped from all entries and a warning entry tells what
+        happened.  Otherwise the entries keep arguments and frame locals
+        only as long as encoding them fits in the time left, see
+        ``_budget_details``.
+        """
         logs = []
         errors = []
+        exceptions = {} # fingerprint -> [first full log entry, count]
+        groups = {} # id of the first record of a group -> group
+        prepare = _LogPreparer(self).prepare
+        if CONST.AGGREGATE_THRESHOLD:
+            groups = self._group_records(records)
+        if deadline is not None:
+            halfway = deadline - CONST.FLUSH_DEADLINE / 2.0
+        plain = left_out = 0
         for record in records:
             try:
-                logs.append(self._prepare_log_record(record))
-            except Exception, e:
+                group = groups.get(id(record))
+                if group is not None and group[0] is not record:
+                    continue # folded into the entry of the group
+                if deadline is not None:
+                    now = time.time()
+                    if now >= deadline:
+                        left_out += 1
+                        continue
+                    if now >= halfway:
+                        plain += 1
+                        logs.append(prepare(record, plain=True))
+                        continue
+                if group is not None:
+                    logs.append(self._prepare_aggregate(group, prepare))
+                    continue
+                fingerprint = self._exc_fingerprint(record)
+                if fingerprint is None:
+                    logs.append(prepare(record))
+                    continue
+                seen = exceptions.get(fingerprint)
+                if seen is None:
+                    seen = exceptions[fingerprint] = [None, 0]
+                seen[1] += 1
+                data = prepare(record, seen[1] <= CONST.EXCEPTION_CAPTURES)
+                data['exc_fingerprint'] = fingerprint
+                if seen[0] is None and 'exc_info' in data:
+                    seen[0] = data
+                logs.append(data)
+            except Exception as e:
                 # this exception may be fired, because of buggy __repr__ or
                 # __str__ implementations on various objects
                 errors.append(self._handle_internal_exception(e))
 
-        chunks = self._encode(logs, errors, profile, extension_data)
-        guid = "%08x" % random.randint(0, 0xFFFFFFFF)
-        for i, chunk in enumerate(chunks):
-            add_header(CONST.FIRELOGGER_HEADER_FORMAT %
-                       dict(guid=guid, identity=i), chunk)
-
-    def _prepare_log_record(self, record):
-        data = {
-            "level": self._log_level(record.levelno),
-            "message": self._handler.format(record),
-            "template": record.msg,
-            "timestamp": long(record.created * 1000 * 1000),
-            "time": (time.strftime("%H:%M:%S",
-                     time.localtime(record.created)) +
-                (".%03d" % ((record.created - long(record.created)) * 1000))
-            )
-        }
-        props = ["args", "pathname", "lineno", "exc_text", "name", "process",
-                 "thread", "threadName"]
-        for p in props:
+        # repeated exceptions are sent in full only EXCEPTION_CAPTURES
+        # times, the first full entry counts them all
+        for first, count in exceptions.values():
+            if first is not None and count > 1:
+                first['exc_count'] = count
+
+        if plain or left_out:
+            # keep encoding cheap too
+            for log in logs:
+                for key in _DETAIL_KEYS:
+                    log.pop(key, None)
+        elif deadline is not None:
+            plain = self._budget_details(logs, deadline)
+        if plain or left_out:
+            logs.append(prepare(logging.LogRecord(
+                'firepython', logging.WARNING, __file__, 0,
+                'FirePython hit its flush deadline of %.3f s: %d records '
+                'sent without detail, %d records left out',
+                (CONST.FLUSH_DEADLINE, plain, left_out), None)))
+
+        # number of records dropped by the handler's record cap, by level
+        dropped_by_level = {}
+        for levelno, count in dropped.items():
+            level = self._log_level(levelno)
+            dropped_by_level[level] = dropped_by_level.get(level, 0) + count
+        return logs, errors, dropped_by_level
+
+    def _budget_details(self, logs, deadline):
+        """
+        Encodes the arguments and frame locals of ``logs`` entry by entry to
+        learn what encoding them costs and drops them from the entries they
+        can no longer be encoded for again before ``deadline``, i.e. when
+        the payload is encoded.  Returns the number of entries stripped.
+        """
+        spent = 0.0 # encoding time of the details kept so far
+        stripped = 0
+        for log in logs:
+            keys = [key for key in _DETAIL_KEYS if key in log]
+            if not keys:
+                continue
+            if not stripped:
+                started = time.time()
+                try:
+                    self._serializer.encode(dict((key, log[key])
+                                                 for key in keys))
+                except Exception:
+                    pass # reported when the payload is encoded
+                now = time.time()
+                if now + spent + (now - started) < deadline:
+                    spent += now - started
+                    continue
+            stripped += 1
+            for key in keys:
+                del log[key]
+        return stripped
+
+    def _group_records(self, records):
+        """
+        Groups records without exception by template, logger and level.
+        Returns a dictionary mapping ids of the records of groups with at
+        least ``AGGREGATE_THRESHOLD`` records to their group (a list).
+        """
+        groups = {}
+        for record in records:
+            if self._exc_fingerprint(record) is not None:
+                continue
             try:
-                data[p] = getattr(record, p)
-            except AttributeError:
+                key = (record.msg, record.name, record.levelno)
+                groups.setdefault(key, []).append(record)
+            except TypeError: # unhashable msg
                 pass
-
-        try:
-            exc_info = getattr(record, 'exc_info')
-            if exc_info is not None:
-                data['exc_info'] = self._sanitize_exc_info(exc_info)
-
-                frames = []
-                t = exc_info[2]
-                while t:
-                    try:
-                        d = {}
-                        for k,v in t.tb_frame.f_locals.iteritems():
-                            if CONST.DEEP_LOCALS:
-                                d[unicode(k)] = v
-                            else:
-                                d[unicode(k)] = repr(v)
-                        frames.append(d)
-                    except:
-                        frames.append('?')
-                    t = t.tb_next
-                data['exc_frames'] = frames
-        except AttributeError:
-            pass
+        grouped = {}
+        for group in groups.values():
+            if len(group) >= CONST.AGGREGATE_THRESHOLD:
+                for record in group:
+                    grouped[id(record)] = group
+        return grouped
+
+    def _prepare_aggregate(self, group, prepare):
+        """
+        Returns one log entry for a ``group`` of records: the entry of the
+        first record with ``count``, ``last_timestamp`` and arguments of the
+        first ``AGGREGATE_SAMPLES`` records in ``args_samples``.
+        """
+        data = prepare(group[0])
+        data['message'] += ' (%d times)' % len(group)
+        data['count'] = len(group)
+        data['last_timestamp'] = long(group[-1].created * 1000 * 1000)
+        data['args_samples'] = [record.args for record in
+                                group[:CONST.AGGREGATE_SAMPLES]]
         return data
 
+    def _serve_payload(self, env, token):
+        """
+        Answers a client fetching the payload stored under ``token`` with
+        the same checks as a logged request.  Returns a tuple (status,
+        headers, body).
+        """
+        request, headers = self._serve_check(env)
+        if not request.enabled:
+            return '403 Forbidden', headers, b''
+        render = self._store.pop(token)
+        if render is None:
+            return '404 Not Found', headers, b''
+        headers.append(('Content-Type', 'application/json; charset=utf-8'))
+        return '200 OK', headers, render().encode('utf-8')
+
+    def _serve_profile(self, env):
+        """
+        Answers a client fetching the aggregates of the continuous sampler
+        with the same checks as a logged request.  Query parameters are
+        ``route`` (all routes by default) and ``format``: ``dot`` (JSON, the
+        profile as sent with logs), ``collapsed`` (text, for flame graph
+        tools) or ``routes`` (JSON, the routes and their sample counts).
+        Returns a tuple (status, headers, body).
+        """
+        request, headers = self._serve_check(env)
+        if not request.enabled:
+            return '403 Forbidden', headers, b''
+        query = parse_qs(env.get('QUERY_STRING', ''))
+        route = query.get('route', [None])[0]
+        format = query.get('format', ['dot'])[0]
+        content_type = 'application/json; charset=utf-8'
+        if format == 'collapsed':
+            body = self._sampler.collapsed(route)
+            content_type = 'text/plain; charset=utf-8'
+        elif format == 'routes':
+            body = self._serialize(self._sampler.routes())
+        elif format != 'dot':
+            return '400 Bad Request', headers, b''
+        elif not gprof2dot:
+            return '501 Not Implemented', headers, b''
+        else:
+            body = self._serialize(self._render_profile(
+                self._sampler.profile(route), self._sampler.info(route)))
+        headers.append(('Content-Type', content_type))
+        return '200 OK', headers, body.encode('utf-8')
+
+    def _serve_check(self, env):
+        request = self._check(env)
+        headers = [('Cache-Control', 'no-store')]
+        if request.client_message:
+            headers.append((CONST.FIRELOGGER_MESSAGE_HEADER,
+                            request.client_message))
+        return request, headers
+
+    def _encode_within_budget(self, guid, logs, errors, profile,
+                              extension_data, dropped, encoding,
+                              compact=False):
+        """
+        Encodes the payload like ``_encode``, shedding detail until the
+        FireLogger headers fit into ``MAX_PAYLOAD_SIZE`` bytes: frame locals
+        go first, then record arguments, debug and info records, the
+        profile and finally warning and more severe records.  A warning
+        record describing what was removed is appended to the trimmed log.
+        When internal errors and extension data are over the budget on their
+        own, the payload is that record alone, and no payload at all (an
+        empty list) if even that does not fit.
+        """
+        budget = CONST.MAX_PAYLOAD_SIZE
+        chunks = self._encode(logs, errors, profile, extension_data, dropped,
+                              encoding, compact)
+        if budget is None or \
+           self._payload_size(guid, chunks, encoding) <= budget:
+            return chunks
+
+        trimmed = []
+        def fits(logs, profile, removed, errors=errors,
+                 extension_data=extension_data, dropped=dropped):
+            summary = self._prepare_log_record(logging.LogRecord(
+                'firepython', logging.WARNING, __file__, 0,
+                'FirePython log trimmed to %d bytes, removed %s',
+                (budget, ', '.join(trimmed + [removed])), None))
+            chunks[:] = self._encode(logs + [summary], errors, profile,
+                                     extension_data, dropped, encoding,
+                                     compact)
+            return self._payload_size(guid, chunks, encoding) <= budget
+
+        for keys, what in ((('exc_frames',), 'frame locals'),
+                           (('args', 'args_samples'), 'arguments')):
+            count = len([log for log in logs if keys[0] in log])
+            if not count:
+                continue
+            logs = [dict((k, v) for k, v in log.items() if k not in keys)
+                    for log in logs]
+            removed = '%s of %d records' % (what, count)
+            if fits(logs, profile, removed):
+                return chunks
+            trimmed.append(removed)
+
+        for level in ('debug', 'info', None, 'warning', 'error', 'critical'):
+            if level is None: # the profile, usually the largest item
+                if not profile:
+                    continue
+                profile = None
+                removed = 'the profile'
+            else:
+                count = len([log for log in logs if log['level'] == level])
+                if not count:
+                    continue
+                logs = [log for log in logs if log['level'] != level]
+                removed = '%d %s records' % (count, level)
+            if fits(logs, profile, removed):
+                return chunks
+            trimmed.append(removed)
+
+        # internal errors or extension data are too large themselves
+        if fits([], None, 'internal errors and extension data', None, None,
+                None):
+            return chunks
+        return []
+
+    def _payload_size(self, guid, chunks, encoding=None):
+        """ Returns bytes taken by the FireLogger headers carrying ``chunks``. """
+        size = 0
+        if encoding:
+            name = CONST.FIRELOGGER_ENCODING_RESPONSE_HEADER % dict(guid=guid)
+            size += len(name) + len(encoding) + 4 # ': ' and CRLF
+        for i, chunk in enumerate(chunks):
+            name = CONST.FIRELOGGER_HEADER_FORMAT % dict(guid=guid, identity=i)
+            size += len(name) + len(chunk) + 4
+        return size
+
+    def _exc_fingerprint(self, record):
+        if isinstance(record, RecordSnapshot):
+            return record.exc_fingerprint
+        exc_info = getattr(record, 'exc_info', None)
+        if not exc_info:
+            return None
+        return firepython.frames.fingerprint(exc_info[0], exc_info[2])
+
+    def _prepare_log_record(self, record, capture_exc=True):
+        """
+        Returns the log entry of ``record``.  Without ``capture_exc`` the
+        exception of the record, if any, is left out.  Use a
+        ``_LogPreparer`` to prepare many records.
+        """
+        return _LogPreparer(self).prepare(record, capture_exc)
+
     def _log_level(self, level):
         if level >= logging.CRITICAL:
             return "critical"
@@ -260,55 +752,88 @@ class FirePythonBase(object):
         else:
             return "debug"
 
-    def _start(self):
-        self._handler.start()
+    def _start(self, request, owner=None):
+        self._handler.start(owner)
+        if request.level_override:
+            firepython.levels.set_override(*request.level_override,
+                                           handlers=(self._handler,))
 
     def _finish(self):
         self._handler.finish()
 
-    def _profile_wrap(self, func):
+    def _discard(self):
+        firepython.levels.clear_override()
+        self._handler.discard()
+
+    def _profile_wrap(self, request, func):
         '''If the FIRELOGGER_RESPONSE_HEADER header has been passed with a
         request, given function will be wrapped with a profile.
         '''
-        if not self._profile_enabled:
+        if not request.profile_enabled:
             return func
-        try:
-            import cProfile as profile
-        except ImportError:
-            import profile
-        self._prof = profile.Profile()
+        request.profiler = \
+            firepython.profiling.create_profiler(request.profile_mode)
         def prof_wrapper(*args, **kwargs):
-            return self._prof.runcall(func, *args, **kwargs)
+            return request.profiler.runcall(func, *args, **kwargs)
         return prof_wrapper
 
-    def _prepare_profile(self):
+    def _prepare_profile(self, request):
         """Prepares profiling information."""
-        if not self._profile_enabled or not hasattr(self, '_prof'):
+        if not request.profile_enabled or request.profiler is None:
             return None
 
         if not gprof2dot:
             logging.warn('failed to import ``gprof2dot``, will not profile')
             return None
 
-        self._prof.create_stats()
-        parser = gprof2dot.PstatsParser(self._prof)
+        if self._store is not None and CONST.PROFILE_RENDER_WORKERS and \
+           firepython.profiling.threading_supported:
+            return self._defer_profile(request.profiler)
+        return self._build_profile(request.profiler)
 
-        def get_function_name((filename, line, name)):
-            module = os.path.splitext(filename)[0]
-            module_pieces = module.split(os.path.sep)
-            return "%s:%d:%s" % ("/".join(module_pieces[-4:]), line, name)
+    def _defer_profile(self, profiler):
+        """
+        Hands the profile graph of ``profiler`` over to the render pool
+        (see ``firepython.profiling.RenderPool``) and returns a profile
+        carrying just a ``token``: the client fetches the finished profile
+        from ``payload_path`` followed by the token, like logs.
+        """
+        job = firepython.profiling.get_render_pool().submit(
+            lambda: self._build_profile(profiler))
+        def render():
+            profile = job.wait(CONST.PROFILE_RENDER_TIMEOUT)
+            if profile is None:
+                if not job.done():
+                    error = 'timed out'
+                else:
+                    error = job.error or 'no graph rendered'
+                profile = {
+                  "producer": "gprof2dot",
+                  "info": "Profile Graph: %s" % error,
+                }
+            return self._serialize(profile)
+        return {
+          "producer": "gprof2dot",
+          "producerVersion": str(gprof2dot.__version__),
+          "info": "Profile Graph: rendered in the background",
+          "token": self._store.put(render),
+        }
 
-        parser.get_function_name = get_function_name
-        output = StringIO()
-        gprof = parser.parse()
+    def _build_profile(self, profiler):
+        if hasattr(profiler, 'info'):
+            gprof = profiler.profile()
+            info = profiler.info()
+        elif hasattr(profiler, 'getstats'): # cProfile
+            gprof, info = firepython.profiling.cprofile_profile(profiler)
+        else:
+            gprof, info = self._parse_pstats(profiler)
+        return self._render_profile(gprof, info)
 
-        gprof.prune(0.005, 0.001)
-                # TODO: ^--- Parameterize node and edge thresholds.
-        dot = gprof2dot.DotWriter(output)
-        theme = gprof2dot.TEMPERATURE_COLORMAP
-        theme.bgcolor = (0.0, 0.0, 0.0)
-                        # ^--- Use black text, for less eye-bleeding.
-        dot.graph(gprof, theme)
+    def _parse_pstats(self, profiler):
+        profiler.create_stats()
+        parser = gprof2dot.PstatsParser(profiler)
+        parser.get_function_name = firepython.profiling.function_name
+        gprof = parser.parse()
 
         def get_info(self):
             s = "Profile Graph:"
@@ -318,16 +843,119 @@ class FirePythonBase(object):
                 s += " (%d primitive calls)" % self.prim_calls
             return s
 
+        return gprof, get_info(parser.stats)
+
+    def _render_profile(self, gprof, info):
+        output = StringIO()
+        gprof.prune(0.005, 0.001)
+                # TODO: ^--- Parameterize node and edge thresholds.
+        dot = gprof2dot.DotWriter(output)
+        theme = gprof2dot.TEMPERATURE_COLORMAP
+        theme.bgcolor = (0.0, 0.0, 0.0)
+                        # ^--- Use black text, for less eye-bleeding.
+        dot.graph(gprof, theme)
+
         profile = {
           "producer": "gprof2dot",
           "producerVersion": str(gprof2dot.__version__),
-          "info": get_info(parser.stats),
+          "info": info,
           "dot": output.getvalue(),
         }
 
         return profile
 
 
+class _EncodedRecord(object):
+    """ A log entry serialized when its record was emitted. """
+
+    __slots__ = ('levelno', 'entry', 'error')
+
+    def __init__(self, levelno):
+        self.levelno = levelno # for the overflow policies of the handler
+        self.entry = None # JSON string
+        self.error = None # internal error entry if preparation failed
+
+
+_RECORD_PROPS = ("args", "pathname", "lineno", "exc_text", "name", "process",
+                 "thread", "threadName")
+_get_record_props = operator.attrgetter(*_RECORD_PROPS)
+
+
+class _LogPreparer(object):
+    """
+    Prepares log entries of the records of one flush.  Level names, the
+    formatted wall-clock second and record attribute access are shared
+    between records instead of being worked out for each of them.
+    """
+
+    def __init__(self, middleware):
+        self._middleware = middleware
+        self._format = middleware._handler.format
+        self._levels = {} # level number -> level name
+        self._second = None
+        self._clock = None # formatted self._second
+
+    def prepare(self, record, capture_exc=True, plain=False):
+        """
+        Returns the log entry of ``record``.  A ``plain`` entry costs next
+        to nothing: its message is the unformatted template and it has no
+        arguments and no exception.
+        """
+        snapshot = isinstance(record, RecordSnapshot)
+        if not snapshot and not capture_exc and record.exc_info:
+            record = copy.copy(record)
+            record.exc_info = record.exc_text = None
+        if snapshot:
+            message = record.message
+        elif plain:
+            message = record.msg
+            if not isinstance(message, (str, unicode)):
+                message = '<%s>' % type(message).__name__
+        else:
+            message = self._format(record)
+        levelno = record.levelno
+        level = self._levels.get(levelno)
+        if level is None:
+            level = self._levels[levelno] = \
+                self._middleware._log_level(levelno)
+        created = record.created
+        second = long(created)
+        if second != self._second:
+            self._second = second
+            self._clock = time.strftime("%H:%M:%S", time.localtime(created))
+        data = {
+            "level": level,
+            "message": message,
+            "template": record.msg,
+            "timestamp": long(created * 1000 * 1000),
+            "time": self._clock + (".%03d" % ((created - second) * 1000)),
+        }
+        try:
+            data.update(zip(_RECORD_PROPS, _get_record_props(record)))
+        except AttributeError: # a record missing some of them
+            for p in _RECORD_PROPS:
+                try:
+                    data[p] = getattr(record, p)
+                except AttributeError:
+                    pass
+        if plain:
+            data.pop('args', None)
+            return data
+
+        exc_info = getattr(record, 'exc_info', None)
+        if exc_info is None or not capture_exc:
+            pass
+        elif snapshot:
+            # already sanitized when the record was emitted
+            data['exc_info'] = exc_info
+            data['exc_frames'] = record.exc_frames
+        else:
+            data['exc_info'] = self._middleware._sanitize_exc_info(exc_info)
+
+            data['exc_frames'] = firepython.frames.capture_locals(exc_info[2])
+        return data
+
+
 class FirePythonDjango(FirePythonBase):
     """
     Django middleware to enable FirePython logging.
@@ -341,48 +969,110 @@ class FirePythonDjango(FirePythonBase):
      - ``FIREPYTHON_LOGGER_NAME``: specific logger name you want to monitor
      - ``FIREPYTHON_CHECK_AGENT``: set to False for prevent server to check
        presence of firepython in user-agent HTTP header.
+     - ``FIREPYTHON_SERIALIZER``: payload serializer, a name from
+       ``firepython.serializers.SERIALIZERS`` or an engine instance.
+     - ``FIREPYTHON_PAYLOAD_PATH``: path prefix (e.g. ``'/_firelogger/'``)
+       under which logs are served; responses then carry just a token
+       header instead of the logs, see ``FirePythonWSGI``.
+     - ``FIREPYTHON_PROFILE_PATH``: path (e.g. ``'/_firelogger/profile'``)
+       serving the aggregates of the continuous sampler, which then
+       samples every request attributed to its view, see
+       ``FirePythonWSGI``.
     """
 
     def __init__(self):
         from django.conf import settings
-        self._extension_data = {}
         self._password = getattr(settings, 'FIREPYTHON_PASSWORD', None)
         self._logger_name = getattr(settings, 'FIREPYTHON_LOGGER_NAME', None)
         self._check_agent = getattr(settings, 'FIREPYTHON_CHECK_AGENT', True)
+        self._serializer = firepython.serializers.get_serializer(
+            getattr(settings, 'FIREPYTHON_SERIALIZER', None))
+        self._payload_path = getattr(settings, 'FIREPYTHON_PAYLOAD_PATH', None)
+        if self._payload_path:
+            self._store = firepython.store.PayloadStore()
+        self._profile_path = getattr(settings, 'FIREPYTHON_PROFILE_PATH', None)
+        if self._profile_path:
+            self._sampler = firepython.profiling.get_continuous_sampler()
         self.install_handler()
 
     def __del__(self):
         self.uninstall_handler()
 
+    def _get_request(self, request):
+        fp_request = getattr(request, 'firepython_request', None)
+        if fp_request is None:
+            # process_request did not run for this request
+            fp_request = self._check(request.META)
+        return fp_request
+
+    def _response(self, status, headers, body):
+        from django.http import HttpResponse
+        response = HttpResponse(body, status=int(status.split()[0]))
+        for name, value in headers:
+            response[name] = value
+        return response
+
     def process_request(self, request):
-        if not self._check(request.META):
+        if self._payload_path and \
+           request.path_info.startswith(self._payload_path):
+            # served responses carry no logs of their own
+            request.firepython_request = FirePythonRequest()
+            return self._response(*self._serve_payload(
+                request.META, request.path_info[len(self._payload_path):]))
+        if self._sampler is not None:
+            if request.path_info == self._profile_path:
+                request.firepython_request = FirePythonRequest()
+                return self._response(*self._serve_profile(request.META))
+            self._sampler.begin(request.path_info)
+
+        fp_request = request.firepython_request = self._check(request.META)
+        if not fp_request.enabled:
             return
 
-        self._start()
+        self._start(fp_request)
         # Make set_extension_data available via the request object.
-        if self._appstats_enabled:
+        if fp_request.appstats_enabled:
             request.firepython_appstats_enabled = True
-        request.firepython_set_extension_data = self._extension_data.__setitem__
+        request.firepython_set_extension_data = \
+            fp_request.extension_data.__setitem__
 
     def process_view(self, request, callback, callback_args, callback_kwargs):
+        if self._sampler is not None:
+            self._sampler.set_route('%s.%s' % (
+                getattr(callback, '__module__', None),
+                getattr(callback, '__name__', type(callback).__name__)))
+        fp_request = self._get_request(request)
         args = (request, ) + callback_args
-        return self._profile_wrap(callback)(*args, **callback_kwargs)
+        if not fp_request.enabled:
+            return callback(*args, **callback_kwargs)
+        return self._profile_wrap(fp_request, callback)(*args,
+                                                        **callback_kwargs)
 
     def process_response(self, request, response):
-        check = self._check(request.META)
-        if self._client_message:
+        if self._sampler is not None:
+            if getattr(response, 'streaming', False):
+                # ends on close, Django closes the streamed content too
+                response.streaming_content = _SampledResponse(
+                    response.streaming_content, self._sampler)
+            else:
+                self._sampler.end()
+        fp_request = self._get_request(request)
+        if fp_request.client_message:
             response.__setitem__(CONST.FIRELOGGER_MESSAGE_HEADER,
-                                 self._client_message)
-        if not check:
+                                 fp_request.client_message)
+        if not fp_request.enabled:
             return response
             
-        profile = self._prepare_profile()
-        self._finish()
-        self._flush_records(response.__setitem__, profile, self._extension_data)
+        try:
+            profile = self._prepare_profile(fp_request)
+            self._finish()
+            self._flush_records(fp_request, response.__setitem__, profile)
+        finally:
+            self._discard()
         return response
 
     def process_exception(self, request, exception):
-        if not self._check(request.META):
+        if not self._get_request(request).enabled:
             return
 
         logging.exception(exception)
@@ -393,29 +1083,104 @@ class FirePythonWSGI(FirePythonBase):
     WSGI middleware to enable FirePython logging.
 
     Supply an application object and an optional password to enable password
-    protection. Also logger name may be specified.
+    protection. Also logger name may be specified.  ``serializer`` selects
+    the payload serializer, see ``firepython.serializers``.
+
+    By default the whole response body is collected so that the FireLogger
+    headers can carry every record logged while the application ran.  With
+    ``stream_threshold`` set, the body is streamed instead: up to that many
+    bytes are held back, then the headers are sent with the records logged
+    so far and the rest of the body passes straight through (``0`` sends
+    the headers with the first body chunk).  Records logged after that point
+    are not sent.  Data passed to the legacy ``write`` callable is held until
+    the application callable returns.
+
+    With ``payload_path`` set (e.g. ``'/_firelogger/'``), the records are
+    not sent in headers at all: they are prepared when the response is
+    sent, then kept in memory for a while (see ``firepython.store``) and
+    the response carries a single
+    ``FireLoggerToken`` header.  The client fetches the logs as JSON from
+    ``payload_path`` followed by the token, sending the same FireLogger
+    headers as for any logged request.  Logs never fetched are never
+    serialized.  With ``PROFILE_RENDER_WORKERS`` set, profile graphs are
+    rendered in background threads and fetched the same way, see
+    ``FirePythonBase._defer_profile``.
+
+    With ``profile_path`` set (e.g. ``'/_firelogger/profile'``), every
+    request is sampled at a low rate by the process-wide continuous
+    sampler, attributed to its route (see
+    ``firepython.profiling.ContinuousSampler``).  The aggregates are served
+    from ``profile_path`` to clients sending the FireLogger headers, see
+    ``FirePythonBase._serve_profile``.  The route is ``PATH_INFO`` unless
+    ``route_func`` maps the WSGI environment to one (e.g. to keep ids in
+    paths from making every request a route of its own).  An application
+    resolving its routes itself may call ``environ['firepython.set_route']``
+    with the route resolved.
     """
-    def __init__(self, app, password=None, logger_name=None, check_agent=True):
+    def __init__(self, app, password=None, logger_name=None, check_agent=True,
+                 stream_threshold=None, serializer=None, payload_path=None,
+                 profile_path=None, route_func=None):
         self.app = app
         self._password = password
         self._logger_name = logger_name
         self._check_agent = check_agent
+        self._stream_threshold = stream_threshold
+        self._serializer = firepython.serializers.get_serializer(serializer)
+        self._payload_path = payload_path
+        if payload_path:
+            self._store = firepython.store.PayloadStore()
+        self._profile_path = profile_path
+        if profile_path:
+            self._sampler = firepython.profiling.get_continuous_sampler()
+        self._route_func = route_func
         self.install_handler()
 
     def __del__(self):
         self.uninstall_handler()
 
     def __call__(self, environ, start_response):
-        check = self._check(environ)
-        if not check and not self._client_message:
+        if self._sampler is None:
+            return self._call(environ, start_response)
+        path = environ.get('PATH_INFO', '')
+        if path == self._profile_path:
+            status, headers, body = self._serve_profile(environ)
+            start_response(status, headers)
+            return [body]
+        route = path
+        if self._route_func is not None:
+            route = self._route_func(environ)
+        self._sampler.begin(route, sys._getframe())
+        environ['firepython.set_route'] = self._sampler.set_route
+        try:
+            app_iter = self._call(environ, start_response)
+        except:
+            self._sampler.end()
+            raise
+        if isinstance(app_iter, (list, tuple)):
+            self._sampler.end()
+            return app_iter
+        # the body is produced while iterated, see _SampledResponse
+        return _SampledResponse(app_iter, self._sampler)
+
+    def _call(self, environ, start_response):
+        if self._payload_path:
+            path = environ.get('PATH_INFO', '')
+            if path.startswith(self._payload_path):
+                status, headers, body = self._serve_payload(
+                    environ, path[len(self._payload_path):])
+                start_response(status, headers)
+                return [body]
+
+        request = self._check(environ)
+        check = request.enabled
+        if not check and not request.client_message:
             return self.app(environ, start_response) # a quick path
 
         # firepython is enabled or we have a client message we want to communicate in headers
-        client_message = self._client_message
+        client_message = request.client_message
 
         # asking why? see __ref_pymod_counter__
         closure = ["200 OK", [], None]
-        extension_data = {}  # Collect extension data here
         sio = StringIO()
         def faked_start_response(_status, _headers, _exc_info=None):
             closure[0] = _status
@@ -429,13 +1194,18 @@ class FirePythonWSGI(FirePythonBase):
         def add_header(name, value):
             closure[1].append((name, value))
 
-        if self._appstats_enabled:
+        if request.appstats_enabled:
             environ['firepython.appstats_enabled'] = True
             
         if check: 
-            self._start()
-            environ['firepython.set_extension_data'] = extension_data.__setitem__
-            
+            self._start(request)
+            environ['firepython.set_extension_data'] = \
+                request.extension_data.__setitem__
+
+        if check and self._stream_threshold is not None:
+            return self._stream(request, environ, start_response, closure,
+                                sio, faked_start_response)
+
         # run app
         try:
             # the nested try-except block within
@@ -444,7 +1214,7 @@ class FirePythonWSGI(FirePythonBase):
             try:
                 app = self.app
                 if check:
-                    app = self._profile_wrap(app)
+                    app = self._profile_wrap(request, app)
                 app_iter = app(environ, faked_start_response)
                 output = list(app_iter)
             except:
@@ -455,9 +1225,12 @@ class FirePythonWSGI(FirePythonBase):
         finally:
             # Output the profile first, so we can see any errors in profiling.
             if check: 
-                profile = self._prepare_profile()
-                self._finish()
-                self._flush_records(add_header, profile, extension_data)
+                try:
+                    profile = self._prepare_profile(request)
+                    self._finish()
+                    self._flush_records(request, add_header, profile)
+                finally:
+                    self._discard()
 
         # start responding
         write = start_response(*closure)
@@ -467,21 +1240,140 @@ class FirePythonWSGI(FirePythonBase):
         # return output
         return output
 
+    def _stream(self, request, environ, start_response, closure, sio,
+                faked_start_response):
+        try:
+            try:
+                app_iter = self._profile_wrap(request, self.app)(
+                    environ, faked_start_response)
+            except:
+                logging.exception(sys.exc_info()[0])
+                raise
+        except:
+            self._discard()
+            raise
+
+        def commit():
+            def add_header(name, value):
+                closure[1].append((name, value))
+            try:
+                profile = self._prepare_profile(request)
+                self._finish()
+                self._flush_records(request, add_header, profile)
+            finally:
+                self._discard()
+            write = start_response(*closure)
+            if sio.tell(): # position is not 0
+                sio.seek(0)
+                write(sio.read())
+
+        return _StreamingResponse(app_iter, self._stream_threshold, commit,
+                                  self._discard)
+
+
+class _StreamingResponse(object):
+    """
+    Response iterable of ``FirePythonWSGI`` in streaming mode.  Holds back
+    body chunks until ``threshold`` bytes are collected (or the body ends),
+    then calls ``commit`` to send the headers and passes everything else
+    through.  ``discard`` is called on close if headers were never sent.
+    """
+
+    def __init__(self, app_iter, threshold, commit, discard):
+        self._app_iter = app_iter
+        self._threshold = threshold
+        self._commit = commit
+        self._discard = discard
+        self._committed = False
+
+    def __iter__(self):
+        pending = []
+        pending_size = 0
+        try:
+            for chunk in self._app_iter:
+                if self._committed:
+                    yield chunk
+                    continue
+                pending.append(chunk)
+                pending_size += len(chunk)
+                if pending_size >= self._threshold and pending_size:
+                    self._committed = True
+                    self._commit()
+                    for held in pending:
+                        yield held
+                    pending = None
+        except Exception:
+            # not GeneratorExit, thrown in when the client went away
+            logging.exception(sys.exc_info()[0])
+            raise
+        if not self._committed:
+            self._committed = True
+            self._commit()
+            for held in pending:
+                yield held
+
+    def close(self):
+        try:
+            if hasattr(self._app_iter, 'close'):
+                self._app_iter.close()
+        finally:
+            if not self._committed:
+                self._discard()
+
+
+class _SampledResponse(object):
+    """
+    Response iterable passing ``app_iter`` through while the continuous
+    ``sampler`` keeps attributing the thread to the route of the request:
+    the sampling of the request ends when the response is closed.
+    """
+
+    def __init__(self, app_iter, sampler):
+        self._app_iter = app_iter
+        self._sampler = sampler
+
+    def __iter__(self):
+        self._sampler.set_top(sys._getframe())
+        for chunk in self._app_iter:
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self._app_iter, 'close'):
+                self._app_iter.close()
+        finally:
+            self._sampler.end()
+
 
 def paste_filter_factory(global_conf, password_file='', logger_name='',
-                         check_agent='true'):
+                         check_agent='true', stream_threshold='',
+                         serializer='', payload_path='', profile_path='',
+                         route_func=''):
     from paste.deploy.converters import asbool
 
     check_agent = asbool(check_agent)
+    if stream_threshold == '':
+        stream_threshold = None
+    else:
+        stream_threshold = int(stream_threshold)
     get_password = lambda: ''
     if password_file:
         def get_password():
             return open(password_file).read().strip()
+    if route_func:
+        # 'package.module:function'
+        module_name, name = route_func.split(':', 1)
+        route_func = getattr(__import__(module_name, {}, {}, [name]), name)
 
     def with_firepython_middleware(app):
         return FirePythonWSGI(app, password=get_password(),
                               logger_name=logger_name,
-                              check_agent=check_agent)
+                              check_agent=check_agent,
+                              stream_threshold=stream_threshold,
+                              serializer=serializer or None,
+                              payload_path=payload_path or None,
+                              profile_path=profile_path or None,
+                              route_func=route_func or None)
     return with_firepython_middleware
 
 
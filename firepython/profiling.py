@@ -0,0 +1,930 @@
+# -*- mode: python; coding: utf-8 -*-
+"""
+Profilers for FirePython profile graphs.
+
+The profiler of a request is selected by the value of its
+``X-FireLoggerProfiler`` header (see ``PROFILERS``):
+
+ - ``sample``: ``SamplingProfiler``, a statistical profiler reading the
+   stack of the profiled thread every ``PROFILE_SAMPLE_INTERVAL`` seconds;
+   its overhead does not grow with the number of calls made
+ - ``monitoring``: ``MonitoringProfiler`` (Python 3.12+), a deterministic
+   profiler built on ``sys.monitoring`` events, instrumenting only the
+   code of ``PROFILE_PACKAGES``
+ - anything else: ``cProfile`` (``profile`` where not available)
+
+Besides ``cProfile``'s, a profiler builds its ``gprof2dot.Profile`` with
+``profile()`` and describes it with ``info()``.  Profile graphs need an
+importable ``gprof2dot``: the copy bundled in the source tree is Python 2
+only, on Python 3 install ``gprof2dot`` from PyPI and make sure the
+bundled copy does not shadow it.
+
+``ContinuousSampler`` is not a per-request profiler: it samples every
+request served, at a low rate, and keeps rolling aggregates per route.
+
+``RenderPool`` renders profile graphs off the request path, see
+``FirePythonBase._defer_profile``.
+"""
+
+import os
+import sys
+import time
+from collections import deque
+
+try:
+    from collections import OrderedDict
+except ImportError: # Python 2.6
+    OrderedDict = None
+
+try:
+    import gprof2dot
+except (ImportError, SyntaxError): # the bundled copy is Python 2 only
+    gprof2dot = None
+
+import firepython._const as CONST
+from firepython.handlers import threading_supported
+
+if threading_supported:
+    import threading
+    try:
+        from threading import get_ident
+    except ImportError: # Python 2
+        from thread import get_ident
+
+monitoring = getattr(sys, 'monitoring', None) # Python 3.12+
+_MODULE_PATH = os.path.splitext(os.path.abspath(__file__))[0]
+_tool_paths = {} # tool id -> paths of the profilers which disabled code
+
+__all__ = [
+    'PROFILERS',
+    'ContinuousSampler',
+    'MonitoringProfiler',
+    'RenderJob',
+    'RenderPool',
+    'SamplingProfiler',
+    'cprofile_profile',
+    'create_profiler',
+    'function_name',
+    'get_continuous_sampler',
+    'get_render_pool',
+    'sampled_profile',
+]
+
+
+def function_name(key):
+    """
+    Returns the graph label of function ``key``, a ``(filename, line
+    number, name)`` tuple as used by ``pstats``.
+    """
+    filename, line, name = key
+    module = os.path.splitext(filename)[0]
+    module_pieces = module.split(os.path.sep)
+    return "%s:%d:%s" % ("/".join(module_pieces[-4:]), line, name)
+
+
+def _code_key(code):
+    return (code.co_filename, code.co_firstlineno, code.co_name)
+
+
+class _NameCache(object):
+    """
+    ``function_name`` results of the ``size`` least recently used keys
+    (without ``OrderedDict``, all of them are forgotten once full).
+    """
+
+    def __init__(self, size):
+        self.size = size
+        if OrderedDict is not None:
+            self._names = OrderedDict() # key -> name, oldest first
+        else:
+            self._names = {}
+        if threading_supported:
+            self._lock = threading.Lock() # shared by request threads
+        else:
+            self._lock = None
+
+    def get(self, key):
+        if self._lock:
+            self._lock.acquire()
+        try:
+            names = self._names
+            name = names.pop(key, None)
+            if name is None:
+                name = function_name(key)
+                if len(names) >= self.size:
+                    if OrderedDict is not None:
+                        names.popitem(last=False)
+                    else:
+                        names.clear()
+            names[key] = name # most recently used last
+            return name
+        finally:
+            if self._lock:
+                self._lock.release()
+
+
+_function_names = _NameCache(CONST.FUNCTION_NAME_CACHE_SIZE)
+
+
+def cprofile_profile(profiler, get_function_name=None):
+    """
+    Returns a ``gprof2dot.Profile`` of the ``cProfile.Profile``
+    ``profiler`` and its description, built straight from
+    ``profiler.getstats()`` like ``gprof2dot.PstatsParser`` would from
+    ``pstats.Stats``.  Unless ``get_function_name`` is given, function
+    names are cached across calls (``FUNCTION_NAME_CACHE_SIZE``).
+    """
+    if get_function_name is None:
+        get_function_name = _function_names.get
+    profile = gprof2dot.Profile()
+    functions = {} # function key -> gprof2dot.Function
+    CALLS, TIME, TOTAL_TIME = \
+        gprof2dot.CALLS, gprof2dot.TIME, gprof2dot.TOTAL_TIME
+
+    def get_function(code):
+        if isinstance(code, str):
+            key = ('~', 0, code) # built-in, labelled like pstats does
+        else:
+            key = (code.co_filename, code.co_firstlineno, code.co_name)
+        function = functions.get(key)
+        if function is None:
+            function = gprof2dot.Function(len(functions),
+                                          get_function_name(key))
+            function[CALLS] = 0
+            function[TIME] = 0.0
+            function[TOTAL_TIME] = 0.0
+            functions[key] = function
+            profile.add_function(function)
+        return function
+
+    total_calls = prim_calls = 0
+    total_tt = max_ct = 0.0
+    for entry in profiler.getstats():
+        function = get_function(entry.code)
+        function[CALLS] += entry.callcount
+        function[TIME] += entry.inlinetime
+        function[TOTAL_TIME] += entry.totaltime
+        total_calls += entry.callcount
+        prim_calls += entry.callcount - entry.reccallcount
+        total_tt += entry.inlinetime
+        max_ct = max(max_ct, function[TOTAL_TIME])
+        for subentry in entry.calls or ():
+            callee = get_function(subentry.code)
+            call = function.calls.get(callee.id)
+            if call is None:
+                call = gprof2dot.Call(callee.id)
+                call[CALLS] = 0
+                call[TOTAL_TIME] = 0.0
+                function.add_call(call)
+            call[CALLS] += subentry.callcount - subentry.reccallcount
+            call[TOTAL_TIME] += subentry.totaltime
+    profile[TIME] = total_tt
+    profile[TOTAL_TIME] = max(total_tt, max_ct)
+    profile.validate()
+    profile.ratio(gprof2dot.TIME_RATIO, TIME)
+    profile.ratio(gprof2dot.TOTAL_TIME_RATIO, TOTAL_TIME)
+
+    info = "Profile Graph: %.3fs CPU: %d function calls" % (total_tt,
+                                                             total_calls)
+    if total_calls != prim_calls:
+        info += " (%d primitive calls)" % prim_calls
+    return profile, info
+
+
+def sampled_profile(stacks, get_function_name=function_name):
+    """
+    Returns a ``gprof2dot.Profile`` of ``stacks``, a dictionary mapping
+    tuples of function keys (outermost first) to their sample counts.
+    """
+    profile = gprof2dot.Profile()
+    functions = {} # function key -> gprof2dot.Function
+    samples = sum(stacks.values())
+    total = float(samples or 1)
+
+    def get_function(key):
+        function = functions.get(key)
+        if function is None:
+            function = gprof2dot.Function(len(functions),
+                                          get_function_name(key))
+            function[gprof2dot.SAMPLES] = 0
+            function[gprof2dot.TOTAL_TIME_RATIO] = 0.0
+            functions[key] = function
+            profile.add_function(function)
+        return function
+
+    for stack, count in stacks.items():
+        get_function(stack[-1])[gprof2dot.SAMPLES] += count
+        seen = set() # recursion counts once per sample
+        caller = None
+        for key in stack:
+            function = get_function(key)
+            if key not in seen:
+                seen.add(key)
+                function[gprof2dot.TOTAL_TIME_RATIO] += count / total
+            edge = (caller, function)
+            if caller is not None and caller is not function and \
+               edge not in seen:
+                seen.add(edge)
+                call = caller.calls.get(function.id)
+                if call is None:
+                    call = gprof2dot.Call(function.id)
+                    call[gprof2dot.SAMPLES2] = 0
+                    caller.add_call(call)
+                call[gprof2dot.SAMPLES2] += count
+            caller = function
+    profile[gprof2dot.SAMPLES] = samples
+    for function in functions.values():
+        function[gprof2dot.TIME_RATIO] = function[gprof2dot.SAMPLES] / total
+        for call in function.calls.values():
+            call[gprof2dot.TOTAL_TIME_RATIO] = \
+                call[gprof2dot.SAMPLES2] / total
+    profile[gprof2dot.TIME_RATIO] = 1.0
+    profile[gprof2dot.TOTAL_TIME_RATIO] = 1.0
+    return profile
+
+
+class SamplingProfiler(object):
+    """
+    Statistical profiler.  While enabled, a sampler thread records the
+    stack of the profiled thread every ``interval`` seconds (defaults to
+    ``PROFILE_SAMPLE_INTERVAL``).  Stacks are counted by their functions,
+    so the graph shows the share of samples spent in each function and
+    below each call, but no call counts.  ``pause`` and ``resume`` skip
+    samples cheaply, e.g. while other tasks of an event loop run.
+    """
+
+    def __init__(self, interval=None):
+        self.interval = interval or CONST.PROFILE_SAMPLE_INTERVAL
+        self.stacks = {} # tuple of function keys, outermost first -> samples
+        self.samples = 0
+        self.duration = 0.0 # seconds spent enabled, pauses excluded
+        self._sampler = None
+        self._started = None
+        self._paused = None # time.time() of the pause
+
+    def enable(self, top=None):
+        """
+        Starts sampling the calling thread.  Frames above ``top``, and
+        ``top`` itself, are left out of the samples.
+        """
+        if not threading_supported or self._sampler is not None:
+            return
+        thread = threading.current_thread()
+        self._sampler = threading.Thread(target=self._sample,
+                                         args=(thread.ident, top),
+                                         name='FirePython sampler')
+        self._sampler.daemon = True
+        self._started = time.time()
+        self._sampler.start()
+
+    def disable(self):
+        """ Stops sampling. """
+        sampler = self._sampler
+        if sampler is None:
+            return
+        self.resume()
+        self._sampler = None
+        sampler.join()
+        self.duration += time.time() - self._started
+
+    def pause(self):
+        """ Skips samples until ``resume``. """
+        if self._sampler is not None and self._paused is None:
+            self._paused = time.time()
+
+    def resume(self):
+        if self._paused is not None:
+            self.duration -= time.time() - self._paused
+            self._paused = None
+
+    def runcall(self, func, *args, **kwargs):
+        self.enable(sys._getframe())
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.disable()
+
+    def _sample(self, thread_id, top):
+        sampler = self._sampler
+        interval = self.interval
+        stacks = self.stacks
+        keys = {} # code -> function key
+        while self._sampler is sampler:
+            time.sleep(interval)
+            if self._sampler is not sampler:
+                break # not sampling disable()
+            if self._paused is not None:
+                continue
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None and frame is not top:
+                code = frame.f_code
+                key = keys.get(code)
+                if key is None:
+                    key = keys[code] = _code_key(code)
+                stack.append(key)
+                frame = frame.f_back
+            if not stack:
+                continue
+            frame = None # not kept alive while sleeping
+            stack.reverse()
+            stack = tuple(stack)
+            stacks[stack] = stacks.get(stack, 0) + 1
+            self.samples += 1
+
+    def profile(self, get_function_name=function_name):
+        """ Returns the samples as a ``gprof2dot.Profile``. """
+        return sampled_profile(self.stacks, get_function_name)
+
+    def info(self):
+        return "Profile Graph: %.3fs sampled: %d samples every %.1fms" % (
+            self.duration, self.samples, self.interval * 1000)
+
+
+def _package_paths(packages):
+    paths = []
+    for name in packages:
+        module = sys.modules.get(name)
+        if module is None:
+            module = __import__(name, {}, {}, name.split('.'))
+        for path in getattr(module, '__path__', None) or ():
+            paths.append(os.path.abspath(path) + os.sep)
+        if not hasattr(module, '__path__'):
+            filename = os.path.abspath(module.__file__)
+            paths.append(os.path.splitext(filename)[0] + '.py')
+    return tuple(paths)
+
+
+class MonitoringProfiler(object):
+    """
+    Deterministic profiler built on ``sys.monitoring`` (Python 3.12+).
+    Only the functions defined in modules of ``packages`` (names of
+    packages or modules, defaults to ``PROFILE_PACKAGES``, None means all
+    code) are measured; calls through other code are attributed to the
+    nearest measured caller.  Events of other code are disabled at their
+    first occurrence, so they cost close to nothing afterwards.  Measured
+    calls go through Python callbacks and cost more than under
+    ``cProfile``: the profiler pays off when limited to the packages of
+    interest.
+
+    Only the thread which enabled the profiler is measured, but
+    ``sys.monitoring`` events are process-wide: while a profile runs, every
+    call of measured code on every thread pays a Python callback (with
+    ``packages`` None, every call).  The profiler only uses the tool ids
+    without a name, leaving ``PROFILER_ID`` to ``cProfile``, and stays
+    disabled when none is free (e.g. too many requests profiled at once).
+
+    Code disabled for a tool id stays disabled after the tool id is freed,
+    and ``sys.monitoring.restart_events()`` would re-enable the code
+    disabled by every other tool (coverage, debuggers) too.  Instead, a tool
+    id is kept for profilers of the same ``packages`` once it disabled
+    code: profilers of more than ``len(TOOL_IDS)`` different ``packages``
+    in one process stay disabled.
+    """
+
+    TOOL_IDS = (3, 4) # the unnamed ones
+
+    def __init__(self, packages=None):
+        if packages is None:
+            packages = CONST.PROFILE_PACKAGES
+        self.paths = packages is not None and _package_paths(packages) or None
+        self.functions = {} # code -> [calls, own time, total time]
+        self.calls = {} # (caller code, callee code) -> [calls, total time]
+        self.duration = 0.0 # seconds spent enabled, pauses excluded
+        self.tool_id = None
+        self._paused = None # time.perf_counter() of the pause
+        self._included = {} # code -> measured?
+        self._stack = [] # [code, started, time in callees, call?]
+        self._depths = {} # code -> times on the stack
+        self._thread = None
+        self._started = None
+
+    def enable(self):
+        """ Starts measuring the calling thread, if a tool id is free. """
+        if monitoring is None or self.tool_id is not None:
+            return
+        for tool_id in self.TOOL_IDS:
+            if _tool_paths.get(tool_id, self.paths) != self.paths:
+                continue # disabled code other packages may include
+            try:
+                monitoring.use_tool_id(tool_id, 'FirePython')
+            except ValueError: # in use
+                continue
+            break
+        else:
+            return
+        _tool_paths[tool_id] = self.paths
+        self.tool_id = tool_id
+        self._thread = get_ident()
+        events = monitoring.events
+        for event, callback in (
+            (events.PY_START, self._on_start),
+            (events.PY_RESUME, self._on_resume),
+            (events.PY_RETURN, self._on_return),
+            (events.PY_YIELD, self._on_return),
+            (events.PY_UNWIND, self._on_unwind),
+        ):
+            monitoring.register_callback(tool_id, event, callback)
+        self._started = time.perf_counter()
+        monitoring.set_events(tool_id, events.PY_START | events.PY_RESUME |
+                              events.PY_RETURN | events.PY_YIELD |
+                              events.PY_UNWIND)
+
+    def disable(self):
+        """ Stops measuring. """
+        tool_id = self.tool_id
+        if tool_id is None:
+            return
+        monitoring.set_events(tool_id, 0)
+        events = monitoring.events
+        for event in (events.PY_START, events.PY_RESUME, events.PY_RETURN,
+                      events.PY_YIELD, events.PY_UNWIND):
+            monitoring.register_callback(tool_id, event, None)
+        monitoring.free_tool_id(tool_id)
+        self.tool_id = None
+        self.resume()
+        self.duration += time.perf_counter() - self._started
+        del self._stack[:]
+        self._depths.clear()
+
+    def pause(self):
+        """
+        Measures nothing until ``resume``, e.g. while other tasks of an
+        event loop run.  The events keep coming: cheaper than ``disable``
+        and ``enable`` only as it keeps the tool id.
+        """
+        if self.tool_id is not None and self._paused is None:
+            self._paused = time.perf_counter()
+
+    def resume(self):
+        if self._paused is not None:
+            self.duration -= time.perf_counter() - self._paused
+            self._paused = None
+
+    def runcall(self, func, *args, **kwargs):
+        self.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.disable()
+
+    def _is_included(self, code):
+        included = self._included.get(code)
+        if included is None:
+            filename = os.path.abspath(code.co_filename)
+            if os.path.splitext(filename)[0] == _MODULE_PATH:
+                included = False # the profiler itself
+            else:
+                included = self.paths is None or \
+                    filename.startswith(self.paths)
+            self._included[code] = included
+        return included
+
+    def _enter(self, code, call):
+        if not self._is_included(code):
+            return monitoring.DISABLE
+        if get_ident() == self._thread and self._paused is None:
+            self._stack.append([code, time.perf_counter(), 0.0, call])
+            self._depths[code] = self._depths.get(code, 0) + 1
+
+    def _on_start(self, code, offset):
+        return self._enter(code, True)
+
+    def _on_resume(self, code, offset):
+        return self._enter(code, False)
+
+    def _on_return(self, code, offset, value):
+        if not self._is_included(code):
+            return monitoring.DISABLE
+        if get_ident() == self._thread and self._paused is None:
+            self._leave(code)
+
+    def _on_unwind(self, code, offset, exception):
+        if self._included.get(code) and get_ident() == self._thread and \
+           self._paused is None:
+            self._leave(code)
+
+    def _leave(self, code):
+        stack = self._stack
+        if not stack or stack[-1][0] is not code:
+            return # entered before the profiler was enabled
+        _, started, callees, call = stack.pop()
+        elapsed = time.perf_counter() - started
+        function = self.functions.get(code)
+        if function is None:
+            function = self.functions[code] = [0, 0.0, 0.0]
+        if call:
+            function[0] += 1
+        function[1] += elapsed - callees
+        self._depths[code] -= 1
+        if not self._depths[code]:
+            function[2] += elapsed # recursion counts once
+        if stack:
+            caller = stack[-1]
+            caller[2] += elapsed
+            edge = self.calls.get((caller[0], code))
+            if edge is None:
+                edge = self.calls[(caller[0], code)] = [0, 0.0]
+            if call:
+                edge[0] += 1
+            edge[1] += elapsed
+
+    def profile(self, get_function_name=function_name):
+        """ Returns the measurements as a ``gprof2dot.Profile``. """
+        profile = gprof2dot.Profile()
+        ids = {} # code -> function id
+        profile[gprof2dot.TIME] = 0.0
+        profile[gprof2dot.TOTAL_TIME] = 0.0
+        for code, (calls, own, total) in self.functions.items():
+            function = gprof2dot.Function(len(ids),
+                                          get_function_name(_code_key(code)))
+            ids[code] = function.id
+            function[gprof2dot.CALLS] = calls
+            function[gprof2dot.TIME] = own
+            function[gprof2dot.TOTAL_TIME] = total
+            profile.add_function(function)
+            profile[gprof2dot.TIME] += own
+            profile[gprof2dot.TOTAL_TIME] = \
+                max(profile[gprof2dot.TOTAL_TIME], total)
+        for (caller, callee), (calls, total) in self.calls.items():
+            if caller not in ids or callee not in ids:
+                continue
+            call = gprof2dot.Call(ids[callee])
+            call[gprof2dot.CALLS] = calls
+            call[gprof2dot.TOTAL_TIME] = total
+            profile.functions[ids[caller]].add_call(call)
+        profile.validate()
+        profile.ratio(gprof2dot.TIME_RATIO, gprof2dot.TIME)
+        profile.ratio(gprof2dot.TOTAL_TIME_RATIO, gprof2dot.TOTAL_TIME)
+        return profile
+
+    def info(self):
+        if monitoring is None:
+            return "Profile Graph: sys.monitoring requires Python 3.12+"
+        if not self.duration:
+            return "Profile Graph: no sys.monitoring tool id was free"
+        return "Profile Graph: %.3fs: %d function calls (sys.monitoring)" % (
+            self.duration, sum(f[0] for f in self.functions.values()))
+
+
+class ContinuousSampler(object):
+    """
+    Process-wide, low-rate sampler of the threads serving requests.  A
+    thread is attributed to a route between ``begin(route)`` and ``end()``;
+    every ``interval`` seconds the stacks of such threads are counted per
+    route.  Counts are kept in ``windows`` windows of ``window`` seconds
+    each, at most ``max_routes`` routes (more are counted as
+    ``'(other)'``) and ``max_stacks`` distinct stacks per route and window
+    (more are counted as ``'(truncated)'``).  Defaults come from the
+    ``CONTINUOUS_*`` constants.
+
+    Its cost does not depend on the requests served, only on the sampling
+    rate and the depth of the stacks sampled.  Use
+    ``get_continuous_sampler`` for the process-wide instance.
+    """
+
+    OTHER_ROUTE = '(other)'
+    TRUNCATED = ('', 0, '(truncated)') # function key of dropped stacks
+
+    def __init__(self, interval=None, window=None, windows=None,
+                 max_routes=None, max_stacks=None):
+        self.interval = interval or CONST.CONTINUOUS_SAMPLE_INTERVAL
+        self.window = window or CONST.CONTINUOUS_WINDOW
+        self.max_routes = max_routes or CONST.CONTINUOUS_MAX_ROUTES
+        self.max_stacks = max_stacks or CONST.CONTINUOUS_MAX_STACKS
+        # (window start, {route: {stack: samples}}), oldest first
+        self._windows = deque(maxlen=windows or CONST.CONTINUOUS_WINDOWS)
+        self._active = {} # thread id -> (route, top frame)
+        if threading_supported:
+            self._lock = threading.Lock()
+        else:
+            self._lock = None
+        self._thread = None
+        self._pid = None
+
+    def begin(self, route, top=None):
+        """
+        Attributes the calling thread to ``route`` until ``end``.  Frames
+        above ``top``, and ``top`` itself, are left out of its samples.
+        """
+        if not threading_supported:
+            return
+        self._active[get_ident()] = (route, top)
+        if self._pid != os.getpid(): # not started yet or forked
+            self._start()
+
+    def set_route(self, route):
+        """ Changes the route of the calling thread, e.g. once resolved. """
+        if not self._active:
+            return
+        ident = get_ident()
+        active = self._active.get(ident)
+        if active is not None:
+            self._active[ident] = (route, active[1])
+
+    def set_top(self, top):
+        """
+        Changes the frame the samples of the calling thread stop at, e.g.
+        once the response body is iterated.
+        """
+        if not self._active:
+            return
+        ident = get_ident()
+        active = self._active.get(ident)
+        if active is not None:
+            self._active[ident] = (active[0], top)
+
+    def end(self):
+        if self._active:
+            self._active.pop(get_ident(), None)
+
+    def stop(self):
+        """ Stops the sampler thread; the next ``begin`` starts it again. """
+        self._acquire()
+        try:
+            thread = self._thread
+            self._thread = self._pid = None
+        finally:
+            self._release()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _start(self):
+        self._acquire()
+        try:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._windows.clear()
+            self._thread = threading.Thread(target=self._run,
+                                            name='FirePython sampler')
+            self._thread.daemon = True
+            self._thread.start()
+        finally:
+            self._release()
+
+    def _run(self):
+        interval = self.interval
+        keys = {} # code -> function key
+        thread = threading.current_thread()
+        while self._thread is thread:
+            time.sleep(interval)
+            if not self._active:
+                continue
+            frames = sys._current_frames()
+            routes = self._current_window()
+            for ident, (route, top) in list(self._active.items()):
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None and frame is not top:
+                    code = frame.f_code
+                    key = keys.get(code)
+                    if key is None:
+                        if len(keys) >= CONST.TRACEBACK_CACHE_SIZE:
+                            keys.clear()
+                        key = keys[code] = _code_key(code)
+                    stack.append(key)
+                    frame = frame.f_back
+                if stack:
+                    stack.reverse()
+                    self._count(routes, route, tuple(stack))
+            frames = frame = None # not kept alive while sleeping
+
+    def _current_window(self):
+        now = time.time()
+        self._acquire()
+        try:
+            if not self._windows or self._windows[-1][0] + self.window <= now:
+                self._windows.append((now, {}))
+            return self._windows[-1][1]
+        finally:
+            self._release()
+
+    def _count(self, routes, route, stack):
+        stacks = routes.get(route)
+        if stacks is None:
+            if len(routes) >= self.max_routes:
+                route = self.OTHER_ROUTE
+                stacks = routes.get(route)
+            if stacks is None:
+                stacks = routes[route] = {}
+        if stack not in stacks and len(stacks) >= self.max_stacks:
+            stack = (self.TRUNCATED,)
+        stacks[stack] = stacks.get(stack, 0) + 1
+
+    def routes(self):
+        """ Returns the routes sampled and their sample counts. """
+        result = {}
+        for route, stacks in self._iter_stacks():
+            result[route] = result.get(route, 0) + sum(stacks.values())
+        return result
+
+    def stacks(self, route=None):
+        """
+        Returns the stacks sampled for ``route`` and their sample counts,
+        over all windows kept.  Without ``route``, the stacks of all
+        routes, each starting with a ``('', 0, route)`` function key.
+        """
+        result = {}
+        for name, stacks in self._iter_stacks():
+            if route is not None and name != route:
+                continue
+            prefix = route is None and (('', 0, name),) or ()
+            for stack, count in stacks.items():
+                stack = prefix + stack
+                result[stack] = result.get(stack, 0) + count
+        return result
+
+    def collapsed(self, route=None, get_function_name=function_name):
+        """
+        Returns ``stacks(route)`` in the collapsed format of flame graph
+        tools: one ``caller;callee;... samples`` line per stack.
+        """
+        lines = []
+        for stack, count in self.stacks(route).items():
+            lines.append('%s %d' % (
+                ';'.join(get_function_name(key) for key in stack), count))
+        lines.sort()
+        return '\n'.join(lines)
+
+    def profile(self, route=None, get_function_name=function_name):
+        """ Returns ``stacks(route)`` as a ``gprof2dot.Profile``. """
+        return sampled_profile(self.stacks(route), get_function_name)
+
+    def info(self, route=None):
+        samples = sum(self.stacks(route).values())
+        return "Profile Graph: %s: %d samples every %.1fms" % (
+            route is None and 'all routes' or route, samples,
+            self.interval * 1000)
+
+    def _iter_stacks(self):
+        self._acquire()
+        try:
+            windows = [routes for _, routes in self._windows]
+        finally:
+            self._release()
+        for routes in windows:
+            for route, stacks in list(routes.items()):
+                yield route, dict(stacks)
+
+
+    def _acquire(self):
+        if self._lock:
+            self._lock.acquire()
+
+    def _release(self):
+        if self._lock:
+            self._lock.release()
+
+
+_continuous_sampler = None
+if threading_supported:
+    _singletons_lock = threading.Lock() # first calls come from requests
+else:
+    _singletons_lock = None
+
+
+def get_continuous_sampler():
+    """ Returns the process-wide ``ContinuousSampler``. """
+    global _continuous_sampler
+    if _continuous_sampler is None:
+        _acquire_singletons()
+        try:
+            if _continuous_sampler is None:
+                _continuous_sampler = ContinuousSampler()
+        finally:
+            _release_singletons()
+    return _continuous_sampler
+
+
+def _acquire_singletons():
+    if _singletons_lock:
+        _singletons_lock.acquire()
+
+
+def _release_singletons():
+    if _singletons_lock:
+        _singletons_lock.release()
+
+
+class RenderJob(object):
+    """ A job of ``RenderPool``: ``func`` called by a worker thread. """
+
+    def __init__(self, func):
+        self.func = func
+        self.result = None
+        self.error = None # why there is no result, once done
+        self._done = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.func()
+        except Exception as e:
+            self.error = 'failed: %s' % e
+        self.func = None
+        self._done.set()
+
+    def drop(self):
+        self.error = 'dropped, too many profiles waiting to be rendered'
+        self.func = None
+        self._done.set()
+
+    def wait(self, timeout=None):
+        """ Returns the result, None if not ready within ``timeout``. """
+        self._done.wait(timeout)
+        return self.result
+
+    def done(self):
+        """ Tells whether the job ran or was dropped. """
+        return self._done.is_set()
+
+
+class RenderPool(object):
+    """
+    ``workers`` daemon threads running the jobs given to ``submit``, at most
+    ``size`` of them waiting: when full, the oldest waiting job is dropped.
+    Defaults come from ``PROFILE_RENDER_WORKERS`` and
+    ``PROFILE_RENDER_QUEUE``.  Use ``get_render_pool`` for the process-wide
+    instance.
+    """
+
+    def __init__(self, workers=None, size=None):
+        self.workers = workers or CONST.PROFILE_RENDER_WORKERS or 1
+        self.size = size or CONST.PROFILE_RENDER_QUEUE
+        self._jobs = deque()
+        self._condition = threading.Condition()
+        self._pid = None
+
+    def submit(self, func):
+        """ Queues a call of ``func``, returns its ``RenderJob``. """
+        job = RenderJob(func)
+        self._condition.acquire()
+        try:
+            if self._pid != os.getpid(): # not started yet or forked
+                self._start()
+            while len(self._jobs) >= self.size:
+                self._jobs.popleft().drop()
+            self._jobs.append(job)
+            self._condition.notify()
+        finally:
+            self._condition.release()
+        return job
+
+    def _start(self):
+        self._pid = os.getpid()
+        self._jobs.clear()
+        for i in range(self.workers):
+            worker = threading.Thread(target=self._run,
+                                      name='FirePython renderer %d' % i)
+            worker.daemon = True
+            worker.start()
+
+    def _run(self):
+        while True:
+            self._condition.acquire()
+            try:
+                while not self._jobs:
+                    self._condition.wait()
+                job = self._jobs.popleft()
+            finally:
+                self._condition.release()
+            job.run()
+
+
+_render_pool = None
+
+
+def get_render_pool():
+    """ Returns the process-wide ``RenderPool``. """
+    global _render_pool
+    if _render_pool is None:
+        _acquire_singletons()
+        try:
+            if _render_pool is None:
+                _render_pool = RenderPool()
+        finally:
+            _release_singletons()
+    return _render_pool
+
+
+PROFILERS = {
+    'sample': SamplingProfiler,
+}
+if monitoring is not None:
+    PROFILERS['monitoring'] = MonitoringProfiler
+
+
+def create_profiler(name=''):
+    """
+    Returns a new profiler registered in ``PROFILERS`` under ``name`` (the
+    value of the ``X-FireLoggerProfiler`` header), a ``cProfile.Profile``
+    when there is none.
+    """
+    factory = PROFILERS.get(name.strip().lower())
+    if factory is not None:
+        return factory()
+    try:
+        import cProfile as profile
+    except ImportError:
+        import profile
+    return profile.Profile()
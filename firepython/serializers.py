@@ -0,0 +1,283 @@
+# -*- mode: python; coding: utf-8 -*-
+"""
+Serializer engines turning the FireLogger payload into JSON text.
+
+An engine is any object with an ``encode(data)`` method returning a JSON
+string.  ``JsonpickleSerializer`` is the reference implementation;
+``JsonSerializer`` produces the same shape of output with the standard
+``json`` module and per-class flatteners, which is considerably faster on
+records carrying arguments and frame locals.
+"""
+
+import sys
+import base64
+import collections
+import types
+
+import jsonpickle
+import jsonpickle.handlers
+import jsonpickle.pickler
+
+import firepython._const as CONST
+
+try:
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        from django.utils import simplejson as json
+
+__all__ = [
+    'JsonpickleSerializer',
+    'JsonSerializer',
+    'SERIALIZERS',
+    'get_serializer',
+]
+
+
+# add a new backed jsonpickle for Django
+# jsonpickle will attempt to import this if default
+# jsonpickle libraries are not present
+jsonpickle.load_backend('django.utils.simplejson', 'dumps',
+                        'loads', ValueError)
+
+PY3 = sys.version_info[0] >= 3
+if PY3:
+    _TEXT_TYPES = (str,)
+    _PRIMITIVE_TYPES = (type(None), bool, int, float, str)
+    _BUILTINS_MODULE = 'builtins'
+else:
+    _TEXT_TYPES = (str, unicode)
+    _PRIMITIVE_TYPES = (type(None), bool, int, long, float, unicode)
+    _BUILTINS_MODULE = '__builtin__'
+_ROUTINE_TYPES = (types.FunctionType, types.BuiltinFunctionType,
+                  types.MethodType, type(len.__call__), type(str.join))
+_OBJECT_GETSTATE = getattr(object, '__getstate__', None)
+
+
+class JsonpickleSerializer(object):
+    """ Encodes with ``jsonpickle`` (``unpicklable=False``). """
+
+    def __init__(self, max_depth=None):
+        self.max_depth = max_depth
+
+    def encode(self, data):
+        return jsonpickle.encode(data, unpicklable=False,
+                                 max_depth=self.max_depth or
+                                           CONST.JSONPICKLE_DEPTH)
+
+
+class JsonSerializer(object):
+    """
+    Encodes with the standard ``json`` module after flattening the payload
+    the way ``jsonpickle`` does with ``unpicklable=False``: sequences become
+    lists, objects the dictionary of their attributes, classes
+    ``{"py/type": name}`` and anything ``max_depth`` levels deep (or already
+    being flattened further up, i.e. a cycle) its ``repr``.  Types
+    ``jsonpickle`` has special rules for (its handlers, e.g. ``datetime`` or
+    ``UUID``, C types without attributes, ``defaultdict``) are flattened by
+    ``jsonpickle`` itself.
+
+    The flattening function is looked up once per class and cached.
+    """
+
+    def __init__(self, max_depth=None):
+        self.max_depth = max_depth
+        self._flatteners = {} # class -> flattening function
+
+    def encode(self, data):
+        return json.dumps(self.flatten(data))
+
+    def flatten(self, obj):
+        return self._flatten(obj, 0, self.max_depth or CONST.JSONPICKLE_DEPTH,
+                             set())
+
+    def _flatten(self, obj, depth, max_depth, path):
+        if depth == max_depth:
+            return repr(obj)
+        cls = getattr(obj, '__class__', type(obj))
+        try:
+            flattener = self._flatteners[cls]
+        except KeyError:
+            flattener = self._flatteners[cls] = _get_flattener(cls)
+        return flattener(self, obj, depth, max_depth, path)
+
+
+def _flatten_primitive(serializer, obj, depth, max_depth, path):
+    return obj
+
+
+def _flatten_bytes(serializer, obj, depth, max_depth, path):
+    if not PY3:
+        try:
+            return obj.decode('utf-8')
+        except UnicodeDecodeError:
+            pass
+    return {'py/b64': base64.b64encode(obj).decode('ascii')}
+
+
+def _flatten_none(serializer, obj, depth, max_depth, path):
+    return None
+
+
+def _flatten_text(serializer, obj, depth, max_depth, path):
+    return _text(obj)
+
+
+def _flatten_type(serializer, obj, depth, max_depth, path):
+    module = getattr(obj, '__module__', None) or _BUILTINS_MODULE
+    if module == 'exceptions':
+        module = _BUILTINS_MODULE
+    return {'py/type': '%s.%s' % (module, obj.__name__)}
+
+
+def _flatten_sequence(serializer, obj, depth, max_depth, path):
+    if id(obj) in path:
+        return repr(obj)
+    path.add(id(obj))
+    try:
+        flatten = serializer._flatten
+        depth += 1
+        return [flatten(item, depth, max_depth, path) for item in obj]
+    finally:
+        path.discard(id(obj))
+
+
+def _flatten_dict(serializer, obj, depth, max_depth, path):
+    if id(obj) in path:
+        return repr(obj)
+    path.add(id(obj))
+    try:
+        return _flatten_items(serializer, obj, depth + 1, max_depth, path)
+    finally:
+        path.discard(id(obj))
+
+
+def _flatten_items(serializer, obj, depth, max_depth, path):
+    flatten = serializer._flatten
+    data = {}
+    for key, value in obj.items():
+        if key is None:
+            key = 'null'
+        elif not isinstance(key, _TEXT_TYPES):
+            key = repr(key)
+        data[key] = flatten(value, depth, max_depth, path)
+    return data
+
+
+def _flatten_getstate(serializer, obj, depth, max_depth, path):
+    if id(obj) in path:
+        return repr(obj)
+    path.add(id(obj))
+    try:
+        return serializer._flatten(obj.__getstate__(), depth + 1, max_depth,
+                                   path)
+    finally:
+        path.discard(id(obj))
+
+
+def _flatten_instance(serializer, obj, depth, max_depth, path):
+    if id(obj) in path:
+        return repr(obj)
+    path.add(id(obj))
+    try:
+        depth += 1
+        attrs = getattr(obj, '__dict__', None)
+        if attrs is not None:
+            return _flatten_items(serializer, attrs, depth, max_depth, path)
+        data = {}
+        for cls in type(obj).__mro__:
+            slots = cls.__dict__.get('__slots__', ())
+            if isinstance(slots, _TEXT_TYPES):
+                slots = (slots,)
+            for name in slots:
+                try:
+                    value = getattr(obj, name)
+                except AttributeError:
+                    continue
+                data[name] = serializer._flatten(value, depth, max_depth,
+                                                 path)
+        return data or None
+    finally:
+        path.discard(id(obj))
+
+
+def _flatten_jsonpickle(serializer, obj, depth, max_depth, path):
+    # types jsonpickle has its own rules for, e.g. handlers or __reduce__
+    pickler = jsonpickle.pickler.Pickler(unpicklable=False,
+                                         max_depth=max_depth - depth)
+    return pickler.flatten(obj, reset=True)
+
+
+def _has_attributes(cls):
+    # instances keep attributes in a __dict__ or in Python-defined slots
+    for base in cls.__mro__:
+        if base is not object and ('__dict__' in base.__dict__ or
+                                   '__slots__' in base.__dict__):
+            return True
+    return False
+
+
+def _text(obj):
+    if PY3:
+        return str(obj)
+    return unicode(obj)
+
+
+def _get_flattener(cls):
+    if issubclass(cls, _PRIMITIVE_TYPES) and cls in _PRIMITIVE_TYPES:
+        return _flatten_primitive
+    if issubclass(cls, bytes):
+        return _flatten_bytes
+    if issubclass(cls, (list, tuple, set, frozenset)) and \
+       cls in (list, tuple, set, frozenset):
+        return _flatten_sequence
+    if issubclass(cls, dict) and cls is dict:
+        return _flatten_dict
+    if issubclass(cls, type) or (not PY3 and cls is types.ClassType):
+        return _flatten_type
+    if issubclass(cls, _ROUTINE_TYPES):
+        return _flatten_none
+    if issubclass(cls, types.ModuleType):
+        return _flatten_text
+    if jsonpickle.handlers.get(cls) is not None:
+        return _flatten_jsonpickle
+    getstate = getattr(cls, '__getstate__', None)
+    if getstate is not None and \
+       getattr(getstate, '__func__', getstate) is not _OBJECT_GETSTATE and \
+       not issubclass(cls, BaseException):
+        return _flatten_getstate
+    if issubclass(cls, dict):
+        if issubclass(cls, collections.defaultdict):
+            return _flatten_jsonpickle # adds its default_factory
+        return _flatten_dict
+    if issubclass(cls, (list, tuple, set, frozenset)):
+        return _flatten_sequence
+    if issubclass(cls, _PRIMITIVE_TYPES):
+        return _flatten_primitive
+    if not _has_attributes(cls):
+        return _flatten_jsonpickle # C types, e.g. datetime or complex
+    return _flatten_instance
+
+
+SERIALIZERS = {
+    'jsonpickle': JsonpickleSerializer,
+    'json': JsonSerializer,
+}
+
+
+def get_serializer(serializer=None):
+    """
+    Returns a serializer engine: ``serializer`` itself if it is an engine,
+    an instance of the engine registered in ``SERIALIZERS`` under that name,
+    or of the ``SERIALIZER`` engine when None.
+    """
+    if serializer is None:
+        serializer = CONST.SERIALIZER
+    if not isinstance(serializer, _TEXT_TYPES):
+        return serializer
+    try:
+        return SERIALIZERS[serializer]()
+    except KeyError:
+        raise ValueError('unknown FirePython serializer %r' % serializer)
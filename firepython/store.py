@@ -0,0 +1,102 @@
+# -*- mode: python; coding: utf-8 -*-
+"""
+In-process store of FireLogger payloads waiting to be fetched by the client.
+"""
+
+import os
+import time
+import binascii
+
+try:
+    from collections import OrderedDict
+except ImportError: # Python 2.6
+    OrderedDict = None
+
+import firepython._const as CONST
+from firepython.handlers import threading_supported
+
+if threading_supported:
+    import threading
+
+__all__ = [
+    'PayloadStore',
+]
+
+
+class PayloadStore(object):
+    """
+    Keeps up to ``size`` payloads for ``ttl`` seconds under random tokens
+    (defaults are ``PAYLOAD_STORE_SIZE`` and ``PAYLOAD_STORE_TTL`` from
+    ``firepython._const``).  When full, the least recently stored payload
+    is dropped.  A payload can be popped only once.
+    """
+
+    def __init__(self, size=None, ttl=None):
+        self.size = size or CONST.PAYLOAD_STORE_SIZE
+        self.ttl = ttl or CONST.PAYLOAD_STORE_TTL
+        if OrderedDict is not None:
+            self._payloads = OrderedDict() # token -> (expires, payload)
+        else:
+            self._payloads = {}
+        if threading_supported:
+            self._lock = threading.Lock()
+        else:
+            self._lock = None
+
+    def put(self, payload):
+        """ Stores ``payload``, returns its token. """
+        token = binascii.hexlify(os.urandom(16))
+        if not isinstance(token, str):
+            token = token.decode('ascii') # Python 3
+        now = time.time()
+        self._acquire()
+        try:
+            self._expire(now)
+            while len(self._payloads) >= self.size:
+                self._pop_oldest()
+            self._payloads[token] = (now + self.ttl, payload)
+        finally:
+            self._release()
+        return token
+
+    def pop(self, token):
+        """ Removes and returns the payload of ``token``, None if gone. """
+        self._acquire()
+        try:
+            expires, payload = self._payloads.pop(token, (0, None))
+        finally:
+            self._release()
+        if expires < time.time():
+            return None
+        return payload
+
+    def __len__(self):
+        return len(self._payloads)
+
+    def _expire(self, now):
+        if OrderedDict is None:
+            for token, (expires, _) in list(self._payloads.items()):
+                if expires < now:
+                    del self._payloads[token]
+            return
+        # payloads are ordered by expiry since all share the same ttl
+        while self._payloads:
+            token = next(iter(self._payloads))
+            if self._payloads[token][0] >= now:
+                break
+            del self._payloads[token]
+
+    def _pop_oldest(self):
+        if OrderedDict is not None:
+            self._payloads.popitem(last=False)
+        else:
+            token = min(self._payloads, key=lambda t: self._payloads[t][0])
+            del self._payloads[token]
+
+    def _acquire(self):
+        if self._lock:
+            self._lock.acquire()
+
+    def _release(self):
+        if self._lock:
+            self._lock.release()
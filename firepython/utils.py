@@ -1,5 +1,6 @@
 # -*- mode: python; coding: utf-8 -*-
 import sys
+import zlib
 from firepython import __api_version__
 import firepython._const as CONST
 
@@ -9,6 +10,10 @@ __all__ = [
     'get_version_header',
     'get_auth_token',
     'get_auth_header',
+    'constant_time_compare',
+    'negotiate_encoding',
+    'parse_version_header',
+    'COMPRESSORS',
 ]
 
 try:
@@ -24,6 +29,11 @@ try:
 except ImportError:
     from md5 import md5
 
+try:
+    from hmac import compare_digest
+except ImportError: # Python < 2.7.7
+    compare_digest = None
+
 
 class TolerantJSONEncoder(json.JSONEncoder):
 
@@ -40,8 +50,70 @@ def get_version_header(version=__api_version__):
 
 
 def get_auth_token(password):
-    return md5(CONST.AUTHTOK_FORMAT % password).hexdigest()
+    token = CONST.AUTHTOK_FORMAT % password
+    if not isinstance(token, bytes): # Python 3
+        token = token.encode('utf-8')
+    return md5(token).hexdigest()
+
+
+def constant_time_compare(a, b):
+    """
+    Compares strings ``a`` and ``b`` in time independent of where they
+    differ, for comparing secrets.
+    """
+    if compare_digest is not None:
+        try:
+            return compare_digest(a, b)
+        except TypeError: # e.g. non-ASCII unicode strings
+            pass
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
 
 
 def get_auth_header(password):
     return (CONST.FIRELOGGER_AUTH_HEADER, get_auth_token(password))
+
+
+def _deflate(data):
+    compressor = zlib.compressobj(CONST.COMPRESSION_LEVEL, zlib.DEFLATED,
+                                  -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _zlib(data):
+    return zlib.compress(data, CONST.COMPRESSION_LEVEL)
+
+
+# payload encodings FirePython can produce (name -> compress function)
+COMPRESSORS = {
+    'deflate': _deflate, # raw deflate stream
+    'zlib': _zlib, # deflate stream with zlib header and checksum
+}
+
+
+def negotiate_encoding(header):
+    """
+    Picks the first payload encoding from the client's comma separated
+    list ``header`` that FirePython supports, or None for plain base64.
+    """
+    for encoding in header.split(','):
+        encoding = encoding.split(';')[0].strip().lower()
+        if encoding in COMPRESSORS:
+            return encoding
+    return None
+
+
+def parse_version_header(header):
+    """
+    Splits the client's version header ``version[;option...]`` into the
+    version and a set of (lowercase) options, e.g. ``'1.0; compact'`` gives
+    ``('1.0', set(['compact']))``.
+    """
+    parts = header.split(';')
+    options = set(option.strip().lower() for option in parts[1:])
+    options.discard('')
+    return parts[0].strip(), options
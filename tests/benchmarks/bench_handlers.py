@@ -0,0 +1,57 @@
+"""
+Per-record overhead of an idle ``ThreadBufferedHandler``.
+
+Run with::
+
+    python -m tests.benchmarks.bench_handlers
+"""
+import timeit
+import logging
+
+from firepython.handlers import ThreadBufferedHandler
+
+RECORDS = 100000
+REPEAT = 5
+
+
+def _logger(name):
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(_NullHandler())
+    return logger
+
+
+class _NullHandler(logging.Handler):
+
+    def emit(self, record):
+        pass
+
+
+def _measure(logger):
+    timer = timeit.Timer(lambda: logger.info('request %s done', 42))
+    return min(timer.repeat(REPEAT, RECORDS)) / RECORDS * 1e9
+
+
+def main():
+    no_handler = _logger('bench.no_handler')
+
+    detached = _logger('bench.detached')
+    ThreadBufferedHandler(detached)  # attaches itself only when started
+
+    gated = _logger('bench.gated')
+    gated.addHandler(ThreadBufferedHandler())
+
+    results = [
+        ('no FirePython handler', _measure(no_handler)),
+        ('idle handler (detached)', _measure(detached)),
+        ('idle handler (attached, gated)', _measure(gated)),
+    ]
+    base = results[0][1]
+    for name, ns in results:
+        print('%-32s %8.0f ns/record  %+6.1f%%' %
+              (name, ns, (ns - base) / base * 100))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""
+Record preparation time per request: one record at a time through
+``_prepare_log_record`` versus the batched ``_prepare_logs``.
+
+Run with::
+
+    python -m tests.benchmarks.bench_prepare
+"""
+import time
+import timeit
+import logging
+
+from firepython.middleware import FirePythonWSGI
+
+SIZES = (1000, 10000, 100000)
+REPEAT = 3
+
+
+def _records(count):
+    now = time.time()
+    records = []
+    for i in range(count):
+        record = logging.LogRecord('bench.prepare', logging.INFO, __file__,
+                                   42, 'item %d of %s', (i, 'order'), None)
+        record.created = now + i * 0.0005 # 2000 records per second
+        records.append(record)
+    return records
+
+
+def _measure(func):
+    return min(timeit.Timer(func).repeat(REPEAT, 1)) * 1000
+
+
+def main():
+    middleware = FirePythonWSGI(None)
+    for size in SIZES:
+        records = _records(size)
+        single = _measure(lambda: [middleware._prepare_log_record(record)
+                                   for record in records])
+        batched = _measure(lambda: middleware._prepare_logs(records, {}))
+        print('%7d records  one by one %9.1f ms  batched %9.1f ms  %5.2fx' %
+              (size, single, batched, single / batched))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+Time spent turning a cProfile profile into a ``gprof2dot.Profile``:
+``gprof2dot.PstatsParser`` over ``pstats.Stats`` versus the direct
+``firepython.profiling.cprofile_profile`` converter (second run, with
+function names cached).
+
+Run with::
+
+    python -m tests.benchmarks.bench_profile
+"""
+import json
+import timeit
+import cProfile
+
+import firepython.profiling as FP
+
+REPEAT = 5
+
+
+def _work():
+    data = [{'id': i, 'tags': ['a', 'b'], 'score': i * 0.5}
+            for i in range(2000)]
+    for i in range(20):
+        json.loads(json.dumps(data))
+        sorted(data, key=lambda item: -item['score'])
+
+
+def _pstats(profiler):
+    profiler.create_stats()
+    parser = FP.gprof2dot.PstatsParser(profiler)
+    parser.get_function_name = FP.function_name
+    return parser.parse()
+
+
+def main():
+    if FP.gprof2dot is None:
+        print('gprof2dot is not importable')
+        return
+    profiler = cProfile.Profile()
+    profiler.runcall(_work)
+    FP.cprofile_profile(profiler) # warm the function name cache
+    for name, convert in (('PstatsParser', _pstats),
+                          ('cprofile_profile', FP.cprofile_profile)):
+        timer = timeit.Timer(lambda: convert(profiler))
+        ms = min(timer.repeat(REPEAT, 1)) * 1000
+        print('%-20s %8.2f ms' % (name, ms))
+
+
+if __name__ == '__main__':
+    main()
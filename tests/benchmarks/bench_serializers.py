@@ -0,0 +1,85 @@
+"""
+Payload encoding time of the serializer engines.
+
+Record sets are prepared by ``_prepare_log_record`` of the middleware from
+real log records: plain messages, messages with arguments and exceptions
+with (deep) frame locals.
+
+Run with::
+
+    python -m tests.benchmarks.bench_serializers
+"""
+import sys
+import timeit
+import logging
+
+import firepython._const as CONST
+from firepython.middleware import FirePythonWSGI
+from firepython.serializers import SERIALIZERS
+
+RECORDS = 200
+REPEAT = 5
+
+
+class _Order(object):
+
+    def __init__(self, number):
+        self.number = number
+        self.items = [{'sku': 'A-%d' % i, 'qty': i, 'price': 9.99}
+                      for i in range(5)]
+        self.customer = {'name': u'J\xe9r\xf4me', 'tags': ('new', 'eu')}
+
+
+def _fail(order):
+    total = sum(item['qty'] for item in order.items)
+    raise ValueError('order %d has %d items' % (order.number, total))
+
+
+def _record(msg, args=(), exc_info=None):
+    return logging.LogRecord('bench.serializers', logging.INFO, __file__, 42,
+                             msg, args, exc_info)
+
+
+def _exc_record(i):
+    try:
+        _fail(_Order(i))
+    except ValueError:
+        return _record('failed to process order %d', (i,), sys.exc_info())
+
+
+def _record_sets():
+    return [
+        ('plain messages',
+         [_record('request handled') for i in range(RECORDS)]),
+        ('messages with args',
+         [_record('order %s: %r', (i, _Order(i).items)) for i in range(RECORDS)]),
+        ('exceptions',
+         [_exc_record(i) for i in range(RECORDS)]),
+    ]
+
+
+def _measure(middleware, logs):
+    timer = timeit.Timer(lambda: middleware._encode(logs))
+    return min(timer.repeat(REPEAT, 1)) * 1000
+
+
+def main():
+    middleware = FirePythonWSGI(None)
+    for deep_locals in (False, True):
+        CONST.DEEP_LOCALS = deep_locals
+        for name, records in _record_sets():
+            logs = [middleware._prepare_log_record(record)
+                    for record in records]
+            title = '%s%s' % (name, deep_locals and ' (deep locals)' or '')
+            results = []
+            for engine in sorted(SERIALIZERS, reverse=True): # jsonpickle first
+                middleware._serializer = SERIALIZERS[engine]()
+                results.append((engine, _measure(middleware, logs)))
+            base = results[0][1]
+            for engine, ms in results:
+                print('%-34s %-12s %8.2f ms  %5.2fx' %
+                      (title, engine, ms, base / ms))
+
+
+if __name__ == '__main__':
+    main()
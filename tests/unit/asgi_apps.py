@@ -0,0 +1,40 @@
+"""
+ASGI helpers for ``test_asgi``.  Kept out of ``test_asgi`` because
+they need ``async`` syntax.
+"""
+
+import asyncio
+
+
+def get_interleaving_app(log, steps):
+    """
+    Returns an application logging ``steps`` records, each followed by a
+    switch to the other tasks, before it starts the response.
+    """
+    async def app(scope, receive, send):
+        for step in range(steps):
+            log.info('%s %d', scope['path'], step)
+            await asyncio.sleep(0)
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/plain')]})
+    return app
+
+
+def get_working_app(works, steps):
+    """
+    Returns an application calling ``works[path]`` ``steps`` times, each
+    call followed by a switch to the other tasks, before it starts the
+    response.
+    """
+    async def app(scope, receive, send):
+        for step in range(steps):
+            works[scope['path']]()
+            await asyncio.sleep(0)
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/plain')]})
+    return app
+
+
+async def gather(*requests):
+    """ ``asyncio.gather`` called from within the running loop. """
+    return await asyncio.gather(*requests)
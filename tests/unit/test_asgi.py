@@ -0,0 +1,147 @@
+import sys
+import json
+import base64
+import logging
+
+from nose import SkipTest
+import nose.tools as NT
+
+import firepython as FPY
+import firepython.utils as FU
+
+if sys.version_info >= (3, 7):
+    import asyncio
+    import firepython.asgi as FA
+    from tests.unit import asgi_apps
+else:
+    FA = None
+
+LOGGER_NAME = 'test_asgi'
+
+
+def get_app():
+    log = logging.getLogger(LOGGER_NAME)
+    log.setLevel(logging.INFO)
+
+    def app(scope, receive, send):
+        log.info(scope['path'])
+        return send({'type': 'http.response.start', 'status': 200,
+                     'headers': [(b'content-type', b'text/plain')]})
+    return FA.FirePythonASGI(app, password='snarf', logger_name=LOGGER_NAME)
+
+
+def get_scope(path, enabled=True):
+    headers = []
+    if enabled:
+        headers = [
+            (b'x-firelogger', FPY.__api_version__.encode('ascii')),
+            (b'x-fireloggerauth', FU.get_auth_token('snarf').encode('ascii')),
+        ]
+    return {'type': 'http', 'path': path, 'headers': headers}
+
+
+def call(app, scope):
+    sent = []
+
+    def send(message):
+        sent.append(message)
+        return asyncio.sleep(0)
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(app(scope, None, send))
+    finally:
+        loop.close()
+    return sent
+
+
+def decode_logs(headers):
+    chunks = sorted((int(name.decode('latin-1').rsplit('-', 1)[1]), value)
+                    for name, value in headers
+                    if name.startswith(b'firelogger-'))
+    data = base64.b64decode(b''.join(value for _, value in chunks))
+    return json.loads(data.decode('utf-8'))['logs']
+
+
+def test_asgi_middleware_adds_logs_to_response_start():
+    if FA is None:
+        raise SkipTest('ASGI middleware requires Python 3.7+')
+    app = get_app()
+
+    plain = call(app, get_scope('/plain', enabled=False))
+    NT.assert_equal([(b'content-type', b'text/plain')], plain[0]['headers'])
+
+    sent = call(app, get_scope('/logged'))
+    logs = decode_logs(sent[0]['headers'])
+    NT.assert_equal(['/logged'], [log['message'] for log in logs])
+    NT.assert_false(app._handler.is_active())
+
+
+def test_asgi_concurrent_requests_do_not_share_records():
+    if FA is None:
+        raise SkipTest('ASGI middleware requires Python 3.7+')
+    log = logging.getLogger(LOGGER_NAME)
+    log.setLevel(logging.INFO)
+    app = FA.FirePythonASGI(asgi_apps.get_interleaving_app(log, 3),
+                            password='snarf', logger_name=LOGGER_NAME)
+    paths = ['/%d' % i for i in range(20)]
+    sent = dict((path, []) for path in paths)
+
+    def request(path):
+        def send(message):
+            sent[path].append(message)
+            return asyncio.sleep(0)
+        return app(get_scope(path, enabled=path != '/0'), None, send)
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(
+            asgi_apps.gather(*[request(path) for path in paths]))
+    finally:
+        loop.close()
+    NT.assert_equal([(b'content-type', b'text/plain')],
+                    sent['/0'][0]['headers'])
+    for path in paths[1:]:
+        logs = decode_logs(sent[path][0]['headers'])
+        NT.assert_equal(['%s %d' % (path, step) for step in range(3)],
+                        [log['message'] for log in logs])
+    NT.assert_false(app._handler.is_active())
+
+
+def profiled_work():
+    pass
+
+
+def other_work():
+    pass
+
+
+def test_asgi_profile_leaves_out_concurrent_requests():
+    if FA is None:
+        raise SkipTest('ASGI middleware requires Python 3.7+')
+    works = {'/profiled': profiled_work, '/other': other_work}
+    app = FA.FirePythonASGI(asgi_apps.get_working_app(works, 5),
+                            password='snarf', logger_name=LOGGER_NAME)
+    profiled = []
+    start_profiler = app._start_profiler
+    def record_profiler(request):
+        start_profiler(request)
+        profiled.append(request)
+    app._start_profiler = record_profiler
+
+    def send(message):
+        return asyncio.sleep(0)
+
+    scope = get_scope('/profiled')
+    scope['headers'].append((b'x-fireloggerprofiler', b'1'))
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(asgi_apps.gather(
+            app(scope, None, send), app(get_scope('/other'), None, send)))
+    finally:
+        loop.close()
+    import pstats
+    calls = dict((key[2], stats[1]) for key, stats in
+                 pstats.Stats(profiled[0].profiler).stats.items())
+    NT.assert_equal(5, calls.get('profiled_work'))
+    NT.assert_false('other_work' in calls)
@@ -6,6 +6,12 @@ IMPORT_MODS = [
     'firepython.utils',
     'firepython.middleware',
     'firepython.handlers',
+    'firepython.frames',
+    'firepython.compact',
+    'firepython.levels',
+    'firepython.serializers',
+    'firepython.store',
+    'firepython.profiling',
     'firepython._const',
     'firepython._setup_common',
     'firepython.demo',
@@ -0,0 +1,50 @@
+import nose.tools as NT
+
+from firepython.compact import LEVELS, compact_logs
+
+
+def expand(compact):
+    """ Rebuilds log entries from the compact layout, as a client would. """
+    columns = compact['columns']
+    strings = compact['strings']
+    logs = []
+    timestamp = 0
+    for i in range(compact['count']):
+        timestamp += columns['timestamp'][i]
+        log = {'level': LEVELS[columns['level'][i]], 'timestamp': timestamp}
+        for name, values in columns.items():
+            if name in ('level', 'timestamp') or values[i] is None:
+                continue
+            if name in ('pathname', 'name', 'threadName', 'template'):
+                log[name] = strings[values[i]]
+            else:
+                log[name] = values[i]
+        logs.append(log)
+    for i, others in compact['extra']:
+        logs[i].update(others)
+    return logs
+
+
+def get_log(i, **kwargs):
+    log = {'level': 'info', 'message': 'item %d' % i, 'template': 'item %d',
+           'timestamp': 1000000 + i * 250, 'time': '10:00:00.000',
+           'args': [i], 'pathname': '/srv/app/views.py', 'lineno': 42,
+           'name': 'app.views', 'process': 1, 'thread': 2,
+           'threadName': 'MainThread', 'exc_text': None}
+    log.update(kwargs)
+    return log
+
+
+def test_compact_logs_round_trip():
+    logs = [get_log(i) for i in range(5)]
+    logs.append(get_log(5, level='error', exc_info=['x', {}, []],
+                        template=object()))
+    compact = compact_logs(logs)
+    NT.assert_equal(['/srv/app/views.py', 'app.views', 'MainThread',
+                     'item %d'], compact['strings'])
+    NT.assert_equal([1000000, 250, 250, 250, 250, 250],
+                    compact['columns']['timestamp'])
+    NT.assert_equal([1, 1, 1, 1, 1, 3], compact['columns']['level'])
+    for log in logs:
+        del log['time'], log['exc_text']
+    NT.assert_equal(logs, expand(compact))
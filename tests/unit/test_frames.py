@@ -0,0 +1,76 @@
+import sys
+
+import nose.tools as NT
+
+import firepython._const as CONST
+import firepython.frames as FF
+
+
+class Node(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.children = []
+
+
+def fail(depth, value):
+    if depth > 1:
+        fail(depth - 1, value)
+    raise ValueError('boom')
+
+
+def get_traceback(depth, value=None):
+    try:
+        fail(depth, value)
+    except ValueError:
+        return sys.exc_info()[2]
+
+
+def test_locals_are_bounded():
+    value = {'text': 'x' * 1000, 'items': list(range(100))}
+    frame = FF.capture_locals(get_traceback(1, value), deep=True)[-1]
+    NT.assert_equal(CONST.FRAME_REPR_LENGTH, len(frame['value']['text']))
+    NT.assert_equal(list(range(CONST.FRAME_MAX_ITEMS)) + ['... 80 more'],
+                    frame['value']['items'])
+
+    max_locals = CONST.FRAME_MAX_LOCALS
+    CONST.FRAME_MAX_LOCALS = 1
+    try:
+        frame = FF.capture_locals(get_traceback(1, value))[-1]
+    finally:
+        CONST.FRAME_MAX_LOCALS = max_locals
+    NT.assert_equal(['...', 'depth'], sorted(frame))
+    NT.assert_equal('1 more', frame['...'])
+
+
+def test_cycles_end_as_repr():
+    root = Node('root')
+    root.children.append(root)
+    frame = FF.capture_locals(get_traceback(1, root), deep=True)[-1]
+    NT.assert_equal('root', frame['value']['name'])
+    NT.assert_true(frame['value']['children'][0].startswith('<'))
+
+    frame = FF.capture_locals(get_traceback(1, root), deep=False)[-1]
+    NT.assert_true(frame['value'].startswith('<'))
+
+
+def test_only_innermost_frames_are_captured():
+    frames = FF.capture_locals(get_traceback(CONST.FRAME_MAX_FRAMES + 5))
+    NT.assert_equal(CONST.FRAME_MAX_FRAMES + 6, len(frames))
+    NT.assert_equal([{}] * 6, frames[:6])
+    NT.assert_true(all(frames[6:]))
+
+
+def test_fingerprint_depends_on_type_and_locations():
+    tbs = [get_traceback(1), get_traceback(1), get_traceback(2)]
+    prints = [FF.fingerprint(ValueError, tb) for tb in tbs]
+    NT.assert_equal(prints[0], prints[1])
+    NT.assert_not_equal(prints[0], prints[2])
+    NT.assert_not_equal(prints[0], FF.fingerprint(KeyError, tbs[0]))
+
+
+def test_extract_tb_matches_traceback_module():
+    import traceback
+    tb = get_traceback(3)
+    NT.assert_equal([tuple(entry) for entry in traceback.extract_tb(tb)],
+                    FF.extract_tb(tb))
@@ -0,0 +1,169 @@
+import gc
+import logging
+import weakref
+import threading
+
+import nose.tools as NT
+
+from firepython.handlers import ThreadBufferedHandler, RecordSnapshot, \
+    _BoundedRecords, KEEP_FIRST, KEEP_LAST, KEEP_FIRST_AND_LAST, LEVEL_PRIORITY
+
+
+def get_logger(name):
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    return logger
+
+
+def test_handler_is_attached_only_while_active():
+    logger = get_logger('test_handlers.attach')
+    handler = ThreadBufferedHandler(logger)
+    NT.assert_false(handler in logger.handlers)
+    NT.assert_false(handler.is_active())
+
+    handler.start()
+    handler.start()  # starting twice on one thread counts once
+    NT.assert_true(handler in logger.handlers)
+    NT.assert_true(handler.is_active())
+
+    handler.finish()
+    NT.assert_false(handler in logger.handlers)
+    NT.assert_false(handler.is_active())
+
+
+def test_idle_handler_ignores_records():
+    logger = get_logger('test_handlers.idle')
+    handler = ThreadBufferedHandler()
+    logger.addHandler(handler)
+    try:
+        logger.info('not buffered')
+        NT.assert_equal([], handler.get_records())
+
+        handler.start()
+        logger.info('buffered')
+        handler.finish()
+        NT.assert_equal(['buffered'],
+                        [r.getMessage() for r in handler.get_records()])
+    finally:
+        logger.removeHandler(handler)
+
+
+def test_discard_drops_the_buffer():
+    logger = get_logger('test_handlers.discard')
+    handler = ThreadBufferedHandler(logger)
+    handler.start()
+    logger.info('buffered')
+    handler.discard()
+    NT.assert_equal([], handler.get_records())
+    NT.assert_false(handler.is_enabled())
+    NT.assert_false(handler in logger.handlers)
+
+
+def test_buffers_are_not_shared_between_threads():
+    logger = get_logger('test_handlers.threads')
+    handler = ThreadBufferedHandler(logger)
+    seen = {}
+
+    def run(name):
+        handler.start()
+        logger.info(name)
+        seen[name] = [r.getMessage() for r in handler.get_records()]
+        handler.discard()
+
+    threads = [threading.Thread(target=run, args=('t%d' % i,))
+               for i in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for name, messages in seen.items():
+        NT.assert_equal([name], messages)
+    NT.assert_false(handler.is_active())
+
+
+def test_reap_reclaims_buffers_of_dead_threads():
+    logger = get_logger('test_handlers.reap')
+    handler = ThreadBufferedHandler(logger)
+    t = threading.Thread(target=handler.start)
+    t.start()
+    t.join()
+    NT.assert_true(handler.is_active())
+    NT.assert_equal(1, handler.reap())
+    NT.assert_false(handler.is_active())
+    NT.assert_false(handler in logger.handlers)
+
+
+def make_records(levels):
+    return [logging.LogRecord('bounded', level, __file__, 1, str(i), (), None)
+            for i, level in enumerate(levels)]
+
+
+def kept(policy, levels, size=4):
+    records = _BoundedRecords(size, policy)
+    for record in make_records(levels):
+        records.append(record)
+    return [int(r.msg) for r in records], records.dropped
+
+
+def test_bounded_records_overflow_policies():
+    levels = [logging.INFO] * 10
+    NT.assert_equal(([0, 1, 2, 3], {logging.INFO: 6}),
+                    kept(KEEP_FIRST, levels))
+    NT.assert_equal(([6, 7, 8, 9], {logging.INFO: 6}),
+                    kept(KEEP_LAST, levels))
+    NT.assert_equal(([0, 1, 8, 9], {logging.INFO: 6}),
+                    kept(KEEP_FIRST_AND_LAST, levels))
+
+
+def test_level_priority_never_drops_warnings():
+    D, W = logging.DEBUG, logging.WARNING
+    levels = [W, D, D, W, D, D, W, W, W, D]
+    NT.assert_equal(([0, 3, 6, 7, 8], {D: 5}),
+                    kept(LEVEL_PRIORITY, levels))
+
+
+def test_handler_reports_dropped_records():
+    logger = get_logger('test_handlers.dropped')
+    handler = ThreadBufferedHandler(logger, max_records=2)
+    handler.start()
+    for i in range(5):
+        logger.debug('%d', i)
+    handler.finish()
+    NT.assert_equal(['3', '4'],
+                    [r.getMessage() for r in handler.get_records()])
+    NT.assert_equal({logging.DEBUG: 3}, handler.get_dropped())
+    handler.discard()
+
+
+class Payload(object):
+    pass
+
+
+def test_snapshots_do_not_keep_frames_alive():
+    logger = get_logger('test_handlers.snapshot')
+    handler = ThreadBufferedHandler(logger, snapshot=True)
+    handler.start()
+
+    def fail():
+        payload = Payload()
+        payload.size = 42
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            logger.exception('failed %s', 'here')
+        return weakref.ref(payload)
+
+    payload = fail()
+    gc.collect()
+    handler.finish()
+    NT.assert_equal(None, payload())
+
+    record, = handler.get_records()
+    NT.assert_true(isinstance(record, RecordSnapshot))
+    NT.assert_equal('failed here', record.message.splitlines()[0])
+    exc_type, exc_value, tb = record.exc_info
+    NT.assert_equal(ValueError, exc_type)
+    NT.assert_equal('fail', tb[-1][2])
+    NT.assert_equal({'size': 42}, record.exc_frames[-1]['payload'])
+    handler.discard()
@@ -0,0 +1,69 @@
+import logging
+import threading
+
+import nose.tools as NT
+
+import firepython.levels as FL
+
+
+def test_parse_level_spec():
+    yield NT.assert_equal, (logging.DEBUG, ()), FL.parse_level_spec('debug')
+    yield NT.assert_equal, (5, ()), FL.parse_level_spec('5')
+    yield NT.assert_equal, (logging.INFO, ('app', 'lib.db')), \
+        FL.parse_level_spec('INFO:app, lib.db')
+    yield NT.assert_raises, ValueError, FL.parse_level_spec, 'chatty'
+
+
+def test_override_is_local_to_the_request():
+    app = logging.getLogger('test_levels.app')
+    app.setLevel(logging.INFO)
+    other = logging.getLogger('test_levels.other')
+    other.setLevel(logging.INFO)
+    seen_elsewhere = []
+
+    FL.set_override(logging.DEBUG, ('test_levels.app',))
+    try:
+        NT.assert_true(app.isEnabledFor(logging.DEBUG))
+        NT.assert_false(other.isEnabledFor(logging.DEBUG))
+        t = threading.Thread(
+            target=lambda: seen_elsewhere.append(app.isEnabledFor(logging.DEBUG)))
+        t.start()
+        t.join()
+        NT.assert_equal([False], seen_elsewhere)
+    finally:
+        FL.clear_override()
+    NT.assert_false(app.isEnabledFor(logging.DEBUG))
+    NT.assert_true(
+        logging.Logger.__dict__['isEnabledFor'] is FL._original_is_enabled_for)
+
+
+class RecordingHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def test_override_records_reach_only_its_handlers():
+    parent = logging.getLogger('test_levels.handlers')
+    parent.setLevel(logging.INFO)
+    app = logging.getLogger('test_levels.handlers.app')
+    chosen = RecordingHandler()
+    other = RecordingHandler()
+    parent.addHandler(chosen)
+    parent.addHandler(other)
+    FL.set_override(logging.DEBUG, handlers=(chosen,))
+    try:
+        app.debug('debug')
+        app.info('info')
+    finally:
+        FL.clear_override()
+        parent.removeHandler(chosen)
+        parent.removeHandler(other)
+    NT.assert_equal(['debug', 'info'], chosen.messages)
+    NT.assert_equal(['info'], other.messages)
+    NT.assert_true(
+        logging.Logger.__dict__['callHandlers'] is FL._original_call_handlers)
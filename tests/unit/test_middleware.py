@@ -0,0 +1,751 @@
+import json
+import time
+import zlib
+import base64
+import logging
+import threading
+import traceback
+
+import nose.tools as NT
+from nose import SkipTest
+
+import firepython as FPY
+import firepython.utils as FU
+import firepython.levels as FL
+import firepython._const as FC
+import firepython.middleware as FM
+import firepython.profiling as FPR
+
+LOGGER_NAME = 'test_middleware'
+
+
+def get_env(enabled=True):
+    env = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/'}
+    if enabled:
+        env[FC.FIRELOGGER_VERSION_HEADER] = FPY.__api_version__
+        env[FC.FIRELOGGER_AUTH_HEADER] = FU.get_auth_token('snarf')
+    return env
+
+
+def call(app, env):
+    """ Runs a WSGI ``app``, returns (headers, body chunks). """
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['headers'] = headers
+        return response.setdefault('written', []).append
+
+    app_iter = app(env, start_response)
+    try:
+        chunks = list(app_iter)
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+    return response['headers'], response.get('written', []) + chunks
+
+
+def decode_payload(headers):
+    chunks = sorted((int(name.rsplit('-', 1)[1]), value)
+                    for name, value in headers
+                    if name.startswith('FireLogger-'))
+    data = base64.b64decode(''.join(value for _, value in chunks))
+    encoding = dict(headers).get(
+        FC.FIRELOGGER_ENCODING_RESPONSE_HEADER % dict(guid=get_guid(headers)))
+    if encoding == 'deflate':
+        data = zlib.decompress(data, -zlib.MAX_WBITS)
+    elif encoding == 'zlib':
+        data = zlib.decompress(data)
+    return json.loads(data.decode('utf-8'))
+
+
+def get_guid(headers):
+    for name, value in headers:
+        if name.startswith('FireLogger-'):
+            return name.split('-')[1]
+
+
+def decode_logs(headers):
+    return decode_payload(headers)['logs']
+
+
+def streaming_app(environ, start_response):
+    log = logging.getLogger(LOGGER_NAME)
+    log.info('before body')
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    yield 'first'
+    log.info('after first chunk')
+    yield 'second'
+
+
+def get_middleware(app, **kwargs):
+    logging.getLogger(LOGGER_NAME).setLevel(logging.INFO)
+    return FM.FirePythonWSGI(app, password='snarf', logger_name=LOGGER_NAME,
+                             **kwargs)
+
+
+def test_buffered_response_carries_all_records():
+    app = get_middleware(streaming_app)
+    headers, body = call(app, get_env())
+    NT.assert_equal(['first', 'second'], body)
+    NT.assert_equal(['before body', 'after first chunk'],
+                    [log['message'] for log in decode_logs(headers)])
+
+
+def test_streamed_response_sends_headers_with_first_chunk():
+    app = get_middleware(streaming_app, stream_threshold=0)
+    headers, body = call(app, get_env())
+    NT.assert_equal(['first', 'second'], body)
+    NT.assert_equal(['before body'],
+                    [log['message'] for log in decode_logs(headers)])
+    NT.assert_false(app._handler.is_active())
+
+
+def test_streamed_response_holds_back_threshold_bytes():
+    app = get_middleware(streaming_app, stream_threshold=100)
+    headers, body = call(app, get_env())
+    NT.assert_equal(['first', 'second'], body)
+    NT.assert_equal(['before body', 'after first chunk'],
+                    [log['message'] for log in decode_logs(headers)])
+
+
+class RecordingHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def test_streamed_response_closed_early_logs_no_error():
+    app = get_middleware(streaming_app, stream_threshold=0)
+    recording = RecordingHandler()
+    logging.getLogger().addHandler(recording)
+    try:
+        app_iter = app(get_env(), lambda status, headers, exc_info=None: None)
+        chunks = iter(app_iter)
+        NT.assert_equal('first', next(chunks))
+        chunks.close() # the client disconnected
+        app_iter.close()
+    finally:
+        logging.getLogger().removeHandler(recording)
+    NT.assert_equal([], [r for r in recording.records
+                         if r.levelno >= logging.ERROR])
+
+
+def test_level_header_lowers_the_level_of_its_request_only():
+    log = logging.getLogger(LOGGER_NAME)
+
+    def app(environ, start_response):
+        log.debug('debug')
+        log.info('info')
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ['ok']
+
+    app = get_middleware(app)
+    recording = RecordingHandler()
+    log.addHandler(recording)
+    try:
+        env = get_env()
+        env[FC.FIRELOGGER_LEVEL_HEADER] = 'debug:' + LOGGER_NAME
+        headers, _ = call(app, env)
+        NT.assert_equal(['debug', 'info'],
+                        [l['message'] for l in decode_logs(headers)])
+        headers, _ = call(app, get_env())
+        NT.assert_equal(['info'], [l['message'] for l in decode_logs(headers)])
+    finally:
+        log.removeHandler(recording)
+    NT.assert_equal(['info', 'info'],
+                    [r.getMessage() for r in recording.records])
+    NT.assert_false(log.isEnabledFor(logging.DEBUG))
+    NT.assert_true(logging.Logger.__dict__['isEnabledFor'] is
+                   FL._original_is_enabled_for)
+
+
+def test_concurrent_requests_do_not_share_state():
+    log = logging.getLogger(LOGGER_NAME)
+
+    def app(environ, start_response):
+        log.info(environ['PATH_INFO'])
+        time.sleep(0.001)
+        log.info(environ['PATH_INFO'])
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [environ['PATH_INFO']]
+
+    app = get_middleware(app)
+    failures = []
+    completed = []
+
+    def worker(n):
+        for i in range(20):
+            env = get_env()
+            env['PATH_INFO'] = path = '/%d/%d' % (n, i)
+            try:
+                profiled = bool(FM.gprof2dot) and (n + i) % 2 == 0
+                if profiled:
+                    env[FC.FIRELOGGER_PROFILER_ENABLED_HEADER] = 'yes'
+                headers, body = call(app, env)
+                payload = decode_payload(headers)
+                if ([log['message'] for log in payload['logs']] !=
+                    [path, path] or ('profile' in payload) != profiled or
+                    body != [path]):
+                    failures.append(path)
+            except Exception:
+                failures.append(traceback.format_exc())
+            completed.append(path)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    NT.assert_equal([], failures)
+    NT.assert_equal(160, len(completed))
+    NT.assert_false(app._handler.is_active())
+
+
+def test_compressed_payload_is_negotiated():
+    logging.getLogger(LOGGER_NAME).setLevel(logging.INFO)
+
+    def app(environ, start_response):
+        for i in range(50):
+            logging.getLogger(LOGGER_NAME).info('the same line again')
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ['done']
+
+    app = get_middleware(app)
+    plain_headers, _ = call(app, get_env())
+    for encoding in ('deflate', 'zlib'):
+        env = get_env()
+        env[FC.FIRELOGGER_ENCODING_HEADER] = 'br, ' + encoding
+        headers, _ = call(app, env)
+        NT.assert_equal(50, len(decode_logs(headers)))
+        NT.assert_true(len(headers) * 2 < len(plain_headers))
+
+
+def test_payload_is_trimmed_to_budget():
+
+    def app(environ, start_response):
+        for i in range(40):
+            logging.getLogger(LOGGER_NAME).debug('debug line %s', 'x' * 100)
+        try:
+            big = ['y' * 100] * 50
+            raise ValueError('boom')
+        except ValueError:
+            logging.getLogger(LOGGER_NAME).exception('failed with %r',
+                                                     ['z' * 100] * 20)
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ['done']
+
+    app = get_middleware(app)
+    logging.getLogger(LOGGER_NAME).setLevel(logging.DEBUG)
+    headers, _ = call(app, get_env())
+    NT.assert_equal(41, len(decode_logs(headers)))
+
+    FC.MAX_PAYLOAD_SIZE = 8000
+    try:
+        headers, _ = call(app, get_env())
+    finally:
+        FC.MAX_PAYLOAD_SIZE = None
+    NT.assert_true(sum(len(n) + len(v) + 4 for n, v in headers) <= 8000)
+    logs = decode_logs(headers)
+    NT.assert_equal(['error', 'warning'], [log['level'] for log in logs])
+    NT.assert_false('exc_frames' in logs[0])
+    NT.assert_false('args' in logs[0])
+    NT.assert_true('40 debug records' in logs[1]['message'])
+
+
+def test_profile_is_trimmed_before_warnings():
+    app = get_middleware(streaming_app)
+    logs = [app._prepare_log_record(logging.LogRecord(
+        LOGGER_NAME, level, __file__, 0, 'line %d', (i,), None))
+        for i, level in enumerate([logging.INFO, logging.WARNING] * 5)]
+    profile = {'dot': 'digraph { %s }' % ('x' * 20000)}
+    FC.MAX_PAYLOAD_SIZE = 8000
+    try:
+        chunks = app._encode_within_budget('0' * 8, logs, [], profile, {},
+                                           {}, None)
+    finally:
+        FC.MAX_PAYLOAD_SIZE = None
+    NT.assert_true(app._payload_size('0' * 8, chunks) <= 8000)
+    data = json.loads(base64.b64decode(''.join(chunks)).decode('utf-8'))
+    NT.assert_false('profile' in data)
+    NT.assert_equal(['warning'] * 6, [log['level'] for log in data['logs']])
+    NT.assert_true('5 info records, the profile' in data['logs'][-1]['message'])
+
+
+def test_payload_fits_when_extension_data_does_not():
+
+    def app(environ, start_response):
+        environ['firepython.set_extension_data']('big', 'x' * 20000)
+        logging.getLogger(LOGGER_NAME).warning('warning')
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ['done']
+
+    for incremental in (False, True):
+        FC.INCREMENTAL_ENCODING = incremental
+        try:
+            middleware = get_middleware(app)
+        finally:
+            FC.INCREMENTAL_ENCODING = False
+        FC.MAX_PAYLOAD_SIZE = 8000
+        try:
+            headers, _ = call(middleware, get_env())
+        finally:
+            FC.MAX_PAYLOAD_SIZE = None
+        NT.assert_true(sum(len(n) + len(v) + 4 for n, v in headers) <= 8000)
+        data = decode_payload(headers)
+        NT.assert_false('extension_data' in data)
+        NT.assert_equal(1, len(data['logs']))
+        NT.assert_true('internal errors and extension data' in
+                       data['logs'][0]['message'])
+
+        FC.MAX_PAYLOAD_SIZE = 100 # not even the summary fits
+        try:
+            headers, _ = call(middleware, get_env())
+        finally:
+            FC.MAX_PAYLOAD_SIZE = None
+        NT.assert_false([n for n, _ in headers
+                         if n.startswith('FireLogger-')])
+        NT.assert_true('does not fit' in
+                       dict(headers)[FC.FIRELOGGER_MESSAGE_HEADER])
+
+
+def test_payload_is_fetched_by_token():
+    app = get_middleware(streaming_app, payload_path='/_firelogger/')
+    headers, body = call(app, get_env())
+    NT.assert_equal(['first', 'second'], body)
+    NT.assert_false([name for name, _ in headers
+                     if name.startswith('FireLogger-')])
+    token = dict(headers)[FC.FIRELOGGER_TOKEN_RESPONSE_HEADER]
+
+    def fetch(env):
+        status = []
+        env['PATH_INFO'] = '/_firelogger/' + token
+        body = app(env, lambda s, h, exc_info=None: status.append(s))
+        return status[0], b''.join(body)
+
+    NT.assert_equal('403 Forbidden', fetch(get_env(enabled=False))[0])
+    status, body = fetch(get_env())
+    NT.assert_equal('200 OK', status)
+    NT.assert_equal(['before body', 'after first chunk'],
+                    [log['message'] for log in
+                     json.loads(body.decode('utf-8'))['logs']])
+    NT.assert_equal('404 Not Found', fetch(get_env())[0])
+
+
+def test_snapshot_records_give_the_same_payload():
+
+    def app(environ, start_response):
+        try:
+            answer = 42
+            raise ValueError('boom')
+        except ValueError:
+            logging.getLogger(LOGGER_NAME).exception('failed %s', 'here')
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ['done']
+
+    app = get_middleware(app)
+    logs = []
+    for snapshot in (False, True):
+        FC.SNAPSHOT_RECORDS = snapshot
+        try:
+            headers, _ = call(app, get_env())
+        finally:
+            FC.SNAPSHOT_RECORDS = False
+        log, = decode_logs(headers)
+        log['exc_frames'] = [sorted(frame) for frame in log['exc_frames']]
+        logs.append(dict((key, log[key]) for key in
+                         ('message', 'args', 'exc_info', 'exc_frames')))
+    NT.assert_equal(logs[0], logs[1])
+
+
+def test_repeated_exceptions_are_captured_once():
+
+    def app(environ, start_response):
+        for i in range(10):
+            try:
+                raise ValueError('boom')
+            except ValueError:
+                logging.getLogger(LOGGER_NAME).exception('failed %d', i)
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ['done']
+
+    app = get_middleware(app)
+    for snapshot in (False, True):
+        FC.SNAPSHOT_RECORDS = snapshot
+        try:
+            headers, _ = call(app, get_env())
+        finally:
+            FC.SNAPSHOT_RECORDS = False
+        logs = decode_logs(headers)
+        NT.assert_equal(1, len(set(log['exc_fingerprint'] for log in logs)))
+        full = [log for log in logs if 'exc_info' in log]
+        NT.assert_equal(FC.EXCEPTION_CAPTURES, len(full))
+        NT.assert_equal(10, full[0]['exc_count'])
+        NT.assert_equal('failed 9', logs[-1]['message'])
+
+
+def test_repeated_templates_are_aggregated():
+
+    def app(environ, start_response):
+        log = logging.getLogger(LOGGER_NAME)
+        log.info('start')
+        for i in range(100):
+            log.info('item %d', i)
+        log.warning('item %d', 100)
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ['done']
+
+    app = get_middleware(app)
+    FC.AGGREGATE_THRESHOLD = 10
+    try:
+        headers, _ = call(app, get_env())
+    finally:
+        FC.AGGREGATE_THRESHOLD = None
+    logs = decode_logs(headers)
+    NT.assert_equal(['start', 'item 0 (100 times)', 'item 100'],
+                    [log['message'] for log in logs])
+    NT.assert_equal(100, logs[1]['count'])
+    NT.assert_equal([[i] for i in range(FC.AGGREGATE_SAMPLES)],
+                    logs[1]['args_samples'])
+    NT.assert_true(logs[1]['last_timestamp'] >= logs[1]['timestamp'])
+
+
+def test_compact_payload_is_negotiated():
+
+    def app(environ, start_response):
+        for i in range(50):
+            logging.getLogger(LOGGER_NAME).info('item %d', i)
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ['done']
+
+    app = get_middleware(app)
+    plain_headers, _ = call(app, get_env())
+    env = get_env()
+    env[FC.FIRELOGGER_VERSION_HEADER] += '; compact'
+    headers, _ = call(app, env)
+    payload = decode_payload(headers)
+    NT.assert_equal('compact', payload['format'])
+    NT.assert_equal(50, payload['logs']['count'])
+    NT.assert_equal(['item %d' % i for i in range(50)],
+                    payload['logs']['columns']['message'])
+    NT.assert_true(len(headers) * 2 < len(plain_headers))
+
+
+def test_incremental_encoding_gives_the_same_logs():
+
+    def app(environ, start_response):
+        for i in range(3):
+            logging.getLogger(LOGGER_NAME).info('item %d', i)
+            try:
+                raise ValueError('boom')
+            except ValueError:
+                logging.getLogger(LOGGER_NAME).exception('failed')
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        environ['firepython.set_extension_data']('answer', 42)
+        return ['done']
+
+    payloads = []
+    for incremental in (False, True):
+        FC.INCREMENTAL_ENCODING = incremental
+        try:
+            middleware = get_middleware(app)
+        finally:
+            FC.INCREMENTAL_ENCODING = False
+        headers, _ = call(middleware, get_env())
+        payload = decode_payload(headers)
+        for log in payload['logs']:
+            del log['time'], log['timestamp']
+            log.pop('exc_frames', None)
+            log.pop('exc_count', None)
+        payloads.append(payload)
+    NT.assert_equal(payloads[0], payloads[1])
+    NT.assert_equal({'answer': 42}, payloads[1]['extension_data'])
+
+
+class Slow(object):
+
+    delay = 0
+
+    def __str__(self):
+        time.sleep(self.delay)
+        return 'slow'
+
+
+def test_flush_stops_at_the_deadline():
+
+    def app(environ, start_response):
+        for i in range(40):
+            logging.getLogger(LOGGER_NAME).info('%s %d', Slow(), i)
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        Slow.delay = 0.05 # slow from now on, i.e. when flushing
+        return ['done']
+
+    app = get_middleware(app)
+    FC.FLUSH_DEADLINE = 0.2
+    try:
+        started = time.time()
+        headers, _ = call(app, get_env())
+        elapsed = time.time() - started
+    finally:
+        FC.FLUSH_DEADLINE = None
+        Slow.delay = 0
+    NT.assert_true(elapsed < 1, elapsed)
+    logs = decode_logs(headers)
+    NT.assert_equal('slow 0', logs[0]['message'])
+    NT.assert_equal('%s %d', logs[-2]['message'])
+    NT.assert_true('flush deadline' in logs[-1]['message'])
+    NT.assert_false([log for log in logs[:-1] if 'args' in log])
+
+
+class SlowState(object):
+
+    def __init__(self, i):
+        self.i = i
+
+    def __getstate__(self):
+        time.sleep(0.01) # slow to encode only
+        return {'i': self.i}
+
+    def __str__(self):
+        return 'state'
+
+
+def test_flush_deadline_covers_encoding():
+
+    def app(environ, start_response):
+        for i in range(300):
+            logging.getLogger(LOGGER_NAME).info('%s', [SlowState(i)])
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ['done']
+
+    app = get_middleware(app)
+    FC.FLUSH_DEADLINE = 0.1
+    try:
+        started = time.time()
+        headers, _ = call(app, get_env())
+        elapsed = time.time() - started
+    finally:
+        FC.FLUSH_DEADLINE = None
+    NT.assert_true(elapsed < 1, elapsed)
+    logs = decode_logs(headers)
+    NT.assert_equal(301, len(logs))
+    NT.assert_true('args' in logs[0])
+    NT.assert_false('args' in logs[-2])
+    NT.assert_true('flush deadline' in logs[-1]['message'])
+
+
+class CountingEnv(dict):
+
+    lookups = 0
+
+    def get(self, *args):
+        self.lookups += 1
+        return dict.get(self, *args)
+
+
+def test_check_fast_path_and_cached_token():
+    app = get_middleware(streaming_app)
+    env = CountingEnv(get_env(enabled=False))
+    NT.assert_false(app._check(env).enabled)
+    NT.assert_equal(1, env.lookups)
+
+    envs = [get_env() for i in range(3)]
+    wrong = get_env()
+    wrong[FC.FIRELOGGER_AUTH_HEADER] = FU.get_auth_token('wrong')
+    real_get_auth_token = FU.get_auth_token
+    calls = []
+    def get_auth_token(password):
+        calls.append(password)
+        return real_get_auth_token(password)
+    FU.get_auth_token = get_auth_token
+    try:
+        for env in envs:
+            NT.assert_true(app._check(env).enabled)
+        NT.assert_false(app._check(wrong).enabled)
+    finally:
+        FU.get_auth_token = real_get_auth_token
+    NT.assert_equal(['snarf'], calls)
+
+
+def test_sampling_profile():
+    if not FM.gprof2dot:
+        raise SkipTest('gprof2dot is not importable')
+
+    def app(environ, start_response):
+        end = time.time() + 0.05
+        while time.time() < end:
+            pass
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ['ok']
+
+    app = get_middleware(app)
+    env = get_env()
+    env[FC.FIRELOGGER_PROFILER_ENABLED_HEADER] = 'sample'
+    headers, body = call(app, env)
+    profile = decode_payload(headers)['profile']
+    NT.assert_true('samples every' in profile['info'])
+    NT.assert_true(':app' in profile['dot'])
+
+
+def test_continuous_profile_export():
+    def app(environ, start_response):
+        end = time.time() + 0.02
+        while time.time() < end:
+            pass
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ['ok']
+
+    app = get_middleware(app, profile_path='/_profile')
+    app._sampler = sampler = FPR.ContinuousSampler(interval=0.001)
+    env = get_env(enabled=False)
+    env['PATH_INFO'] = '/busy'
+    try:
+        NT.assert_equal(['ok'], call(app, env)[1])
+    finally:
+        sampler.stop()
+
+    env = get_env(enabled=False)
+    env['PATH_INFO'] = '/_profile'
+    status = []
+    app(env, lambda s, h: status.append(s))
+    NT.assert_equal(['403 Forbidden'], status)
+
+    env = get_env()
+    env['PATH_INFO'] = '/_profile'
+    env['QUERY_STRING'] = 'format=routes'
+    body = app(env, lambda s, h: status.append(s))
+    NT.assert_equal('200 OK', status[-1])
+    routes = json.loads(body[0].decode('utf-8'))
+    NT.assert_equal(['/busy'], list(routes))
+
+    env['QUERY_STRING'] = 'format=collapsed&route=/busy'
+    body = app(env, lambda s, h: status.append(s))
+    NT.assert_true(':app ' in body[0].decode('utf-8') or
+                   ':app;' in body[0].decode('utf-8'))
+
+    env['QUERY_STRING'] = 'route=/busy'
+    body = app(env, lambda s, h: status.append(s))
+    if FM.gprof2dot:
+        profile = json.loads(body[0].decode('utf-8'))
+        NT.assert_true('/busy' in profile['info'])
+        NT.assert_true(':app' in profile['dot'])
+    else:
+        NT.assert_equal('501 Not Implemented', status[-1])
+
+
+class RecordingSampler(object):
+
+    def __init__(self):
+        self.routes = []
+        self.events = []
+
+    def begin(self, route, top=None):
+        self.routes.append(route)
+        self.events.append('begin')
+
+    def set_route(self, route):
+        self.routes.append(route)
+
+    def set_top(self, top):
+        self.events.append('set_top')
+
+    def end(self):
+        self.events.append('end')
+
+
+def test_continuous_profile_routes():
+    def app(environ, start_response):
+        if environ['PATH_INFO'] == '/resolved':
+            environ['firepython.set_route']('home')
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ['ok']
+
+    def route_func(environ):
+        return '/'.join(part.isdigit() and '<id>' or part
+                        for part in environ['PATH_INFO'].split('/'))
+
+    app = get_middleware(app, profile_path='/_profile', route_func=route_func)
+    app._sampler = sampler = RecordingSampler()
+    for path in ('/users/1', '/users/2/posts', '/resolved'):
+        env = get_env(enabled=False)
+        env['PATH_INFO'] = path
+        call(app, env)
+    NT.assert_equal(['/users/<id>', '/users/<id>/posts', '/resolved', 'home'],
+                    sampler.routes)
+
+
+def test_continuous_profile_covers_the_body():
+    sampler = RecordingSampler()
+
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        sampler.events.append('app')
+        yield 'first'
+        sampler.events.append('body')
+        yield 'second'
+
+    for stream_threshold in (None, 0):
+        del sampler.events[:]
+        middleware = get_middleware(app, profile_path='/_profile',
+                                    stream_threshold=stream_threshold)
+        middleware._sampler = sampler
+        NT.assert_equal(['first', 'second'],
+                        call(middleware, get_env(enabled=False))[1])
+        NT.assert_equal(['begin', 'set_top', 'app', 'body', 'end'],
+                        sampler.events)
+
+
+def test_profile_rendered_in_background():
+    if not FM.gprof2dot:
+        raise SkipTest('gprof2dot is not importable')
+    app = get_middleware(streaming_app, payload_path='/_firelogger/')
+
+    def profile():
+        env = get_env()
+        env[FC.FIRELOGGER_PROFILER_ENABLED_HEADER] = 'yes'
+        workers = FC.PROFILE_RENDER_WORKERS
+        FC.PROFILE_RENDER_WORKERS = 1
+        try:
+            headers, body = call(app, env)
+        finally:
+            FC.PROFILE_RENDER_WORKERS = workers
+        payload = fetch(dict(headers)[FC.FIRELOGGER_TOKEN_RESPONSE_HEADER])
+        NT.assert_false('dot' in payload['profile'])
+        return fetch(payload['profile']['token'])
+
+    def fetch(token):
+        status = []
+        env = get_env()
+        env['PATH_INFO'] = '/_firelogger/' + token
+        body = app(env, lambda s, h, exc_info=None: status.append(s))
+        NT.assert_equal(['200 OK'], status)
+        return json.loads(b''.join(body).decode('utf-8'))
+
+    rendered = profile()
+    NT.assert_true(rendered['dot'].startswith('digraph'))
+    NT.assert_true('function calls' in rendered['info'])
+
+    app._build_profile = lambda profiler: None
+    NT.assert_equal('Profile Graph: no graph rendered', profile()['info'])
+
+
+def test_stored_payload_is_prepared_when_sent():
+    items = ['first']
+
+    def app(environ, start_response):
+        logging.getLogger(LOGGER_NAME).info('items %s', items)
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ['ok']
+
+    app = get_middleware(app, payload_path='/_firelogger/')
+    headers, body = call(app, get_env())
+    items.append('second') # after the response, before the fetch
+    env = get_env()
+    env['PATH_INFO'] = \
+        '/_firelogger/' + dict(headers)[FC.FIRELOGGER_TOKEN_RESPONSE_HEADER]
+    body = app(env, lambda s, h, exc_info=None: None)
+    logs = json.loads(b''.join(body).decode('utf-8'))['logs']
+    NT.assert_equal("items ['first']", logs[0]['message'])
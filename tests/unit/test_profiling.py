@@ -0,0 +1,361 @@
+import os
+import time
+import threading
+
+import nose.tools as NT
+from nose import SkipTest
+
+import firepython.profiling as FP
+
+
+def busy(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+
+def outer():
+    busy(0.05)
+    inner()
+
+
+def inner():
+    busy(0.05)
+
+
+def get_function(profile, name):
+    for function in profile.functions.values():
+        if function.name.endswith(':' + name):
+            return function
+    raise AssertionError('no function %s' % name)
+
+
+def test_create_profiler():
+    NT.assert_true(isinstance(FP.create_profiler(' Sample'),
+                              FP.SamplingProfiler))
+    NT.assert_false(isinstance(FP.create_profiler('1'), FP.SamplingProfiler))
+
+
+def test_sampling_profiler():
+    profiler = FP.SamplingProfiler(interval=0.001)
+    profiler.runcall(outer)
+    NT.assert_true(profiler.samples > 10)
+    NT.assert_true(all(stack[0][2] == 'outer' for stack in profiler.stacks))
+    NT.assert_true('samples every 1.0ms' in profiler.info())
+
+    if FP.gprof2dot is None:
+        raise SkipTest('gprof2dot is not importable')
+    gprof2dot = FP.gprof2dot
+    profile = profiler.profile()
+    outer_function = get_function(profile, 'outer')
+    inner_function = get_function(profile, 'inner')
+    NT.assert_almost_equal(1.0, outer_function[gprof2dot.TOTAL_TIME_RATIO])
+    NT.assert_true(0.3 < inner_function[gprof2dot.TOTAL_TIME_RATIO] < 0.7)
+    call = outer_function.calls[inner_function.id]
+    NT.assert_almost_equal(inner_function[gprof2dot.TOTAL_TIME_RATIO],
+                           call[gprof2dot.TOTAL_TIME_RATIO])
+
+
+def test_sampling_profiler_pause():
+    profiler = FP.SamplingProfiler(interval=0.001)
+    profiler.enable()
+    profiler.pause()
+    busy(0.05)
+    NT.assert_equal(0, profiler.samples)
+    profiler.resume()
+    busy(0.1)
+    profiler.disable()
+    NT.assert_true(profiler.samples > 5, profiler.samples)
+    NT.assert_true(profiler.duration < 0.14, profiler.duration)
+
+
+def fib(n):
+    if n < 2:
+        return n
+    return fib(n - 1) + fib(n - 2)
+
+
+def test_monitoring_profiler():
+    if FP.monitoring is None:
+        raise SkipTest('sys.monitoring requires Python 3.12+')
+    profiler = FP.create_profiler('monitoring')
+    NT.assert_equal(10946, profiler.runcall(fib, 21))
+    functions = dict((code.co_name, stats)
+                     for code, stats in profiler.functions.items())
+    NT.assert_equal(35421, functions['fib'][0]) # exact call count
+    NT.assert_false('__init__' in functions) # nose internals
+    NT.assert_equal(None, profiler.tool_id)
+    NT.assert_true('35421 function calls' in profiler.info())
+
+
+def test_monitoring_profiler_packages():
+    if FP.monitoring is None:
+        raise SkipTest('sys.monitoring requires Python 3.12+')
+    profiler = FP.MonitoringProfiler(packages=['json'])
+    import json
+    profiler.runcall(lambda: fib(10) and json.dumps({'a': [1, 2]}))
+    filenames = set(code.co_filename for code in profiler.functions)
+    NT.assert_true(filenames)
+    NT.assert_true(all(os.sep + 'json' + os.sep in filename
+                       for filename in filenames))
+
+
+def test_monitoring_profiler_keeps_disabled_code_apart():
+    if FP.monitoring is None:
+        raise SkipTest('sys.monitoring requires Python 3.12+')
+    import json
+    for packages in (['json'], None, ['json']):
+        profiler = FP.MonitoringProfiler(packages=packages)
+        profiler.runcall(lambda: fib(10) and json.dumps([1]))
+        calls = [stats[0] for code, stats in profiler.functions.items()
+                 if code.co_name == 'fib']
+        NT.assert_equal(packages is None and [177] or [], calls)
+
+
+def test_monitoring_profiler_pause():
+    if FP.monitoring is None:
+        raise SkipTest('sys.monitoring requires Python 3.12+')
+    profiler = FP.MonitoringProfiler(packages=None)
+    profiler.enable()
+    try:
+        profiler.pause()
+        fib(5)
+        profiler.resume()
+        fib(3)
+    finally:
+        profiler.disable()
+    calls = [stats[0] for code, stats in profiler.functions.items()
+             if code.co_name == 'fib']
+    NT.assert_equal([5], calls)
+
+
+def test_cprofile_after_monitoring_profiler():
+    if FP.monitoring is None:
+        raise SkipTest('sys.monitoring requires Python 3.12+')
+    import cProfile
+    import pstats
+    FP.MonitoringProfiler(packages=['json']).runcall(fib, 10)
+    profiler = cProfile.Profile()
+    profiler.runcall(fib, 10)
+    calls = [stats[1] for key, stats in pstats.Stats(profiler).stats.items()
+             if key[2] == 'fib']
+    NT.assert_equal([177], calls)
+
+
+class FakeGprof2dot(object):
+    """ The part of the ``gprof2dot`` model ``profile()`` methods use. """
+
+    CALLS = 'calls'
+    TIME = 'time'
+    TIME_RATIO = 'time ratio'
+    TOTAL_TIME = 'total time'
+    TOTAL_TIME_RATIO = 'total time ratio'
+
+    class Call(dict):
+
+        def __init__(self, callee_id):
+            dict.__init__(self)
+            self.callee_id = callee_id
+
+    class Function(dict):
+
+        def __init__(self, id, name):
+            dict.__init__(self)
+            self.id = id
+            self.name = name
+            self.calls = {}
+
+        def add_call(self, call):
+            self.calls[call.callee_id] = call
+
+    class Profile(dict):
+
+        def __init__(self):
+            dict.__init__(self)
+            self.functions = {}
+
+        def add_function(self, function):
+            self.functions[function.id] = function
+
+        def validate(self):
+            for function in self.functions.values():
+                for callee_id in function.calls:
+                    assert callee_id in self.functions
+
+        def ratio(self, outevent, inevent):
+            for function in self.functions.values():
+                function[outevent] = function[inevent] / self[inevent]
+                for call in function.calls.values():
+                    if inevent in call:
+                        call[outevent] = call[inevent] / self[inevent]
+            self[outevent] = 1.0
+
+
+def test_monitoring_profiler_profile():
+    if FP.monitoring is None:
+        raise SkipTest('sys.monitoring requires Python 3.12+')
+    profiler = FP.MonitoringProfiler(packages=None)
+    profiler.runcall(outer)
+    gprof2dot = FakeGprof2dot
+    saved, FP.gprof2dot = FP.gprof2dot, gprof2dot
+    try:
+        profile = profiler.profile()
+    finally:
+        FP.gprof2dot = saved
+    outer_function = get_function(profile, 'outer')
+    inner_function = get_function(profile, 'inner')
+    NT.assert_equal(1, outer_function[gprof2dot.CALLS])
+    NT.assert_almost_equal(1.0, outer_function[gprof2dot.TOTAL_TIME_RATIO])
+    NT.assert_true(0.3 < inner_function[gprof2dot.TOTAL_TIME_RATIO] < 0.7)
+    call = outer_function.calls[inner_function.id]
+    NT.assert_equal(1, call[gprof2dot.CALLS])
+    NT.assert_almost_equal(inner_function[gprof2dot.TOTAL_TIME_RATIO],
+                           call[gprof2dot.TOTAL_TIME_RATIO])
+    NT.assert_equal(2, get_function(profile, 'busy')[gprof2dot.CALLS])
+    NT.assert_true(profile[gprof2dot.TIME] <= profile[gprof2dot.TOTAL_TIME])
+
+
+def test_continuous_sampler():
+    sampler = FP.ContinuousSampler(interval=0.001)
+    sampler.begin('/outer')
+    try:
+        outer()
+    finally:
+        sampler.end()
+        time.sleep(0.01)
+        thread = sampler._thread
+        sampler.stop()
+    NT.assert_false(thread.is_alive())
+    routes = sampler.routes()
+    NT.assert_equal(['/outer'], list(routes))
+    stacks = sampler.stacks('/outer')
+    NT.assert_equal(routes['/outer'], sum(stacks.values()))
+    NT.assert_true(any(key[2] == 'inner' for stack in stacks
+                       for key in stack))
+    for stack in sampler.stacks():
+        NT.assert_equal(('', 0, '/outer'), stack[0])
+    lines = sampler.collapsed('/outer').split('\n')
+    NT.assert_true(all(line.rsplit(' ', 1)[1].isdigit() for line in lines))
+
+
+def test_continuous_sampler_bounds():
+    sampler = FP.ContinuousSampler(max_routes=2, max_stacks=2, windows=2)
+    for i in range(3):
+        routes = sampler._current_window()
+        for route in ('/a', '/b', '/c'):
+            for stack in ('x', 'y', 'z'):
+                sampler._count(routes, route, (('f', 1, stack),))
+        sampler._windows.append((0, {}))
+    NT.assert_equal(2, len(sampler._windows))
+    NT.assert_equal({'/a': 3, '/b': 3, '(other)': 3}, sampler.routes())
+    NT.assert_equal({(('f', 1, 'x'),): 1, (('f', 1, 'y'),): 1,
+                     (sampler.TRUNCATED,): 1}, sampler.stacks('/a'))
+
+
+def test_cprofile_profile_matches_pstats_parser():
+    if FP.gprof2dot is None:
+        raise SkipTest('gprof2dot is not importable')
+    import cProfile
+    gprof2dot = FP.gprof2dot
+    profiler = cProfile.Profile()
+    profiler.runcall(lambda: [fib(12), sorted([3, 1, 2]), outer()])
+    profile, info = FP.cprofile_profile(profiler)
+
+    profiler.create_stats()
+    parser = gprof2dot.PstatsParser(profiler)
+    parser.get_function_name = FP.function_name
+    expected = parser.parse()
+
+    def summary(profile):
+        names = dict((function.id, function.name)
+                     for function in profile.functions.values())
+        return dict((function.name, (
+            function[gprof2dot.CALLS],
+            round(function[gprof2dot.TOTAL_TIME_RATIO], 6),
+            sorted((names[call.callee_id], call[gprof2dot.CALLS])
+                   for call in function.calls.values())))
+            for function in profile.functions.values())
+
+    NT.assert_equal(summary(expected), summary(profile))
+    NT.assert_true(info.startswith('Profile Graph: '))
+    NT.assert_true('primitive calls' in info) # fib is recursive
+
+
+def test_function_names_are_cached():
+    cache = FP._NameCache(2)
+    NT.assert_equal('/a/b:1:f', cache.get(('/a/b.py', 1, 'f')))
+    cache.get(('/a/c.py', 1, 'g'))
+    cache.get(('/a/b.py', 1, 'f'))
+    cache.get(('/a/d.py', 1, 'h'))
+    NT.assert_equal([('/a/b.py', 1, 'f'), ('/a/d.py', 1, 'h')],
+                    sorted(cache._names))
+
+
+def test_render_pool():
+    pool = FP.RenderPool(workers=1, size=2)
+    NT.assert_equal(42, pool.submit(lambda: 42).wait(5))
+    failed = pool.submit(lambda: 1 / 0)
+    NT.assert_equal(None, failed.wait(5))
+    NT.assert_true(failed.error.startswith('failed: '))
+
+    started = threading.Event()
+    release = threading.Event()
+    def block():
+        started.set()
+        release.wait(5)
+        return 'blocked'
+    blocking = pool.submit(block)
+    started.wait(5)
+    jobs = [pool.submit(lambda i=i: i) for i in range(3)]
+    release.set()
+    NT.assert_equal('blocked', blocking.wait(5))
+    NT.assert_equal(None, jobs[0].wait(5)) # the oldest waiting job
+    NT.assert_true(jobs[0].error.startswith('dropped'))
+    NT.assert_equal([1, 2], [job.wait(5) for job in jobs[1:]])
+
+
+class SlowRenderPool(FP.RenderPool):
+
+    created = 0
+
+    def __init__(self):
+        time.sleep(0.01)
+        SlowRenderPool.created += 1
+        super(SlowRenderPool, self).__init__()
+
+
+def test_render_pool_is_created_once():
+    SlowRenderPool.created = 0
+    saved = FP.RenderPool, FP._render_pool
+    FP.RenderPool, FP._render_pool = SlowRenderPool, None
+    try:
+        threads = [threading.Thread(target=FP.get_render_pool)
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        FP.RenderPool, FP._render_pool = saved
+    NT.assert_equal(1, SlowRenderPool.created)
+
+
+def test_function_name_cache_is_thread_safe():
+    cache = FP._NameCache(50)
+    errors = []
+
+    def worker(n):
+        try:
+            for i in range(2000):
+                key = ('/a/%d.py' % ((n * 7 + i) % 80), 1, 'f')
+                NT.assert_equal(FP.function_name(key), cache.get(key))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    NT.assert_equal([], errors)
+    NT.assert_true(len(cache._names) <= 50)
@@ -0,0 +1,75 @@
+import sys
+import json
+import uuid
+import decimal
+import datetime
+import traceback
+import collections
+
+import nose.tools as NT
+
+import firepython.serializers as FS
+
+
+class Point(object):
+
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+
+class Slotted(object):
+    __slots__ = ('a', 'b')
+
+    def __init__(self):
+        self.a = [1, 2]
+
+
+def get_exc_info():
+    try:
+        1 / 0
+    except ZeroDivisionError:
+        exc_info = sys.exc_info()
+        return (exc_info[0], exc_info[1],
+                [tuple(frame) for frame in traceback.extract_tb(exc_info[2])])
+
+
+def get_payload():
+    return {"logs": [{
+        "message": "point %s",
+        "args": (Point(1, [2, (3, 4)]), Slotted(), {1: 'one', None: 'n'}),
+        "exc_info": get_exc_info(),
+        "deep": [[[[[[[[[[[[[[[[[[['bottom']]]]]]]]]]]]]]]]]]],
+        "locals": {
+            "when": datetime.datetime(2020, 1, 2, 3, 4, 5),
+            "day": datetime.date(2020, 1, 2),
+            "at": datetime.time(3, 4, 5),
+            "took": datetime.timedelta(1, 2, 3),
+            "id": uuid.UUID(int=5),
+            "price": decimal.Decimal('1.5'),
+            "z": 1 + 2j,
+            "groups": collections.defaultdict(list, a=[1]),
+        },
+    }]}
+
+
+def test_json_engine_matches_jsonpickle_output():
+    expected = json.loads(FS.JsonpickleSerializer().encode(get_payload()))
+    actual = json.loads(FS.JsonSerializer().encode(get_payload()))
+    NT.assert_equal(expected, actual)
+
+
+def test_json_engine_breaks_cycles():
+    point = Point(1, None)
+    point.y = point
+    flat = FS.JsonSerializer().flatten({'point': point})
+    NT.assert_equal(1, flat['point']['x'])
+    NT.assert_equal(repr(point), flat['point']['y'])
+
+
+def test_get_serializer():
+    yield NT.assert_true, isinstance(FS.get_serializer('json'),
+                                     FS.JsonSerializer)
+    engine = FS.JsonSerializer()
+    yield NT.assert_true, FS.get_serializer(engine) is engine
+    yield NT.assert_raises, ValueError, FS.get_serializer, 'yaml'
@@ -0,0 +1,31 @@
+import time
+
+import nose.tools as NT
+
+from firepython.store import PayloadStore
+
+
+def test_payload_can_be_popped_once():
+    store = PayloadStore(size=10, ttl=60)
+    token = store.put('payload')
+    NT.assert_equal(32, len(token))
+    NT.assert_equal('payload', store.pop(token))
+    NT.assert_equal(None, store.pop(token))
+    NT.assert_equal(None, store.pop('nonsense'))
+
+
+def test_oldest_payload_is_dropped_when_full():
+    store = PayloadStore(size=2, ttl=60)
+    tokens = [store.put(i) for i in range(3)]
+    NT.assert_equal(2, len(store))
+    NT.assert_equal(None, store.pop(tokens[0]))
+    NT.assert_equal(2, store.pop(tokens[2]))
+
+
+def test_expired_payload_is_gone():
+    store = PayloadStore(size=10, ttl=60)
+    token = store.put('payload')
+    store._payloads[token] = (time.time() - 1, 'payload')
+    NT.assert_equal(None, store.pop(token))
+    store.put('another')
+    NT.assert_equal(1, len(store))
@@ -34,5 +34,24 @@ def test_get_auth_token():
     yield NT.assert_equal, EXPECTED_AUTH_TOK, ret
 
 
+def test_negotiate_encoding():
+    yield NT.assert_equal, None, FU.negotiate_encoding('')
+    yield NT.assert_equal, None, FU.negotiate_encoding('br, lzma')
+    yield NT.assert_equal, 'zlib', FU.negotiate_encoding('br, ZLIB, deflate')
+    yield NT.assert_equal, 'deflate', FU.negotiate_encoding('deflate;q=1')
+
+
 EXPECTED_VERSION_HEADER = (CONST.FIRELOGGER_VERSION_HEADER, 'bork')
 EXPECTED_AUTH_TOK = 'c5d00db3f939c1cc523f57d67e5cc319'
+
+
+def test_parse_version_header():
+    yield NT.assert_equal, ('1.0', set()), FU.parse_version_header(' 1.0 ')
+    yield NT.assert_equal, ('1.0', set(['compact'])), \
+        FU.parse_version_header('1.0; Compact')
+
+
+def test_constant_time_compare():
+    yield NT.assert_true, FU.constant_time_compare('abc', 'abc')
+    yield NT.assert_false, FU.constant_time_compare('abc', 'abd')
+    yield NT.assert_false, FU.constant_time_compare('abc', 'ab')